@@ -1,219 +1,250 @@
 # mypy: ignore-errors
-from azure.devops.connection import Connection
-from msrest.authentication import BasicAuthentication
-from azure.devops.released.build import Build, BuildClient, BuildDefinition
+from __future__ import annotations
 
-import threading
-from github import Github
+from dataclasses import dataclass
+import json
+import logging
 from operator import attrgetter
-from typing import TYPE_CHECKING, Optional, Dict
+from typing import TYPE_CHECKING, Any, Callable
+
+import breaker
+import github_graphql
+import ratelimit
+import tracing
+from pipelines import api_calls, BuildState, DeployStage, Pipelines, PollStatusThread, QueryResult, QueryResultStatus
+
+# One batched query per poll, however many environments there are
+_api_calls = api_calls("ado")
+
+log = logging.getLogger(__name__)
 
 if TYPE_CHECKING:
+    from azure.devops.connection import Connection
+    from azure.devops.released.build import BuildClient
+    from github import Github
     from local_settings import ADOConfig
 
 
-class QueryResultStatus():
-    CHECKING = "Checking"
-    BUILD_COMPLETE = "Build Complete"
-    BUILD_IN_PROGRESS = "Building"
-
-
-class QueryResult():
-    def __init__(self):
-        self.enable_dev = False
-        self.enable_tst = False
-        self.enable_stage = False
-        self.enable_prod = False
-        self.deploying_dev = False
-        self.deploying_tst = False
-        self.deploying_stage = False
-        self.deploying_prod = False
-        self.build_dev = None
-        self.build_tst = None
-        self.build_stage = None
-        self.build_prod = None
-        self.branch_dev = None
-        self.branch_tst = None
-        self.branch_stage = None
-        self.branch_prod = None
-
-
-class AdoPipelines():
+@dataclass(frozen=True)
+class AdoBuildState(BuildState):
+    build_id: int
+
+
+class AdoPipelines(Pipelines):
+    config: "ADOConfig"
+    connection: Connection
+
     def __init__(
         self,
         config: "ADOConfig"
 
     ):
-        self._poll_thread = None
-        self.config = config
-
-    def get_status(self):
-        if self._poll_thread is None:
-            self._poll_thread = PollStatusThread(
-                config=self.config,
-                interval=10
-            )
-            self._poll_thread.start()
-        return self._poll_thread._last_result
-
-    def approve(self, approve_env, params: Dict[str, str]) -> Optional[str]:
-        print("Approve env:" + approve_env)
-        # Get Release Client
+        # Like PyGithub, slow to import on a Pi, so not until a project uses it
+        from azure.devops.connection import Connection
+        from msrest.authentication import BasicAuthentication
         connection = Connection(
-            base_url=self.config.ado_org_url,
-            creds=BasicAuthentication('', self.config.ado_pat)
-        )
-        build_client: BuildClient = connection.clients.get_build_client()
-
-        build_def = build_client.get_definition(
-            self.config.ado_project,
-            self.config.ado_pipeline_ids[approve_env]
+            base_url=config.ado_org_url,
+            creds=BasicAuthentication('', config.ado_pat)
         )
+        super().__init__(config=config, poll_thread_class=AdoPollStatusThread, connection=connection)
 
-        if approve_env == 'Dev':
-            source_branch = self.get_status().branch_dev
-        elif approve_env == 'Test':
-            source_branch = self.get_status().branch_tst
-        elif approve_env == 'Stage':
-            source_branch = self.get_status().branch_stage
-        elif approve_env == 'Prod':
-            source_branch = self.get_status().branch_prod
-        else:
+    def approve(
+        self,
+        approve_env: str,
+        params: dict[str, str],
+        progress: Callable[[DeployStage], None] | None = None,
+        timeout: float | None = None,
+    ) -> AdoBuildState | None:
+        log.info("Approve env: %s", approve_env)
+        from azure.devops.released.build import Build, DefinitionReference
+
+        if approve_env not in self.config.ado_pipeline_ids:
             return None
-
+        build_client: BuildClient = self.connection.clients.get_build_client()
+        # Queuing only needs the definition's id, not the whole definition
         build = Build(
-            source_branch=source_branch,
-            definition=build_def
+            source_branch=self.source_branch(approve_env),
+            definition=DefinitionReference(id=self.config.ado_pipeline_ids[approve_env]),
+            parameters=json.dumps(params) if params else None,
         )
-        build_result = build_client.queue_build(
-            build=build,
-            project=self.config.ado_project
+        _api_calls.inc()
+        with tracing.span("queue_build", "deploy"):
+            build_result = build_client.queue_build(
+                build=build,
+                project=self.config.ado_project
+            )
+        if progress:
+            # The queued build comes straight back
+            progress(DeployStage.DISPATCHED)
+            progress(DeployStage.RUN_FOUND)
+
+        state = AdoBuildState(
+            number=build_result.build_number,
+            build_id=build_result.id,
+            result=QueryResultStatus.RUNNING,
         )
+        self._set_build(approve_env, state)
+        return state
 
-        return build_result.build_number
 
+class AdoPollStatusThread(PollStatusThread):
+    config: "ADOConfig"
+    _connection: Connection
+    backend = "ado"
 
-class PollStatusThread(threading.Thread):
     def __init__(
         self,
         config: "ADOConfig",
-        interval=10
+        github_conn: Github,
+        last_result: QueryResult,
+        connection: Connection,
+        interval: float = 10
     ):
-        super(PollStatusThread, self).__init__()
-        self.daemon = True
-        self.stoprequest = threading.Event()
+        super().__init__(config, github_conn, connection, last_result, interval)
+        self._build_client: BuildClient = connection.clients.get_build_client()
+        # self._rm_client = self._connection.clients.get_release_client()
+        # Lazy, so it doesn't cost a request until it's used
+        self._repo = github_conn.get_repo(config.github_repo, lazy=True)
+        self._graphql: github_graphql.GitHubGraphQL | None = github_graphql.GitHubGraphQL(
+            self._repo, config.github_repo, config.github_pat
+        )
+        # What the last branch lookup cost, in requests and in GitHub's own
+        # units, points for GraphQL and requests for REST
+        self._github_requests = 0
+        self._github_spent = 0
+
+    def _rate_budget(self) -> ratelimit.RateBudget:
+        # Azure DevOps only says anything about its limits once it's throttling
+        return ratelimit.for_token("ado", self.config.ado_pat)
+
+    def _circuit_breaker(self) -> breaker.CircuitBreaker:
+        return breaker.for_service(self.config.ado_org_url)
+
+    @property
+    def _github_budget(self) -> ratelimit.RateBudget:
+        """What the branch lookups come out of, GitHub's quota rather than Azure DevOps'."""
+        if self._graphql is not None:
+            return self._graphql.budget
+        return ratelimit.for_token("github", self.config.github_pat)
+
+    def _next_interval(self, calls: float) -> float:
+        # Whichever of the two is shorter on quota sets the pace
+        return max(
+            super()._next_interval(calls - self._github_requests),
+            self._github_budget.interval(self.delay, self._github_spent, deploying=self.deploying),
+        )
 
-        # self.regularInterval = interval
-        self.delay = interval
+    def poll_once(self) -> None:
+        (dev_branch, tst_branch, main_branch) = self._latest_branches()
 
-        self.config = config
+        # Taken before the query, so a deploy queued during it isn't undone
+        previous = {e: self._current_build(e) for e in self.config.ado_pipeline_ids}
 
-        self._connection = Connection(
-            base_url=config.ado_org_url,
-            creds=BasicAuthentication('', config.ado_pat)
+        # Just the newest build of every definition, in the one request
+        definition_ids = list(self.config.ado_pipeline_ids.values())
+        _api_calls.inc()
+        builds = self._build_client.get_builds(
+            self.config.ado_project,
+            definitions=definition_ids,
+            max_builds_per_definition=1,
+            query_order='queueTimeDescending',
         )
-        self._build_client = self._connection.clients.get_build_client()
-        # self._rm_client = self._connection.clients.get_release_client()
-
-        self._last_result = QueryResult()
-
-    def start(self):
-        self.stoprequest.clear()
-        super(PollStatusThread, self).start()
-
-    def stop(self, timeout=10) -> None:
-        self.stoprequest.set()
-        self.join(timeout)
-
-    def join(self, timeout=None) -> None:
-        super(PollStatusThread, self).join(timeout)
-        if self.is_alive():
-            assert timeout is not None
-            raise RuntimeError(
-                "PollStatusThread failed to die within %d seconds" % timeout)
-
-    def run(self) -> None:
-        while True:
-            # Wait a bit then poll the server again
-            result = QueryResult()
-            github = Github(
-                base_url=self.config.github_url,
-                login_or_token=self.config.github_pat
-            )
-            repo = github.get_repo(self.config.github_repo)
-            branches = repo.get_branches()
-
-            dev_branches = [branch for branch in branches if branch.name.startswith('dev/')]
-            dev_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
-            dev_branch = dev_branches[0].name if dev_branches else None
-
-            tst_branches = [branch for branch in branches if branch.name.startswith('tst/')]
-            tst_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
-            tst_branch = tst_branches[0].name if tst_branches else None
-
-            main_branches = [branch for branch in branches if branch.name == 'main']
-            main_branch = main_branches[0].name if main_branches else None
-
-            for e in self.config.ado_pipeline_ids:
-                buildDef: BuildDefinition = self._build_client.get_definition(
-                    self.config.ado_project,
-                    self.config.ado_pipeline_ids[e],
-                    include_latest_builds=True
-                )
-                if buildDef.latest_completed_build.id == buildDef.latest_build.id:
-                    # build is finished
-                    deploying = False
-                else:
-                    # A build is in progress
-                    deploying = True
-
-                if e == 'Dev':
-                    result.enable_dev = bool(dev_branch)
-                    result.branch_dev = dev_branch
-                    result.deploying_dev = deploying
-                    result.build_dev = buildDef.latest_build
-
-                elif e == 'Test':
-                    result.enable_tst = bool(tst_branch)
-                    result.branch_tst = tst_branch
-                    result.deploying_tst = deploying
-                    result.build_tst = buildDef.latest_build
-                elif e == 'Stage':
-                    result.enable_stage = bool(main_branch)
-                    result.branch_stage = main_branch
-                    result.deploying_stage = deploying
-                    result.build_stage = buildDef.latest_build
-                elif e == 'Prod':
-                    result.enable_prod = True
-                    result.branch_prod = None
-                    result.deploying_prod = deploying
-                    result.build_prod = buildDef.latest_build
-
-            if (
-                # Check if any values have changed to trigger saving a new result
-                # the Build objects are not checked because they'll always be different
-                # and we don't care of the Build changes unless one of these values
-                # has changed
-                self._last_result.enable_dev != result.enable_dev or
-                self._last_result.enable_tst != result.enable_tst or
-                self._last_result.enable_stage != result.enable_stage or
-                self._last_result.enable_prod != result.enable_prod or
-                self._last_result.deploying_dev != result.deploying_dev or
-                self._last_result.deploying_tst != result.deploying_tst or
-                self._last_result.deploying_stage != result.deploying_stage or
-                self._last_result.deploying_prod != result.deploying_prod or
-                self._last_result.branch_dev != result.branch_dev or
-                self._last_result.branch_tst != result.branch_tst or
-                self._last_result.branch_stage != result.branch_stage or
-                self._last_result.branch_prod != result.branch_prod
-            ):
-                # Something has changed
-                print("change")
-                self._last_result = result
-
-            # At the end of the thread execution, wait a bit and then poll again
-            if self.stoprequest.wait(self.delay):
-                break
+        latest = {build.definition.id: build for build in builds}
+
+        for e, definition_id in self.config.ado_pipeline_ids.items():
+            build = latest.get(definition_id)
+            if build is None:
+                # Never been run
+                (deploying, state) = (False, None)
+            else:
+                (deploying, result) = _build_status(build)
+                state = AdoBuildState(number=build.build_number, build_id=build.id, result=result)
+
+            if e == 'Dev':
+                self._last_result.enable_dev = bool(dev_branch)
+                self._last_result.branch_dev = dev_branch
+                self._last_result.deploying_dev = deploying
+            elif e == 'Test':
+                self._last_result.enable_tst = bool(tst_branch)
+                self._last_result.branch_tst = tst_branch
+                self._last_result.deploying_tst = deploying
+            elif e == 'Stage':
+                self._last_result.enable_stage = bool(main_branch)
+                self._last_result.branch_stage = main_branch
+                self._last_result.deploying_stage = deploying
+            elif e == 'Prod':
+                self._last_result.enable_prod = True
+                self._last_result.branch_prod = None
+                self._last_result.deploying_prod = deploying
+            else:
+                continue
+            self._replace_build(e, previous[e], state)
+
+    def _latest_branches(self) -> tuple[str | None, str | None, str | None]:
+        """The most recently committed to dev/ and tst/ branches, and main if there is one."""
+        (self._github_requests, self._github_spent) = (0, 0)
+        try:
+            if self._graphql is not None:
+                try:
+                    return self._latest_branches_graphql()
+                except Exception as ex:
+                    if not github_graphql.unavailable(ex):
+                        raise
+                    log.warning("GitHub didn't take the GraphQL branch query, listing branches over REST instead: %s", ex)
+                    self._graphql = None
+            return self._latest_branches_rest()
+        except Exception as ex:
+            backoff = ratelimit.retry_after(ex)
+            if backoff is not None:
+                # It's GitHub asking us to slow down, not Azure DevOps
+                self._github_budget.throttle(backoff)
+            raise
+
+    def _latest_branches_graphql(self) -> tuple[str | None, str | None, str | None]:
+        _api_calls.inc()
+        status = self._graphql.status(heads=('dev/', 'tst/', 'main'))
+        (self._github_requests, self._github_spent) = (1, status.cost)
+        heads = status.heads
+        return (heads['dev/'], heads['tst/'], heads['main'])
+
+    def _latest_branches_rest(self) -> tuple[str | None, str | None, str | None]:
+        _api_calls.inc()
+        branches = list(self._repo.get_branches())
+
+        dev_branches = [branch for branch in branches if branch.name.startswith('dev/')]
+        tst_branches = [branch for branch in branches if branch.name.startswith('tst/')]
+        # Getting at each of these branches' commit dates is another request
+        commits = len(dev_branches) + len(tst_branches)
+        _api_calls.inc(commits)
+
+        dev_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
+        dev_branch = dev_branches[0].name if dev_branches else None
+
+        tst_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
+        tst_branch = tst_branches[0].name if tst_branches else None
+
+        main_branches = [branch for branch in branches if branch.name == 'main']
+        main_branch = main_branches[0].name if main_branches else None
+
+        self._github_requests = self._github_spent = 1 + commits
+        # From the headers of the last response, so this doesn't cost a request
+        (remaining, limit) = self._github_conn.rate_limiting
+        self._github_budget.update(remaining, limit, self._github_conn.rate_limiting_resettime)
+        return (dev_branch, tst_branch, main_branch)
+
+
+def _build_status(build: Any) -> tuple[bool, QueryResultStatus]:
+    """Whether a build is still deploying, and how it's doing."""
+    if build.status != 'completed':
+        # notStarted, inProgress, cancelling, postponed
+        return (True, QueryResultStatus.RUNNING)
+    if build.result == 'succeeded':
+        return (False, QueryResultStatus.SUCCEEDED)
+    if build.result == 'partiallySucceeded':
+        return (False, QueryResultStatus.PARTIAL)
+    if build.result == 'canceled':
+        return (False, QueryResultStatus.CANCELED)
+    return (False, QueryResultStatus.FAILED)
 
 
 # def pipemain():
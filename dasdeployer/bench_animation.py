@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Animation throughput benchmark.
+
+Drives every animation type, and the mixes the deployer actually shows,
+through the render thread into a `RecordingPixelSink`, then reports achieved
+fps, CPU time per frame and frame interval jitter. Runs anywhere, no Pi
+needed. Save the JSON from two versions and use --compare to diff them.
+
+Example: ./bench_animation.py --seconds 5 --json before.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import rgb
+from pixelsink import RecordingPixelSink
+from rgb import Color, RGBButton
+
+
+def _all(*calls):
+    def setup(button):
+        for call in calls:
+            call(button)
+    return setup
+
+
+WORKLOADS = {
+    # Single animation types on every segment
+    "fill": _all(lambda b: b.fill(Color.GREEN)),
+    "flash": _all(
+        lambda b: b.flashRing(Color.YELLOW, .5),
+        lambda b: b.flashButton(Color.BLUE, .5),
+        lambda b: b.flashKey1(Color.YELLOW, .5),
+        lambda b: b.flashKey2(Color.YELLOW, .5),
+    ),
+    "pulse": _all(
+        lambda b: b.pulseRing(Color.YELLOW),
+        lambda b: b.pulseButton(Color.RED),
+        lambda b: b.pulseKey1(Color.GREEN),
+        lambda b: b.pulseKey2(Color.GREEN),
+    ),
+    "chase": _all(
+        lambda b: b.chaseRing(Color.BLUE),
+        lambda b: b.chaseKey1(Color.YELLOW),
+        lambda b: b.chaseKey2(Color.YELLOW),
+    ),
+    "unicorn": _all(lambda b: b.unicornRing(25)),
+    # What the deployer shows in each stage of a deploy
+    "toggle_up": _all(
+        lambda b: b.fillButton(Color.OFF),
+        lambda b: b.pulseRing(Color.YELLOW),
+        lambda b: b.chaseKey1(Color.YELLOW),
+        lambda b: b.chaseKey2(Color.YELLOW),
+    ),
+    "armed": _all(
+        lambda b: b.pulseKey1(Color.GREEN),
+        lambda b: b.pulseKey2(Color.GREEN),
+        lambda b: b.pulseButton(Color.RED, 1),
+        lambda b: b.unicornRing(25),
+    ),
+    "deploying": _all(
+        lambda b: b.fillButton(Color.WHITE),
+        lambda b: b.chaseRing(Color.BLUE, 1),
+    ),
+}
+
+# Workloads that also post commands while running, as busy callbacks would
+STORMS = {
+    "armed_command_storm": ("armed", [
+        lambda b: b.pulseButton(Color.RED, 1),
+        lambda b: b.fillButton(Color.WHITE),
+    ]),
+}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _stats(sink, fps, cpu_seconds):
+    recorded = sink.recorded()
+    frames = len(recorded)
+    result = {
+        "frames": sink.count,
+        "fps": 0.0,
+        "cpu_ms_per_frame": (cpu_seconds * 1000 / sink.count) if sink.count else 0.0,
+        "interval_mean_ms": 0.0,
+        "jitter_ms": 0.0,
+        "max_late_ms": 0.0,
+    }
+    if frames < 2:
+        return result
+    timestamps = [t for (t, _) in recorded]
+    intervals = [b - a for (a, b) in zip(timestamps, timestamps[1:])]
+    target = 1 / fps
+    result["fps"] = (frames - 1) / (timestamps[-1] - timestamps[0])
+    result["interval_mean_ms"] = statistics.mean(intervals) * 1000
+    result["jitter_ms"] = statistics.pstdev(intervals) * 1000
+    result["max_late_ms"] = max(0.0, max(intervals) - target) * 1000
+    return result
+
+
+def run_workload(setup, seconds, fps, dither, storm=None, storm_interval=0.02):
+    sink = RecordingPixelSink(rgb._NUM_PIXELS, capacity=int(seconds * fps * 2) + 16)
+    button = RGBButton(fps=fps, dither=dither, sink=sink)
+    try:
+        setup(button)
+        # Let the first frames settle before measuring
+        time.sleep(0.25)
+        sink.clear()
+        cpu_start = time.process_time()
+        end = time.perf_counter() + seconds
+        i = 0
+        while time.perf_counter() < end:
+            if storm:
+                storm[i % len(storm)](button)
+                i += 1
+                time.sleep(storm_interval)
+            else:
+                time.sleep(min(0.1, max(0, end - time.perf_counter())))
+        cpu_seconds = time.process_time() - cpu_start
+    finally:
+        button.close()
+    return _stats(sink, fps, cpu_seconds)
+
+
+def run(seconds, fps, dither, only=None):
+    results = {}
+    for name, setup in WORKLOADS.items():
+        if only and name not in only:
+            continue
+        results[name] = run_workload(setup, seconds, fps, dither)
+    for name, (base, storm) in STORMS.items():
+        if only and name not in only:
+            continue
+        results[name] = run_workload(WORKLOADS[base], seconds, fps, dither, storm=storm)
+    return {
+        "benchmark": "animation",
+        "version": rgb.__version__,
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "fps_target": fps,
+        "seconds": seconds,
+        "dither": dither,
+        "results": results,
+    }
+
+
+def compare(baseline, current):
+    print(f"{'workload':<22}{'metric':<18}{'baseline':>10}{'current':>10}{'change':>9}")
+    for name, metrics in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for metric in ("fps", "cpu_ms_per_frame", "jitter_ms", "max_late_ms"):
+            before, after = old[metric], metrics[metric]
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+            print(f"{name:<22}{metric:<18}{before:>10.3f}{after:>10.3f}{change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LED animation render thread.')
+    parser.add_argument('--seconds', type=float, default=5, help='Measured time per workload')
+    parser.add_argument('--fps', type=int, default=32, help='Target frame rate')
+    parser.add_argument('--dither', action='store_true', help='Enable temporal dithering')
+    parser.add_argument('--only', nargs='*', help='Workloads to run (default all)')
+    parser.add_argument('--json', dest='json_path', help='Write results to this file')
+    parser.add_argument('--compare', help='Baseline results file to compare against')
+    args = parser.parse_args()
+
+    report = run(args.seconds, args.fps, args.dither, args.only)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
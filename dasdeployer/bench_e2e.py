@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+"""
+End to end latency benchmark.
+
+Runs the real `dasdeployer.main` against gpiozero's mock pins, the real LCD
+driver on a fake I2C bus, the LED render thread into a `RecordingPixelSink`,
+a fake keyboard controller, and one local HTTP server that stands in for
+both the GitHub Actions and CircleCI APIs. Then it drives the inputs the
+way an operator would and measures:
+
+* project switch to first status: green pressed on the project menu until
+  the selected project's status is on the LCD
+* toggle to keys: toggle up until "Turn Keys" is on the LCD (includes the
+  keyboard form for Prod)
+* key turn to armed: second key turned until the deploy question is shown
+* button to dispatch: big button pressed until the fake API gets the dispatch
+* button to confirmed: big button pressed until the build number is shown
+* status to LCD / status to LED: the fake API finishing the run until the
+  LCD shows the result and the ring goes green
+
+dasdeployer keeps its hardware in module globals and `main` never returns,
+so every run is its own worker process, which prints its samples as JSON
+on the last line of its output. Save the report from two versions and use
+--compare to diff them.
+
+Example: ./bench_e2e.py --iterations 5 --json before.json
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import queue
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+BACKENDS = ("gha", "circleci")
+METRICS = (
+    "project_switch_ms",
+    "toggle_to_keys_ms",
+    "key_to_armed_ms",
+    "button_to_dispatch_ms",
+    "button_to_confirmed_ms",
+    "status_to_lcd_ms",
+    "status_to_led_ms",
+)
+_SHA = "0123456789abcdef0123456789abcdef01234567"
+_REPO = "das/deployer"
+_WAIT_TIMEOUT = 60
+
+
+# Fake CI server
+
+class FakeCI:
+    """Just enough of the GitHub and CircleCI APIs for the deployer, on one port.
+
+    Runs start out in progress and stay that way until `complete` is called.
+    Dispatches are stamped with `time.perf_counter` as they arrive, which
+    the worker shares with the server since they're in the same process.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.dispatched = []
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeCIHandler)
+        self.server.daemon_threads = True
+        self.server.ci = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.reset_at = int(time.time()) + 3600
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-ci", daemon=True).start()
+
+    def dispatch(self, backend, workflow=None, ref=None):
+        with self.lock:
+            number = len(self.runs) + 1
+            run = {
+                "backend": backend,
+                "id": number if backend == "gha" else str(uuid.uuid4()),
+                "number": number,
+                "workflow": workflow,
+                "ref": ref,
+                "done": False,
+            }
+            self.runs[run["id"]] = run
+            self.dispatched.append(time.perf_counter())
+        return run
+
+    def complete(self):
+        """Finish the newest run and return when it happened."""
+        with self.lock:
+            run = self.runs[max(self.runs, key=lambda key: self.runs[key]["number"])]
+            run["done"] = True
+            return time.perf_counter()
+
+    def gha_run(self, run):
+        return {
+            "id": run["id"],
+            "run_number": run["number"],
+            "event": "workflow_dispatch",
+            "head_sha": _SHA,
+            "head_branch": run["ref"],
+            "status": "completed" if run["done"] else "in_progress",
+            "conclusion": "success" if run["done"] else None,
+            "url": f"{self.url}/repos/{_REPO}/actions/runs/{run['id']}",
+        }
+
+    def gha_graphql_run(self, run):
+        return {
+            "id": f"WFR_{run['id']}",
+            "databaseId": run["id"],
+            "runNumber": run["number"],
+            "checkSuite": {
+                "status": "COMPLETED" if run["done"] else "IN_PROGRESS",
+                "conclusion": "SUCCESS" if run["done"] else None,
+            },
+        }
+
+
+class _FakeCIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    routes = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = b"" if body is None else json.dumps(body).encode()
+        ci = self.server.ci
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        # PyGithub keeps the quota from these, which feeds the rate limit budget
+        self.send_header("X-RateLimit-Limit", "5000")
+        self.send_header("X-RateLimit-Remaining", str(max(0, 5000 - ci.requests)))
+        self.send_header("X-RateLimit-Reset", str(ci.reset_at))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        ci = self.server.ci
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"null") if length else None
+        path = urlsplit(self.path).path
+        with ci.lock:
+            ci.requests += 1
+        if ci.latency:
+            time.sleep(ci.latency)
+        for (route_method, pattern, handler) in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                (status, reply) = handler(ci, body, *match.groups())
+                self._reply(status, reply)
+                return
+        self._reply(404, {"message": "Not Found"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+def _route(method, pattern):
+    def register(handler):
+        _FakeCIHandler.routes.append((method, pattern, handler))
+        return handler
+    return register
+
+
+@_route("GET", rf"/repos/{_REPO}")
+def _get_repo(ci, body):
+    return (200, {"id": 1, "name": "deployer", "full_name": _REPO, "url": f"{ci.url}/repos/{_REPO}"})
+
+
+@_route("GET", rf"/repos/{_REPO}/actions/workflows/([^/]+)")
+def _get_workflow(ci, body, workflow):
+    return (200, {
+        "id": workflow,
+        "name": f"deploy {workflow}",
+        "path": f".github/workflows/{workflow}",
+        "state": "active",
+        "node_id": f"WF_{workflow}",
+        "url": f"{ci.url}/repos/{_REPO}/actions/workflows/{workflow}",
+    })
+
+
+@_route("GET", rf"/repos/{_REPO}/branches/([^/]+)")
+def _get_branch(ci, body, branch):
+    return (200, {"name": branch, "commit": {"sha": _SHA, "url": f"{ci.url}/repos/{_REPO}/commits/{_SHA}"}})
+
+
+@_route("GET", rf"/repos/{_REPO}/actions/workflows/([^/]+)/runs")
+def _get_runs(ci, body, workflow):
+    with ci.lock:
+        runs = [ci.gha_run(run) for run in ci.runs.values() if run["workflow"] == workflow]
+    return (200, {"total_count": len(runs), "workflow_runs": runs})
+
+
+@_route("POST", rf"/repos/{_REPO}/actions/workflows/([^/]+)/dispatches")
+def _create_dispatch(ci, body, workflow):
+    ci.dispatch("gha", workflow, body["ref"])
+    return (204, None)
+
+
+@_route("GET", rf"/repos/{_REPO}/actions/runs/(\d+)")
+def _get_workflow_run(ci, body, run_id):
+    with ci.lock:
+        run = ci.runs.get(int(run_id))
+        return (404, {"message": "Not Found"}) if run is None else (200, ci.gha_run(run))
+
+
+@_route("POST", r"/graphql")
+def _graphql(ci, body):
+    # Only the newest runs of workflows, which is all the GHA poller asks for
+    workflows = []
+    with ci.lock:
+        for node_id in body["variables"].get("workflowIds", []):
+            runs = [run for run in ci.runs.values() if run["workflow"] == node_id[len("WF_"):]]
+            runs.sort(key=lambda run: run["number"], reverse=True)
+            workflows.append({"id": node_id, "runs": {"nodes": [ci.gha_graphql_run(run) for run in runs[:5]]}})
+        remaining = max(0, 5000 - ci.requests)
+    reset_at = datetime.fromtimestamp(ci.reset_at, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return (200, {"data": {
+        "rateLimit": {"cost": 1, "remaining": remaining, "limit": 5000, "resetAt": reset_at},
+        "workflows": workflows,
+    }})
+
+
+@_route("POST", r"/api/v2/project/[^/]+/[^/]+/[^/]+/pipeline")
+def _trigger_pipeline(ci, body):
+    run = ci.dispatch("circleci")
+    return (201, {"id": run["id"], "number": run["number"], "state": "created"})
+
+
+@_route("GET", r"/api/v2/pipeline/([^/]+)/workflow")
+def _get_pipeline_workflow(ci, body, pipeline_id):
+    with ci.lock:
+        run = ci.runs.get(pipeline_id)
+        if run is None:
+            return (404, {"message": "Not Found"})
+        status = "success" if run["done"] else "running"
+    return (200, {"items": [{"id": pipeline_id, "name": "deploy", "status": status}], "next_page_token": None})
+
+
+# Fake hardware
+
+class FakeI2CBus:
+    """Takes the bytes the LCD driver writes, the driver still does all its waits."""
+
+    def write_byte(self, address, value):
+        pass
+
+
+class FakeKeyboard:
+    """Serial port stand in for the keyboard controller, fills in every prompt."""
+
+    def __init__(self, value="1", typing=0.0):
+        self.value = value
+        self.typing = typing
+        self.is_open = False
+        self._lines = queue.SimpleQueue()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        pass
+
+    def readline(self):
+        try:
+            return self._lines.get(timeout=0.5)
+        except queue.Empty:
+            return b""
+
+    def write(self, data):
+        message = json.loads(data)
+        if message.get("state") == "form":
+            reply = {"values": {field["name"]: self.value for field in message["fields"]}}
+        elif message.get("state") == "enabled":
+            reply = {"value": self.value}
+        else:
+            return len(data)
+        time.sleep(self.typing)
+        self._lines.put((json.dumps(reply) + "\n").encode())
+        return len(data)
+
+
+# Worker, one run of the deployer
+
+@dataclass
+class BenchEnvironment:
+    prompted_parms: list = field(default_factory=list)
+
+
+@dataclass
+class BenchParameter:
+    paramater_name: str
+    allowed_chars: str
+    display_name: str
+
+
+@dataclass
+class BenchConfig:
+    name: str
+    pipeline_class: str
+    github_url: str
+    github_pat: str = "bench-github-token"
+    github_repo: str = _REPO
+    environments: dict = field(default_factory=dict)
+    gha_workflows: dict = field(default_factory=dict)
+    circle_url: str = ""
+    circle_pat: str = "bench-circle-token"
+    circle_org: str = "das"
+    circle_project: str = "deployer"
+
+
+def _settings(ci, control_socket):
+    environments = {
+        "Dev": BenchEnvironment(),
+        "Test": BenchEnvironment(),
+        "Stage": BenchEnvironment(),
+        "Prod": BenchEnvironment([BenchParameter("version", "0123456789", "Version")]),
+    }
+    settings = types.ModuleType("local_settings")
+    settings.PromptedParameter = BenchParameter
+    settings.DAS_CONFIGS = [
+        BenchConfig(
+            name="Bench GHA",
+            pipeline_class="gha.GhaWorkflows",
+            github_url=ci.url,
+            environments=environments,
+            gha_workflows={env: f"{env.lower()}.yml" for env in environments},
+        ),
+        BenchConfig(
+            name="Bench CircleCI",
+            pipeline_class="circleci.CircleCI",
+            github_url=ci.url,
+            environments=environments,
+            circle_url=f"{ci.url}/api",
+        ),
+    ]
+    settings.CONTROL_SOCKET = control_socket
+    settings.METRICS_PORT = None
+    settings.LOG_LEVEL = "WARNING"
+    # Never dim the display part way through a measurement
+    settings.IDLE_TIMEOUT = 24 * 3600
+    return settings
+
+
+def armed_text(environment):
+    """What the LCD says once the keys have been turned for `environment`."""
+    return "Deploy to Prod?" if environment == "Prod" else f"to {environment}?"
+
+
+class Rig:
+    """The real deployer on fake hardware, driven through its input pins.
+
+    Only one per process, `dasdeployer` is imported with `settings` in place
+    of local_settings.
+    """
+
+    def __init__(self, settings, poll_interval=None):
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+        # Before dasdeployer makes its boards
+        Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+        sys.modules["local_settings"] = settings
+
+        import dasdeployer
+        import rgb
+        from lcd import LCD_HD44780_I2C
+        from pixelsink import RecordingPixelSink
+        from serialsession import SerialSession
+
+        self.dd = dasdeployer
+        self.lcd_log = []
+        self.sink = RecordingPixelSink(rgb._NUM_PIXELS, capacity=8192)
+
+        rig = self
+
+        class RecordingLCD(LCD_HD44780_I2C):
+            def __init__(self):
+                super(RecordingLCD, self).__init__(bus=FakeI2CBus())
+
+            def _write_message(self, message):
+                super(RecordingLCD, self)._write_message(message)
+                # Stamped once the whole message is on the glass
+                rig.lcd_log.append((time.perf_counter(), message))
+
+        dasdeployer.LCD_HD44780_I2C = RecordingLCD
+        dasdeployer.RGBButton = functools.partial(rgb.RGBButton, sink=self.sink)
+        dasdeployer.keyboard = SerialSession("bench", serial=FakeKeyboard())
+        dasdeployer.thermal._read_temperature = lambda: 45.0
+        if poll_interval is not None:
+            dasdeployer.POLL_INTERVAL = poll_interval
+
+    def start(self):
+        dd = self.dd
+        threading.Thread(target=dd.main, name="dasdeployer", daemon=True).start()
+        # Inputs are bound once the hardware is up and any project menu is showing
+        self.wait(lambda: dd.big_button.when_pressed is not None, "the inputs")
+
+    def wait_lcd(self, since, *text, unless=()):
+        """Time the first LCD message after `since` containing all of `text`."""
+        deadline = time.perf_counter() + _WAIT_TIMEOUT
+        seen = 0
+        while time.perf_counter() < deadline:
+            log = self.lcd_log
+            for (stamp, message) in log[seen:]:
+                if (
+                    stamp >= since
+                    and all(part in message for part in text)
+                    and not any(part in message for part in unless)
+                ):
+                    return stamp
+            seen = len(log)
+            time.sleep(0.001)
+        last = self.lcd_log[-1][1] if self.lcd_log else None
+        raise TimeoutError(f"LCD never showed {text!r}, last message was {last!r}")
+
+    def wait_ring_green(self, since):
+        """Time the first frame after `since` with a pure green pixel on the ring."""
+        import rgb
+
+        deadline = time.perf_counter() + _WAIT_TIMEOUT
+        while time.perf_counter() < deadline:
+            for (stamp, frame) in self.sink.recorded():
+                if stamp >= since and any(
+                    g and not r and not b for (r, g, b) in frame[rgb._RING_RANGE]
+                ):
+                    return stamp
+            time.sleep(0.002)
+        raise TimeoutError("Ring never went green")
+
+    def wait(self, predicate, what):
+        deadline = time.perf_counter() + _WAIT_TIMEOUT
+        while time.perf_counter() < deadline:
+            if predicate():
+                return time.perf_counter()
+            time.sleep(0.001)
+        raise TimeoutError(f"Timed out waiting for {what}")
+
+    def press(self, button):
+        button.pin.drive_low()
+        time.sleep(0.05)
+        button.pin.drive_high()
+
+    def toggle(self, environment):
+        return getattr(self.dd.toggle, environment.lower())
+
+    def turn_keys(self):
+        """Turn both keys, returning when the second one went."""
+        keys = self.dd.keys
+        keys.one.pin.drive_low()
+        turned = time.perf_counter()
+        keys.two.pin.drive_low()
+        keys.one.pin.drive_high()
+        keys.two.pin.drive_high()
+        return turned
+
+    def select_project(self, index):
+        """Pick project `index` from the menu, returning when green was pressed and
+        when its status was on the LCD."""
+        dd = self.dd
+        name = dd.DAS_CONFIGS[index].name
+        self.wait_lcd(0, "Select a project")
+        for _ in range(index):
+            since = time.perf_counter()
+            self.press(dd.switch.yellow)
+            self.wait_lcd(since, "Select a project", name)
+        started = time.perf_counter()
+        self.press(dd.switch.green)
+        return (started, self.wait_lcd(started, name, unless=("Select", "loading")))
+
+
+def measure_deploy(rig, ci, environment, samples):
+    def record(metric, started, ended):
+        samples[metric].append((ended - started) * 1000)
+
+    toggle = rig.toggle(environment)
+    started = time.perf_counter()
+    toggle.pin.drive_high()
+    record("toggle_to_keys_ms", started, rig.wait_lcd(started, "Turn Keys"))
+
+    started = rig.turn_keys()
+    record("key_to_armed_ms", started, rig.wait_lcd(started, armed_text(environment)))
+
+    dispatched = len(ci.dispatched)
+    started = time.perf_counter()
+    rig.press(rig.dd.big_button)
+    rig.wait(lambda: len(ci.dispatched) > dispatched, "the dispatch")
+    record("button_to_dispatch_ms", started, ci.dispatched[dispatched])
+    record("button_to_confirmed_ms", started, rig.wait_lcd(started, f"triggered to {environment}"))
+
+    # Let the poll see the run going before finishing it, the progress
+    # messages during the dispatch don't have the build number
+    rig.wait_lcd(started, "Build", f"Deploying to {environment}")
+    completed = ci.complete()
+    record("status_to_lcd_ms", completed, rig.wait_lcd(completed, f"Deployment to {environment}"))
+    record("status_to_led_ms", completed, rig.wait_ring_green(completed))
+
+    since = time.perf_counter()
+    toggle.pin.drive_low()
+    rig.wait_lcd(since, rig.dd.DAS_CONFIGS[rig.dd.select_project_index].name)
+
+
+def _worker_main(args):
+    ci = FakeCI(args.api_latency)
+    ci.start()
+    socket_dir = tempfile.mkdtemp(prefix="bench-e2e-")
+    rig = Rig(_settings(ci, os.path.join(socket_dir, "control.sock")), args.poll_interval)
+    samples = {metric: [] for metric in METRICS}
+    rig.start()
+    (started, ended) = rig.select_project(BACKENDS.index(args.worker))
+    samples["project_switch_ms"].append((ended - started) * 1000)
+    for _ in range(args.iterations):
+        measure_deploy(rig, ci, args.environment, samples)
+    # Logs go to stdout too, so the result is always the last line
+    print(json.dumps({
+        "version": rig.dd.__version__,
+        "samples": samples,
+        "api_requests": ci.requests,
+        "lcd_messages": len(rig.lcd_log),
+    }))
+    sys.stdout.flush()
+    # gpiozero and the deployer leave threads behind that aren't worth unwinding
+    os._exit(0)
+
+
+# Parent, runs the workers and reports
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def _stats(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered),
+        "p50_ms": _percentile(ordered, 0.5),
+        "p95_ms": _percentile(ordered, 0.95),
+        "max_ms": ordered[-1],
+    }
+
+
+def run_worker(backend, args):
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--worker", backend,
+        "--iterations", str(args.iterations),
+        "--environment", args.environment,
+        "--poll-interval", str(args.poll_interval),
+        "--api-latency", str(args.api_latency),
+    ]
+    output = subprocess.run(
+        command,
+        check=True,
+        stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        timeout=args.iterations * _WAIT_TIMEOUT * 4 + _WAIT_TIMEOUT,
+    ).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def run(args):
+    results = {}
+    version = None
+    for backend in args.backends:
+        samples = {metric: [] for metric in METRICS}
+        requests = 0
+        for _ in range(args.runs):
+            result = run_worker(backend, args)
+            for metric in METRICS:
+                samples[metric].extend(result["samples"][metric])
+            requests += result["api_requests"]
+            version = result["version"]
+        results[backend] = {metric: _stats(values) for (metric, values) in samples.items()}
+        results[backend]["api_requests"] = requests
+    return {
+        "benchmark": "e2e",
+        "version": version,
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "environment": args.environment,
+        "runs": args.runs,
+        "iterations": args.iterations,
+        "poll_interval": args.poll_interval,
+        "api_latency": args.api_latency,
+        "results": results,
+    }
+
+
+def compare(baseline, current):
+    print(f"{'backend':<10}{'metric':<24}{'stat':<8}{'baseline':>10}{'current':>10}{'change':>9}")
+    for backend, metrics in current["results"].items():
+        old = baseline["results"].get(backend)
+        if old is None:
+            continue
+        for metric in METRICS:
+            if not old.get(metric, {}).get("count") or not metrics[metric].get("count"):
+                continue
+            for stat in ("p50_ms", "p95_ms"):
+                before, after = old[metric][stat], metrics[metric][stat]
+                change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+                print(f"{backend:<10}{metric:<24}{stat:<8}{before:>10.1f}{after:>10.1f}{change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the deployer end to end against fake hardware and CI.')
+    parser.add_argument('--backends', nargs='*', choices=BACKENDS, default=list(BACKENDS), help='Backends to run (default all)')
+    parser.add_argument('--environment', choices=('Dev', 'Prod'), default='Dev', help='Environment to deploy, Prod adds the keyboard form')
+    parser.add_argument('--runs', type=int, default=3, help='Worker processes per backend, one project switch each')
+    parser.add_argument('--iterations', type=int, default=3, help='Deploys per worker')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between status polls')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Seconds the fake API takes to answer')
+    parser.add_argument('--json', dest='json_path', help='Write results to this file')
+    parser.add_argument('--compare', help='Baseline results file to compare against')
+    parser.add_argument('--worker', choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        _worker_main(args)
+        return
+
+    report = run(args)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+`dasdeployer.breaker`
+====================================================
+
+Circuit breakers for the CI services the poll threads talk to.
+
+Every project polling the same service shares a breaker. After a few
+failures in a row the breaker opens and nobody polls that service until
+the cooldown is up. Then a single poll is let through to see if it's back:
+if that works the breaker closes again, if it doesn't the cooldown doubles.
+An outage on one service then costs it a request every few minutes rather
+than one per project per poll, and projects on other services carry on.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable
+
+import metrics
+
+# Failures in a row before the breaker opens
+_THRESHOLD = 3
+_COOLDOWN = 30.0
+_MAX_COOLDOWN = 600.0
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        service: str,
+        threshold: int = _THRESHOLD,
+        cooldown: float = _COOLDOWN,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.service = service
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._open_for = cooldown
+        # Whether the poll let through to test the service is still out
+        self._probing = False
+        self._open_gauge = metrics.gauge(
+            "dasdeployer_circuit_open",
+            "1 while polls to a CI service are held off after repeated failures",
+            service=service,
+        )
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a poll may go ahead, closed breakers let everything through."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or self._clock() < self.opened_at + self._open_for:
+                return False
+            self._probing = True
+        log.info("Trying %s again", self.service)
+        return True
+
+    def success(self) -> None:
+        with self._lock:
+            was_open = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+            self._open_for = self.cooldown
+            self._probing = False
+        if was_open:
+            log.info("%s is back, polling again", self.service)
+            self._open_gauge.set(0)
+
+    def release(self) -> None:
+        """Give up the poll let through without saying whether the service is back.
+
+        For polls that were turned away by a rate limit, which says nothing
+        either way. Another poll can then try once the breaker's own cooldown
+        is up, which isn't extended.
+        """
+        with self._lock:
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing:
+                # Still down, leave it alone for longer this time
+                self._probing = False
+                self._open_for = min(self._open_for * 2, _MAX_COOLDOWN)
+            elif self.opened_at is not None or self.failures < self.threshold:
+                return
+            self.opened_at = self._clock()
+            open_for = self._open_for
+        log.warning(
+            "%s failed %d times in a row, holding off for %.0fs",
+            self.service, self.failures, open_for,
+        )
+        self._open_gauge.set(1)
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def for_service(service: str) -> CircuitBreaker:
+    """Get the breaker for `service`, every project polling it shares it."""
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(service)
+        return _breakers[service]
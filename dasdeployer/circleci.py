@@ -1,22 +1,30 @@
 # from azure.devops.connection import Connection
 # from msrest.authentication import BasicAuthentication
 # from azure.devops.released.build import Build, BuildClient, BuildDefinition
+from __future__ import annotations
 
 from pycircleci.api import Api
 
 # import threading
-from github import Github
 # from operator import attrgetter
-from dataclasses import dataclass
-from typing import cast, Any, TYPE_CHECKING
+from dataclasses import dataclass, replace
+import logging
+from typing import cast, Any, Callable, TYPE_CHECKING
 # from local_settings import CircleCIConfig
-from pipelines import QueryResult, Pipelines, PollStatusThread, BuildState, QueryResultStatus
-import time
+from logs import redact
+import breaker
+import ratelimit
+import tracing
+from pipelines import api_calls, QueryResult, Pipelines, PollStatusThread, BuildState, QueryResultStatus, DeployStage
 
-now = 0.0
+# Paginated listings only count as the one call
+_api_calls = api_calls("circleci")
+
+log = logging.getLogger(__name__)
 
 if TYPE_CHECKING:
     from local_settings import CircleCIConfig
+    from github import Github
 
 # class QueryResultStatus():
 #     CHECKING = "Checking"
@@ -42,7 +50,7 @@ if TYPE_CHECKING:
 #         self.branch_tst = None
 #         self.branch_stage = None
 #         self.branch_prod = None
-@dataclass
+@dataclass(frozen=True)
 class CircleBuildState(BuildState):
     pipeline_id: str
 
@@ -71,8 +79,14 @@ class CircleCI(Pipelines):
     #         self._poll_thread.start()
     #     return self._poll_thread._last_result
 
-    def approve(self, approve_env: str, params: dict[str, str]) -> CircleBuildState | None:
-        print("Approve env:" + approve_env)
+    def approve(
+        self,
+        approve_env: str,
+        params: dict[str, str],
+        progress: Callable[[DeployStage], None] | None = None,
+        timeout: float | None = None,
+    ) -> CircleBuildState | None:
+        log.info("Approve env: %s", approve_env)
         # Get Release Client
         # connection = Connection(
         #     base_url=self.config.ado_org_url,
@@ -104,26 +118,28 @@ class CircleCI(Pipelines):
         #     build=build,
         #     project=self.config.ado_project
         # )
-        print(f"username={self.config.circle_org} project={self.config.circle_project} branch={source_branch} params={params} bool_params={bool(params)}")
-        build_result: dict[str, str] = self.connection.trigger_pipeline(
-            username=self.config.circle_org,
-            project=self.config.circle_project,
-            branch=source_branch,
-            params=params,
+        log.info(
+            "Triggering %s/%s on %s with %s",
+            self.config.circle_org, self.config.circle_project, source_branch, redact(params),
         )
+        _api_calls.inc()
+        with tracing.span("trigger_pipeline", "deploy"):
+            build_result: dict[str, str] = self.connection.trigger_pipeline(
+                username=self.config.circle_org,
+                project=self.config.circle_project,
+                branch=source_branch,
+                params=params,
+            )
+        if progress:
+            # The pipeline comes straight back from the trigger call
+            progress(DeployStage.DISPATCHED)
+            progress(DeployStage.RUN_FOUND)
         state = CircleBuildState(
             number=int(build_result['number']),
             pipeline_id=build_result['id'],
             result=QueryResultStatus.RUNNING,
         )
-        if approve_env == 'Dev':
-            self.last_result.build_dev = state
-        elif approve_env == 'Test':
-            self.last_result.build_tst = state
-        elif approve_env == 'Stage':
-            self.last_result.build_stage = state
-        elif approve_env == 'Prod':
-            self.last_result.build_prod = state
+        self._set_build(approve_env, state)
 
         return state
 
@@ -131,13 +147,14 @@ class CircleCI(Pipelines):
 class CirclePollStatusThread(PollStatusThread):
     config: "CircleCIConfig"
     _connection: Api
+    backend = "circleci"
     def __init__(
         self,
         config: "CircleCIConfig",
         github_conn: Github,
         last_result: QueryResult,
         connection: Api,
-        interval: int = 10
+        interval: float = 10
     ):
         super().__init__(
             config=config,
@@ -173,144 +190,147 @@ class CirclePollStatusThread(PollStatusThread):
     #         raise RuntimeError(
     #             "PollStatusThread failed to die within %d seconds" % timeout)
 
-    def run(self) -> None:
-        while True:
-            # Wait a bit then poll the server again
-            # result = QueryResult()
-            # github = Github(
-            #     base_url=self.config.github_url,
-            #     login_or_token=self.config.github_pat
+    def _rate_budget(self) -> ratelimit.RateBudget:
+        # CircleCI doesn't send the quota, the budget only hears about 429s
+        return ratelimit.for_token("circleci", self.config.circle_pat)
+
+    def _circuit_breaker(self) -> breaker.CircuitBreaker:
+        return breaker.for_service(self.config.circle_url or "https://circleci.com/api")
+
+    def poll_once(self) -> None:
+        # Wait a bit then poll the server again
+        # result = QueryResult()
+        # github = Github(
+        #     base_url=self.config.github_url,
+        #     login_or_token=self.config.github_pat
+        # )
+        # repo = self._github_conn.get_repo(self.config.github_repo)
+        # branches = repo.get_branches()
+
+        # dev_branches = [branch for branch in branches if branch.name.startswith('dev/')]
+        # dev_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
+        # dev_branch = dev_branches[0].name if dev_branches else None
+
+        # tst_branches = [branch for branch in branches if branch.name.startswith('tst/')]
+        # tst_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
+        # tst_branch = tst_branches[0].name if tst_branches else None
+
+        # main_branches = [branch for branch in branches if branch.name == 'main']
+        # main_branch = main_branches[0].name if main_branches else None
+        # for e, value in self.config.circle_workflows.items():
+        for e, value in self.config.environments.items():
+            # if value:
+            if e == 'Dev':
+                self._last_result.enable_dev = bool(value)
+                self._last_result.branch_dev = 'main'
+                state = cast(CircleBuildState, self._last_result.build_dev)
+                # result.deploying_dev = deploying
+                # result.build_dev = buildDef.latest_build
+
+            elif e == 'Test':
+                self._last_result.enable_tst = bool(value)
+                self._last_result.branch_tst = 'main'
+                state = cast(CircleBuildState, self._last_result.build_tst)
+                # result.deploying_tst = deploying
+                # result.build_tst = buildDef.latest_build
+            elif e == 'Stage':
+                self._last_result.enable_stage = bool(value)
+                self._last_result.branch_stage = 'main'
+                state = cast(CircleBuildState, self._last_result.build_stage)
+                # result.deploying_stage = deploying
+                # result.build_stage = buildDef.latest_build
+            elif e == 'Prod':
+                self._last_result.enable_prod = bool(value)
+                self._last_result.branch_prod = 'main'
+                state = cast(CircleBuildState, self._last_result.build_prod)
+                # result.deploying_prod = deploying
+                # result.build_prod = buildDef.latest_build
+            # buildDef: BuildDefinition = self._build_client.get_definition(
+            #     self.config.ado_project,
+            #     self.config.ado_pipeline_ids[e],
+            #     include_latest_builds=True
             # )
-            # repo = self._github_conn.get_repo(self.config.github_repo)
-            # branches = repo.get_branches()
-
-            # dev_branches = [branch for branch in branches if branch.name.startswith('dev/')]
-            # dev_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
-            # dev_branch = dev_branches[0].name if dev_branches else None
-
-            # tst_branches = [branch for branch in branches if branch.name.startswith('tst/')]
-            # tst_branches.sort(key=attrgetter('commit.commit.author.date'), reverse=True)
-            # tst_branch = tst_branches[0].name if tst_branches else None
-
-            # main_branches = [branch for branch in branches if branch.name == 'main']
-            # main_branch = main_branches[0].name if main_branches else None
-            global now
-            new_now = time.time()
-            print(f"running, last run {new_now - now} seconds ago")
-            now = new_now
-            # for e, value in self.config.circle_workflows.items():
-            for e, value in self.config.environments.items():
-                # if value:
-                if e == 'Dev':
-                    self._last_result.enable_dev = bool(value)
-                    self._last_result.branch_dev = 'main'
-                    state = cast(CircleBuildState, self._last_result.build_dev)
-                    # result.deploying_dev = deploying
-                    # result.build_dev = buildDef.latest_build
-
-                elif e == 'Test':
-                    self._last_result.enable_tst = bool(value)
-                    self._last_result.branch_tst = 'main'
-                    state = cast(CircleBuildState, self._last_result.build_tst)
-                    # result.deploying_tst = deploying
-                    # result.build_tst = buildDef.latest_build
-                elif e == 'Stage':
-                    self._last_result.enable_stage = bool(value)
-                    self._last_result.branch_stage = 'main'
-                    state = cast(CircleBuildState, self._last_result.build_stage)
-                    # result.deploying_stage = deploying
-                    # result.build_stage = buildDef.latest_build
-                elif e == 'Prod':
-                    self._last_result.enable_prod = bool(value)
-                    self._last_result.branch_prod = 'main'
-                    state = cast(CircleBuildState, self._last_result.build_prod)
-                    # result.deploying_prod = deploying
-                    # result.build_prod = buildDef.latest_build
-                # buildDef: BuildDefinition = self._build_client.get_definition(
-                #     self.config.ado_project,
-                #     self.config.ado_pipeline_ids[e],
-                #     include_latest_builds=True
-                # )
-                # if buildDef.latest_completed_build.id == buildDef.latest_build.id:
-                #     # build is finished
-                #     deploying = False
-                # else:
-                #     # A build is in progress
-                #     deploying = True
-
-                # Get build id (workflow id?) from last_result (store it when approved)
-                if state:
-                    workflows: list[dict[str, Any]] = self._connection.get_pipeline_workflow(
-                        pipeline_id=state.pipeline_id,
-                        paginate=True
-                    )
-                    states = set([w['status'] for w in workflows])
-
-                    if len(states) == 1 and 'success' in states:
-                        deploying = False
-                        state.result = QueryResultStatus.SUCCEEDED
-                    elif 'failed' in states or 'failing' in states or 'error' in states or 'unauthorized' in states:
-                        deploying = False
-                        state.result = QueryResultStatus.FAILED
-                    elif 'canceled' in states or 'not_run' in states:
-                        deploying = False
-                        state.result = QueryResultStatus.CANCELED
-                    elif 'running' in states or 'on_hold' in states:
-                        deploying = True
-                        state.result = QueryResultStatus.RUNNING
-                else:
+            # if buildDef.latest_completed_build.id == buildDef.latest_build.id:
+            #     # build is finished
+            #     deploying = False
+            # else:
+            #     # A build is in progress
+            #     deploying = True
+
+            # Get build id (workflow id?) from last_result (store it when approved)
+            # Finished pipelines don't change, short of somebody rerunning a
+            # workflow, which only a refresh picks up
+            if state and (self.refreshing or not state.finished):
+                _api_calls.inc()
+                workflows: list[dict[str, Any]] = self._connection.get_pipeline_workflow(
+                    pipeline_id=state.pipeline_id,
+                    paginate=True
+                )
+                states = set([w['status'] for w in workflows])
+
+                if len(states) == 1 and 'success' in states:
                     deploying = False
-
-                # use it to query the status
-                # set deploying and build based on result of that query
-
-                if e == 'Dev':
-                    # result.enable_dev = bool(dev_branch)
-                    # result.branch_dev = dev_branch
-                    self._last_result.deploying_dev = deploying
-                    # result.build_dev = buildDef.latest_build
-
-                elif e == 'Test':
-                    # result.enable_tst = bool(tst_branch)
-                    # result.branch_tst = tst_branch
-                    self._last_result.deploying_tst = deploying
-                    # result.build_tst = buildDef.latest_build
-                elif e == 'Stage':
-                    # result.enable_stage = bool(main_branch)
-                    # result.branch_stage = main_branch
-                    self._last_result.deploying_stage = deploying
-                    # result.build_stage = buildDef.latest_build
-                elif e == 'Prod':
-                    # result.enable_prod = True
-                    # result.branch_prod = None
-                    self._last_result.deploying_prod = deploying
-                    # result.build_prod = buildDef.latest_build
-
-            # if (
-            #     # Check if any values have changed to trigger saving a new result
-            #     # the Build objects are not checked because they'll always be different
-            #     # and we don't care of the Build changes unless one of these values
-            #     # has changed
-            #     self._last_result.enable_dev != result.enable_dev or
-            #     self._last_result.enable_tst != result.enable_tst or
-            #     self._last_result.enable_stage != result.enable_stage or
-            #     self._last_result.enable_prod != result.enable_prod or
-            #     self._last_result.deploying_dev != result.deploying_dev or
-            #     self._last_result.deploying_tst != result.deploying_tst or
-            #     self._last_result.deploying_stage != result.deploying_stage or
-            #     self._last_result.deploying_prod != result.deploying_prod or
-            #     self._last_result.branch_dev != result.branch_dev or
-            #     self._last_result.branch_tst != result.branch_tst or
-            #     self._last_result.branch_stage != result.branch_stage or
-            #     self._last_result.branch_prod != result.branch_prod
-            # ):
-            #     # Something has changed
-            #     print("change")
-            #     self._last_result = result
-
-            # At the end of the thread execution, wait a bit and then poll again
-            if self.stoprequest.wait(self.delay):
-                break
+                    result = QueryResultStatus.SUCCEEDED
+                elif 'failed' in states or 'failing' in states or 'error' in states or 'unauthorized' in states:
+                    deploying = False
+                    result = QueryResultStatus.FAILED
+                elif 'canceled' in states or 'not_run' in states:
+                    deploying = False
+                    result = QueryResultStatus.CANCELED
+                else:
+                    # running, on_hold, or no workflows started yet
+                    deploying = True
+                    result = QueryResultStatus.RUNNING
+                self._replace_build(e, state, replace(state, result=result))
+            else:
+                deploying = False
+
+            # use it to query the status
+            # set deploying and build based on result of that query
+
+            if e == 'Dev':
+                # result.enable_dev = bool(dev_branch)
+                # result.branch_dev = dev_branch
+                self._last_result.deploying_dev = deploying
+                # result.build_dev = buildDef.latest_build
+
+            elif e == 'Test':
+                # result.enable_tst = bool(tst_branch)
+                # result.branch_tst = tst_branch
+                self._last_result.deploying_tst = deploying
+                # result.build_tst = buildDef.latest_build
+            elif e == 'Stage':
+                # result.enable_stage = bool(main_branch)
+                # result.branch_stage = main_branch
+                self._last_result.deploying_stage = deploying
+                # result.build_stage = buildDef.latest_build
+            elif e == 'Prod':
+                # result.enable_prod = True
+                # result.branch_prod = None
+                self._last_result.deploying_prod = deploying
+                # result.build_prod = buildDef.latest_build
+
+        # if (
+        #     # Check if any values have changed to trigger saving a new result
+        #     # the Build objects are not checked because they'll always be different
+        #     # and we don't care of the Build changes unless one of these values
+        #     # has changed
+        #     self._last_result.enable_dev != result.enable_dev or
+        #     self._last_result.enable_tst != result.enable_tst or
+        #     self._last_result.enable_stage != result.enable_stage or
+        #     self._last_result.enable_prod != result.enable_prod or
+        #     self._last_result.deploying_dev != result.deploying_dev or
+        #     self._last_result.deploying_tst != result.deploying_tst or
+        #     self._last_result.deploying_stage != result.deploying_stage or
+        #     self._last_result.deploying_prod != result.deploying_prod or
+        #     self._last_result.branch_dev != result.branch_dev or
+        #     self._last_result.branch_tst != result.branch_tst or
+        #     self._last_result.branch_stage != result.branch_stage or
+        #     self._last_result.branch_prod != result.branch_prod
+        # ):
+        #     # Something has changed
+        #     print("change")
+        #     self._last_result = result
 
 
 # def pipemain():
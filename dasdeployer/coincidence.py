@@ -0,0 +1,99 @@
+"""
+`dasdeployer.coincidence`
+====================================================
+
+Detects inputs that happen together, like the two deploy keys being
+turned at the same time.
+
+Call `press` straight from each gpiozero callback. Presses are stamped with
+`time.monotonic_ns` as they come in, so NTP adjusting the clock after boot
+can't make two turns look further apart (or closer) than they were, and
+all the state is behind one lock since the callbacks come in on different
+threads.
+
+The detector has to be armed, and disarms itself once it has matched, so
+one turn of the keys can only ever fire once. The spread between the first
+and last press of each match is kept so the window can be tuned.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+class CoincidenceDetector:
+    def __init__(
+        self,
+        channels: tuple[str, ...],
+        window: float = 1.0,
+        debounce: float = 0.05,
+        on_match: Optional[Callable[[float], None]] = None,
+        clock: Callable[[], int] = time.monotonic_ns,
+        history: int = 64,
+    ) -> None:
+        self.channels = channels
+        self.window_ns = int(window * 1e9)
+        self.debounce_ns = int(debounce * 1e9)
+        # Called with the spread in seconds, on the thread of the last press
+        self.on_match = on_match
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._armed = False
+        self._pressed: dict[str, int] = {}
+        self.matched = threading.Event()
+        self.spreads: deque = deque(maxlen=history)
+
+    @property
+    def armed(self) -> bool:
+        return self._armed
+
+    def arm(self) -> None:
+        with self._lock:
+            self._pressed.clear()
+            self._armed = True
+            self.matched.clear()
+
+    def disarm(self) -> None:
+        with self._lock:
+            self._pressed.clear()
+            self._armed = False
+
+    def press(self, channel: str) -> bool:
+        """Record a press on `channel` and return whether it completed a match."""
+        now = self._clock()
+        with self._lock:
+            if not self._armed:
+                return False
+            previous = self._pressed.get(channel)
+            if previous is not None and now - previous < self.debounce_ns:
+                return False
+            self._pressed[channel] = now
+            # Presses that have fallen out of the window don't count any more
+            self._pressed = {
+                name: pressed for (name, pressed) in self._pressed.items()
+                if now - pressed <= self.window_ns
+            }
+            if len(self._pressed) < len(self.channels):
+                return False
+            spread = (now - min(self._pressed.values())) / 1e9
+            self._pressed.clear()
+            self._armed = False
+            self.spreads.append(spread)
+        log.info("Coincidence on %s, %.0fms apart", ", ".join(self.channels), spread * 1000)
+        self.matched.set()
+        if self.on_match:
+            self.on_match(spread)
+        return True
+
+    def callback(self, channel: str) -> Callable[[], None]:
+        """Return a gpiozero callback that presses `channel`."""
+        def pressed() -> None:
+            self.press(channel)
+        return pressed
@@ -0,0 +1,121 @@
+"""
+`dasdeployer.control`
+====================================================
+
+Local control socket, so other processes on the Pi (writelcd.py, the boot
+scripts) can talk to the running deployer instead of opening the LCD
+themselves and fighting it for the I2C bus.
+
+Requests and replies are one JSON object per line on a unix socket, and a
+connection can send as many requests as it likes. Each request names a
+command, the rest of its keys are passed to that command's handler:
+
+    {"cmd": "message", "text": "Hello"}  ->  {"ok": true}
+
+Handlers run on the connection's thread, so they must only use things
+that are safe to touch from any thread.
+
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_SOCKET = '/tmp/dasdeployer.sock'
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[..., Optional[Dict[str, Any]]]
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    server: "_ControlSocketServer"
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.control.dispatch(line)
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+class _ControlSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, control: "ControlServer") -> None:
+        self.control = control
+        super(_ControlSocketServer, self).__init__(path, _ControlHandler)
+
+
+class ControlServer(threading.Thread):
+    def __init__(self, handlers: dict[str, Handler], path: str = DEFAULT_SOCKET) -> None:
+        super(ControlServer, self).__init__()
+        self.daemon = True
+        self.handlers = handlers
+        self.path = path
+        self._server: Optional[_ControlSocketServer] = None
+
+    def start(self) -> None:
+        if os.path.exists(self.path):
+            # Left behind by a deployer that didn't shut down cleanly
+            os.unlink(self.path)
+        self._server = _ControlSocketServer(self.path, self)
+        os.chmod(self.path, 0o660)
+        super(ControlServer, self).start()
+
+    def stop(self, timeout: float | None = 10) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        self.join(timeout)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def dispatch(self, line: bytes) -> dict[str, Any]:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("expected a JSON object")
+            command = request.pop("cmd")
+            handler = self.handlers[command]
+        except (ValueError, KeyError) as e:
+            return {"ok": False, "error": f"bad request: {e}"}
+        try:
+            reply = handler(**request) or {}
+        except Exception as e:
+            log.warning("Control command %s failed: %r", command, e)
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, **reply}
+
+    def run(self) -> None:
+        assert self._server is not None
+        self._server.serve_forever(poll_interval=0.5)
+
+
+def send_command(
+    command: str,
+    path: str = DEFAULT_SOCKET,
+    timeout: float = 2,
+    **args: Any,
+) -> dict[str, Any]:
+    """Send one command to the running deployer and return its reply.
+
+    Raises OSError (usually FileNotFoundError or ConnectionRefusedError)
+    if the deployer isn't running.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps({"cmd": command, **args}) + "\n").encode())
+        with sock.makefile('rb') as reply:
+            line = reply.readline()
+    if not line:
+        raise ConnectionError("control socket closed without replying")
+    return json.loads(line)
@@ -1,24 +1,98 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+# Before anything slow is imported, so the imports get counted too
+from startup import StartupProfiler
+startup = StartupProfiler()
+
 from gpiozero import LEDBoard, ButtonBoard, Button, CPUTemperature
 from subprocess import check_call
-from time import sleep, time
+from time import sleep
 from lcd import LCD_HD44780_I2C
 from rgb import Color, RGBButton
-from pipelines import Pipelines, QueryResult, QueryResultStatus, BuildState
+from pipelines import load_pipeline_class, Pipelines, QueryResult, QueryResultStatus, BuildState, DeployStage
+from deploy import DeployExecutor
+from idle import IdleGovernor
+from ledcache import LEDCache
+import metrics
+from coincidence import CoincidenceDetector
+from control import ControlServer, DEFAULT_SOCKET
+from thermal import ThermalMonitor, ThermalTier
+from ui import UIStateMachine
+import logs
+import tracing
+import local_settings
 from local_settings import DAS_CONFIGS, PromptedParameter
-from serial import Serial
+from serialsession import SerialSession
 
-from typing import cast, Optional, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from threading import Event, Thread
+from typing import cast, Callable, Optional, Tuple, Dict
 
 
+import logging
+import os
 import socket
+import time
+
+logs.setup(
+    level=getattr(local_settings, 'LOG_LEVEL', 'INFO'),
+    capacity=getattr(local_settings, 'LOG_BUFFER', 500),
+)
+log = logging.getLogger("dasdeployer")
+# Opt-in, costs next to nothing unless a trace file is given
+tracing.configure(os.environ.get('DASDEPLOYER_TRACE') or getattr(local_settings, 'TRACE_FILE', None))
+
+startup.mark("imports")
 
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/FISHMANPET/DasDeployer.git"
 
 TITLE = ">>> Das Deployer <<<"
 
+# Seconds without any input or status change before the box dims itself
+IDLE_TIMEOUT = getattr(local_settings, 'IDLE_TIMEOUT', 300)
+ACTIVE_FPS = 32
+IDLE_FPS = 4
+POLL_INTERVAL = 10
+# Seconds between looks at finished builds for runs started elsewhere, None never looks
+REFRESH_INTERVAL = getattr(local_settings, 'REFRESH_INTERVAL', None)
+# Seconds apart the two keys can be turned and still count as together
+KEY_WINDOW = getattr(local_settings, 'KEY_WINDOW', 1.0)
+# Seconds to wait for the operator to fill in the prompted parameters
+PROMPT_TIMEOUT = getattr(local_settings, 'PROMPT_TIMEOUT', 120)
+CONTROL_SOCKET = getattr(local_settings, 'CONTROL_SOCKET', DEFAULT_SOCKET)
+# Prometheus metrics on localhost, None to turn them off
+METRICS_PORT = getattr(local_settings, 'METRICS_PORT', metrics.DEFAULT_PORT)
+# Seconds from launch to the first build status on the display
+STARTUP_TARGET = getattr(local_settings, 'STARTUP_TARGET', 20)
+
+# How hard to back off at each thermal tier: animation fps cap, whether to hold
+# the unicorn and chase effects still, and how much to stretch the poll interval
+THERMAL_POLICY = {
+    ThermalTier.NORMAL: (None, False, 1),
+    ThermalTier.WARM: (24, False, 1),
+    ThermalTier.HOT: (16, True, 2),
+    ThermalTier.CRITICAL: (8, True, 3),
+}
+
+
+class UIState(Enum):
+    SELECT_PROJECT = "select project"
+    MAIN = "main"
+    PROMPTING = "prompting"
+    AWAITING_KEYS = "awaiting keys"
+    ARMED = "armed"
+    DIAGNOSTICS = "diagnostics"
+    KEY_MENU = "key menu"
+    LOGS = "logs"
+
+
+# States where the toggles and the build status display are live
+MAIN_STATES = (UIState.MAIN, UIState.PROMPTING, UIState.AWAITING_KEYS, UIState.ARMED)
+
 # Define controls
 switchLight = LEDBoard(red=17, yellow=22, green=9, blue=11, pwm=True)
 switch = ButtonBoard(red=18, yellow=23, green=25, blue=8, hold_time=5)
@@ -26,52 +100,75 @@ toggleLight = LEDBoard(dev=0, test=26, stage=6, prod=19)
 toggle = ButtonBoard(dev=1, test=20, stage=12, prod=16, pull_up=False)
 keys = ButtonBoard(one=14, two=15)
 leds = LEDBoard(switchLight, toggleLight)
-lcd = LCD_HD44780_I2C()
-rgbmatrix = RGBButton()
+# Only touch the GPIO pins when a light actually changes
+switch_leds = LEDCache(switchLight)
+toggle_leds = LEDCache(toggleLight)
 big_button = Button(7)
-serial = Serial(baudrate=9600, timeout=0)
-serial.port = '/dev/ttyACM1'
+# Opened once by its own thread and kept open
+keyboard = SerialSession('/dev/ttyACM1')
+# The LCD init sequence and the LED strip are slow, see bring_up()
+lcd: LCD_HD44780_I2C
+rgbmatrix: RGBButton
 
-key_one_time = 0.0
-key_two_time = 0.0
+startup.mark("gpio")
 
 active_environment = None
 last_result = QueryResult()
 keys_enabled = True
-enable_main = True
 select_project_index = 0
 pipes: Optional[Pipelines] = None
 
 params: Dict[str, str] = {}
 
 
-def turn_one() -> None:
-    print("one turned")
-    global key_one_time
-    key_one_time = time()
-    check_keys()
+def go_idle() -> None:
+    log.info("Going idle")
+    rgbmatrix.set_fps(IDLE_FPS)
+    # Only the button stays lit while idle
+    rgbmatrix.suspend("ring", "key1", "key2")
+    lcd.clear(backlight=False)
 
 
-def turn_two() -> None:
-    print("two turned")
-    global key_two_time
-    key_two_time = time()
-    check_keys()
+def wake_up() -> None:
+    log.info("Waking up")
+    rgbmatrix.set_fps(ACTIVE_FPS)
+    rgbmatrix.resume()
+    lcd.redraw()
 
 
-def check_keys() -> None:
-    global key_two_time, key_one_time
-    if key_one_time and key_two_time:
-        time_diff = key_one_time - key_two_time
-        if time_diff >= -1 and time_diff <= 1:
-            print("matched")
-            key_one_time = 0.0
-            key_two_time = 0.0
-            deploy_question2()
-        else:
-            key_one_time = 0.0
-            key_two_time = 0.0
-            print("timer reset")
+def can_idle() -> bool:
+    if ui.state != UIState.MAIN or any(tog.value for tog in toggle):
+        return False
+    return not (
+        last_result.deploying_dev or last_result.deploying_tst
+        or last_result.deploying_stage or last_result.deploying_prod
+    )
+
+
+governor = IdleGovernor(IDLE_TIMEOUT, on_idle=go_idle, on_wake=wake_up, can_idle=can_idle)
+
+
+thermal_tier = metrics.gauge("dasdeployer_thermal_tier", "Thermal tier, 0 normal to 3 critical")
+
+
+def apply_thermal_tier(tier: ThermalTier) -> None:
+    thermal_tier.set(tier)
+    (fps_cap, simple, poll_scale) = THERMAL_POLICY[tier]
+    rgbmatrix.limit_fps(fps_cap)
+    rgbmatrix.simplify(simple)
+    if pipes:
+        pipes.set_poll_interval(POLL_INTERVAL * poll_scale)
+
+
+thermal = ThermalMonitor(on_change=apply_thermal_tier)
+
+
+# Stamped on the gpiozero threads, the match is handled on the UI thread
+key_detector = CoincidenceDetector(
+    ("one", "two"),
+    window=KEY_WINDOW,
+    on_match=lambda spread: ui.post("keys", "matched"),
+)
 
 
 # Nifty get_ip function from Jamieson Becker https://stackoverflow.com/a/28950776
@@ -99,6 +196,28 @@ def format_lcd_message(
     return final_string
 
 
+def cpu_status() -> str:
+    cpu = CPUTemperature()
+    return f"CPU: {str(round(cpu.temperature))}{chr(0xDF)} {thermal.tier}"
+
+
+def load_pipes() -> None:
+    global pipes, last_result
+    config = DAS_CONFIGS[select_project_index]
+    if pipes:
+        # Only the selected project polls, so it gets all of the quota
+        pipes.stop(wait=False)
+    for (name, value) in vars(config).items():
+        # Never let a PAT or token end up in the logs
+        if logs.is_secret_name(name) and isinstance(value, str):
+            logs.add_secret(value)
+    # Only the backend this project uses gets imported
+    pipes = load_pipeline_class(config.pipeline_class)(config)
+    pipes.set_poll_interval(POLL_INTERVAL * THERMAL_POLICY[thermal.tier][2])
+    pipes.set_refresh_interval(REFRESH_INTERVAL)
+    last_result = pipes.get_status()
+
+
 def shutdown() -> None:
     lcd.message = "Switching off..."
     sleep(3)
@@ -114,76 +233,152 @@ def reboot() -> None:
 
 def reload_pipes() -> None:
     lcd.message = "Reloading pipelines"
-    global pipes
-    pipes = DAS_CONFIGS[select_project_index].pipeline_class(DAS_CONFIGS[select_project_index])
-    sleep(3)
-    cpu = CPUTemperature()
+    load_pipes()
     lcd.message = format_lcd_message(
         TITLE,
         f"IP:  {get_ip()}",
-        f"CPU: {str(round(cpu.temperature))}{chr(0xDF)}",
+        cpu_status(),
         "Off Reset Pipes Back"
     )
 
 
-def dev_deploy() -> None:
-    deploy_question("Dev")
+def dev_deploy() -> UIState:
+    return deploy_question("Dev")
 
 
-def test_deploy() -> None:
-    deploy_question("Test")
+def test_deploy() -> UIState:
+    return deploy_question("Test")
 
 
-def stage_deploy() -> None:
-    deploy_question("Stage")
+def stage_deploy() -> UIState:
+    return deploy_question("Stage")
 
 
-def prod_deploy() -> None:
-    deploy_question("Prod")
+def prod_deploy() -> UIState:
+    return deploy_question("Prod")
 
 
-def get_prompt_value(prompt: PromptedParameter) -> str:
-    with serial as s:
-        s.write(b"start")
-        print("sent start")
-        sleep(1)
-        s.write((prompt.allowed_chars).encode())
-        print("sent alllowed chars")
-        response = ""
-        while not response:
-            result = s.readline()
-            if result:
-                response = result.decode().strip()
-                print(response)
+def prompt_field(prompt: PromptedParameter) -> Dict[str, str]:
+    return {
+        "name": prompt.paramater_name,
+        "possible_chars": prompt.allowed_chars,
+        "display_name": getattr(prompt, 'display_name', prompt.paramater_name),
+    }
+
+
+def valid_value(prompt: PromptedParameter, value: str) -> bool:
+    return bool(value) and all(char in prompt.allowed_chars for char in value)
 
-        sleep(1)
-        s.write(b"end")
 
-    return response
+def get_prompt_value(prompt: PromptedParameter, token: int) -> Optional[str]:
+    """ Ask the keyboard controller for a value, None if the toggle went down first """
+    field = prompt_field(prompt)
+    del field["name"]
+    with tracing.span("prompt", "prompt", parameter=prompt.paramater_name):
+        response = keyboard.request({"state": "enabled", **field}, timeout=PROMPT_TIMEOUT, token=token)
+    if response is None:
+        return None
+    log.debug("Keyboard reply for %s", prompt.paramater_name)
+    return str(response.get("value", ""))
 
 
-def deploy_question(environment: str) -> None:
-    print("Toggle up")
-    print(environment)
+def get_prompt_values(prompts: list[PromptedParameter], token: int) -> Optional[Dict[str, str]]:
+    """ Fill in every prompt in one exchange with the keyboard controller (one per prompt on
+    older firmware), None if cancelled or timed out """
+    values: Dict[str, str] = {}
+    pending = list(prompts)
+    while pending and not keyboard.legacy_firmware:
+        with tracing.span("prompt form", "prompt", fields=len(pending)):
+            response = keyboard.request({
+                "state": "form",
+                "fields": [prompt_field(prompt) for prompt in pending],
+            }, timeout=PROMPT_TIMEOUT, token=token)
+        if response is None:
+            return None
+        if "values" not in response:
+            # Firmware that doesn't know about forms prompts for a single value
+            # whatever it's sent. That's the first field's, the rest are asked
+            # for one at a time below.
+            value = str(response.get("value", ""))
+            if valid_value(pending[0], value):
+                values[pending[0].paramater_name] = value
+                pending = pending[1:]
+            break
+
+        answers = response["values"]
+        invalid = []
+        for prompt in pending:
+            value = str(answers.get(prompt.paramater_name, ""))
+            if valid_value(prompt, value):
+                values[prompt.paramater_name] = value
+            else:
+                log.warning("Invalid value for %s", prompt.paramater_name)
+                invalid.append(prompt)
+        # Only ask again for the ones that were wrong
+        pending = invalid
+
+    for prompt in pending:
+        value = get_prompt_value(prompt, token)
+        if value is None:
+            return None
+        values[prompt.paramater_name] = value
+    return values
+
+
+def deploy_question(environment: str) -> UIState:
+    log.info("Toggle up: %s", environment)
     global active_environment
     active_environment = environment
     global params
     params = {}
+    if pipes:
+        # Look up what the dispatch needs while the operator turns the keys
+        pipes.prefetch(environment)
 
     if environment == "Prod" and pipes:
         env = pipes.config.environments[environment]
         if env:
-            prompts = env.prompted_parms
-            for prompt in prompts:
-                value = get_prompt_value(prompt)
-                print(f"value={value} param_name={prompt.paramater_name}")
-                print(f"params before={params}")
-                params[prompt.paramater_name] = value
-                print(f"params after={params}")
+            start_prompt(env.prompted_parms)
+            return UIState.PROMPTING
+    return await_keys()
+
+
+# Bumped for every prompt, so an answer to one that's been given up on is ignored
+prompt_count = 0
 
+
+def start_prompt(prompts: list[PromptedParameter]) -> None:
+    """ Ask for the prompted parameters on a thread of its own, the answer comes back as an event """
+    global prompt_count
+    prompt_count += 1
+    prompt_id = prompt_count
+    # Taken here, so the toggle going down cancels it even before it's asked
+    token = keyboard.cancel_token()
+
+    def ask() -> None:
+        try:
+            values = get_prompt_values(prompts, token)
+        except Exception:
+            log.exception("Prompting for parameters failed")
+            values = None
+        ui.post("prompt", "done", prompt_id, values)
+    Thread(target=ask, name="prompt", daemon=True).start()
+
+
+def prompt_done(prompt_id: int, values: Optional[Dict[str, str]]) -> Optional[UIState]:
+    if prompt_id != prompt_count:
+        return None
+    if values is None:
+        log.warning("No answer to the parameter prompt")
+        return toggle_release()
+    params.update(values)
+    log.info("params=%s", logs.redact(params))
+    return await_keys()
+
+
+def await_keys() -> UIState:
     if keys_enabled:
-        keys.one.when_pressed = turn_one
-        keys.two.when_pressed = turn_two
+        key_detector.arm()
         rgbmatrix.fillButton(Color.OFF)
         rgbmatrix.pulseRing(Color.YELLOW)
         rgbmatrix.chaseKey1(Color.YELLOW)
@@ -193,21 +388,18 @@ def deploy_question(environment: str) -> None:
             "Turn Keys",
             "to activate"
         )
+        return UIState.AWAITING_KEYS
     else:
-        deploy_question2()
+        return deploy_question2()
 
 
-def deploy_question2() -> None:
-    print("Toggle up2")
-    if keys.one.when_pressed:
-        keys.one.when_pressed = None
-    if keys.two.when_pressed:
-        keys.two.when_pressed = None
+def deploy_question2() -> UIState:
     if keys_enabled:
         rgbmatrix.pulseKey1(Color.GREEN)
         rgbmatrix.pulseKey2(Color.GREEN)
     global active_environment
     environment = active_environment
+    log.info("Ready to deploy %s", environment)
     active_environment = None
 
     if environment in ('Dev', 'Test', 'Stage'):
@@ -228,10 +420,10 @@ def deploy_question2() -> None:
 
     rgbmatrix.pulseButton(Color.RED, 1)
     rgbmatrix.unicornRing(25)
-    big_button.when_pressed = deploy
+    return UIState.ARMED
 
 
-def deploy() -> None:
+def deploy() -> Optional[UIState]:
     # Find what we should be deploying.
     deploy_env = None
     if (toggle.prod.value):
@@ -243,96 +435,144 @@ def deploy() -> None:
     elif (toggle.dev.value):
         deploy_env = "Dev"
     else:
-        return
+        return None
 
     # Approve it.
+    if deployer.in_flight:
+        # Already dispatching, don't deploy twice
+        return None
 
-    big_button.when_pressed = None
     rgbmatrix.fillButton(Color.WHITE)
     rgbmatrix.stopRing()
     rgbmatrix.stopKey1()
     rgbmatrix.stopKey2()
 
-    lcd.message = format_lcd_message(TITLE, f"Deploying to {deploy_env}")
     if pipes:
-        build_result = pipes.approve(deploy_env, params)
-        rgbmatrix.chaseRing(Color.BLUE, 1)
-        if build_result is not None:
-            lcd.message = format_lcd_message(
-                TITLE,
-                f"Build {build_result.number}",
-                f"triggered to {deploy_env}"
-            )
+        # Returns straight away, progress and the result come back below
+        deployer.submit(pipes, deploy_env, params)
+    return UIState.MAIN
+
+
+def deploy_progress(environment: str, stage: DeployStage) -> None:
+    lcd.message = format_lcd_message(
+        TITLE,
+        f"Deploying to {environment}",
+        f"{stage.value}..."
+    )
+
+
+def deploy_done(environment: str, build_result: Optional[BuildState]) -> None:
+    if build_result is None:
+        # The last progress stage says what went wrong
+        rgbmatrix.pulseRing(Color.RED)
+        return
+    rgbmatrix.chaseRing(Color.BLUE, 1)
+    lcd.message = format_lcd_message(
+        TITLE,
+        f"Build {build_result.number}",
+        f"triggered to {environment}"
+    )
 
 
-def toggle_release() -> None:
-    print("Toggle down")
-    global key_two_time, key_one_time
-    key_one_time = 0.0
-    key_two_time = 0.0
+# Progress comes back on the deploy thread, so hand it to the UI thread to display
+deployer = DeployExecutor(
+    on_progress=lambda environment, stage: ui.post("deploy", "progress", environment, stage),
+    on_done=lambda environment, build: ui.post("deploy", "done", environment, build),
+)
+
+
+def toggle_release() -> UIState:
+    log.info("Toggle down")
+    global prompt_count
+    # Give up on any prompt still out, and ignore its answer
+    prompt_count += 1
+    keyboard.cancel()
+    key_detector.disarm()
     rgbmatrix.stopKey1()
     rgbmatrix.stopKey2()
-    if keys.one.when_pressed:
-        keys.one.when_pressed = None
-    if keys.two.when_pressed:
-        keys.two.when_pressed = None
+    if pipes:
+        pipes.cancel_prefetch()
 
     if last_result is None:
-        print("No last result available")
-        return
+        log.warning("No last result available")
     else:
         update_display(last_result)
+    return UIState.MAIN
 
 
-def run_diagnostics() -> None:
+def run_diagnostics() -> UIState:
     """ Diagnostic menu when Red button is held down """
-    toggle_main_off()
-    cpu = CPUTemperature()
     lcd.message = format_lcd_message(
         TITLE,
         f"IP:  {get_ip()}",
-        f"CPU: {str(round(cpu.temperature))}{chr(0xDF)}",
+        cpu_status(),
         "Off Reset Pipes Back"
     )
-    switchLight.red.on()
-    switchLight.yellow.on()
-    switchLight.green.on()
-    switchLight.blue.on()
-
-    switch.red.wait_for_release()
-
-    switch.red.when_pressed = shutdown
-    switch.yellow.when_pressed = reboot
-    switch.green.when_pressed = reload_pipes
-
-    switch.blue.wait_for_press()
-
-    # Blue light pressed - reset and drop out of diagnostics mode
-    toggle_main_on()
-    update_display(last_result)
+    switch_leds.update(red=1, yellow=1, green=1, blue=1)
+    for (name, cache) in (("switch", switch_leds), ("toggle", toggle_leds)):
+        log.info("%s LEDs: %d writes, %d avoided", name, cache.writes, cache.avoided)
+    # The red button is still down, so the next red press is a fresh one
+    return UIState.DIAGNOSTICS
 
 
-def key_toggle() -> None:
+def key_toggle() -> UIState:
     """ Menu for toggling key requirement when green button is held down """
-    toggle_main_off()
     lcd.message = format_lcd_message(
         TITLE,
         f"Keys enabled: {keys_enabled}",
         "",
         "Toggle          Back"
     )
-    switchLight.red.on()
-    switchLight.blue.on()
+    switch_leds.update(red=1, blue=1)
+    return UIState.KEY_MENU
+
+
+log_entries: list[logs.LogEntry] = []
+log_page = 0
 
-    switch.green.wait_for_release()
 
-    switch.red.when_pressed = toggle_keys
+def show_logs() -> UIState:
+    """ Page through the in-memory log when yellow is held down """
+    global log_entries, log_page
+    # Page through a snapshot, so new entries don't move things about
+    log_entries = logs.BUFFER.entries()
+    log_page = 0
+    switch_leds.update(red=1, yellow=1, blue=1)
+    show_log_page()
+    return UIState.LOGS
+
+
+def show_log_page() -> None:
+    if not log_entries:
+        lcd.message = format_lcd_message(TITLE, "No log entries", "", "                Back")
+        return
+    entry = log_entries[-1 - log_page]
+    when = time.strftime("%H:%M", time.localtime(entry.created))
+    header = f"{log_page + 1}/{len(log_entries)} {entry.level[:4]} {when}"
+    # The LCD only has ASCII, and wraps the text over the last three lines
+    text = f"{entry.source}: {entry.message}".encode("ascii", "replace").decode()
+    lcd.message = header[:20] + "\n" + text[:60]
+
 
-    switch.blue.wait_for_press()
+def log_older() -> None:
+    global log_page
+    if log_page < len(log_entries) - 1:
+        log_page += 1
+        show_log_page()
 
-    # Blue light pressed - reset and drop out of diagnostics mode
-    toggle_main_on()
+
+def log_newer() -> None:
+    global log_page
+    if log_page > 0:
+        log_page -= 1
+        show_log_page()
+
+
+def back_to_main() -> UIState:
+    # Blue light pressed - reset and drop out of the menu
+    switch_leds.off()
     update_display(last_result)
+    return UIState.MAIN
 
 
 def toggle_keys() -> None:
@@ -359,24 +599,37 @@ def get_build_color(build_result: BuildState) -> Tuple[int, int, int]:
     return Color.OFF
 
 
-def deploy_in_progress(build: BuildState, environment: str) -> None:
-    print("Deploy")
+def build_line(result: QueryResult, build: BuildState) -> str:
+    if result.stale:
+        # Can't reach the CI, so this is only what it was last time we could
+        return f"Build {build.number} (stale)"
+    return f"Build {build.number}"
+
+
+def deploy_in_progress(result: QueryResult, build: BuildState, environment: str) -> None:
+    log.info("Deploying to %s, build %s", environment, build.number)
     rgbmatrix.fillButton(Color.WHITE)
-    rgbmatrix.chaseRing(Color.BLUE, 1)
+    if result.stale:
+        rgbmatrix.flashRing(Color.YELLOW)
+    else:
+        rgbmatrix.chaseRing(Color.BLUE, 1)
     lcd.message = format_lcd_message(
         TITLE,
-        f"Build {build.number}",
+        build_line(result, build),
         f"Deploying to {environment}"
     )
 
 
 def deploy_finished(result: QueryResult, build: BuildState, environment: str) -> None:
-    print("Finished")
+    log.info("Deploy to %s finished: %s", environment, build.result)
     rgbmatrix.fillButton(Color.WHITE)
-    rgbmatrix.pulseRing(get_build_color(build))
+    if result.stale:
+        rgbmatrix.flashRing(Color.YELLOW)
+    else:
+        rgbmatrix.pulseRing(get_build_color(build))
     lcd.message = format_lcd_message(
         TITLE,
-        f"Build {build.number}",
+        build_line(result, build),
         f"Deployment to {environment}",
         f"Status: {build.result}"
     )
@@ -396,15 +649,16 @@ def select_project_next() -> None:
     select_project_menu()
 
 
-def select_project_select() -> None:
+def select_project_select() -> UIState:
     lcd.message = format_lcd_message(
         TITLE,
         "Project Selected:",
         DAS_CONFIGS[select_project_index].name,
         "Project loading..."
     )
-    global pipes
-    pipes = DAS_CONFIGS[select_project_index].pipeline_class(DAS_CONFIGS[select_project_index])
+    switch_leds.off()
+    load_pipes()
+    return UIState.MAIN
 
 
 def select_project_menu() -> None:
@@ -414,12 +668,7 @@ def select_project_menu() -> None:
         DAS_CONFIGS[select_project_index].name,
         "<-  -> Select"
     )
-    switchLight.red.on()
-    switchLight.yellow.on()
-    switchLight.green.on()
-    switch.red.when_pressed = select_project_previous
-    switch.yellow.when_pressed = select_project_next
-    switch.green.when_pressed = select_project_select
+    switch_leds.update(red=1, yellow=1, green=1)
 
 
 def update_display(result: QueryResult) -> None:
@@ -430,7 +679,7 @@ def update_display(result: QueryResult) -> None:
         # Dev switch is up
         if (result.deploying_dev and result.build_dev):
             # Dev deployment in progress
-            deploy_in_progress(result.build_dev, "Dev")
+            deploy_in_progress(result, result.build_dev, "Dev")
         elif result.build_dev:
             # Dev deployment is finished
             deploy_finished(result, result.build_dev, "Dev")
@@ -441,7 +690,7 @@ def update_display(result: QueryResult) -> None:
         # Test switch is up
         if (result.deploying_tst and result.build_tst):
             # Test deployment in progress
-            deploy_in_progress(result.build_tst, "Test")
+            deploy_in_progress(result, result.build_tst, "Test")
         elif result.build_tst:
             deploy_finished(result, result.build_tst, "Test")
         else:
@@ -451,7 +700,7 @@ def update_display(result: QueryResult) -> None:
         # Stage switch is up
         if (result.deploying_stage and result.build_stage):
             # Stage deployment in progress
-            deploy_in_progress(result.build_stage, "Staging")
+            deploy_in_progress(result, result.build_stage, "Staging")
         elif result.build_stage:
             # Stage deployment is finished
             deploy_finished(result, result.build_stage, "Staging")
@@ -462,7 +711,7 @@ def update_display(result: QueryResult) -> None:
         # Prod switch is up
         if (result.deploying_prod and result.build_prod):
             # Prod deployment in progress
-            deploy_in_progress(result.build_prod, "Prod")
+            deploy_in_progress(result, result.build_prod, "Prod")
         elif result.build_prod:
             # Prod deoployment is finished
             deploy_finished(result, result.build_prod, "Prod")
@@ -470,100 +719,282 @@ def update_display(result: QueryResult) -> None:
 
     else:
         rgbmatrix.fillButton(Color.GREEN)
-        rgbmatrix.fillRing(Color.OFF)
-        lcd.message = format_lcd_message(
-            TITLE,
-            DAS_CONFIGS[select_project_index].name
-        )
+        if result.stale:
+            rgbmatrix.flashRing(Color.YELLOW)
+            lcd.message = format_lcd_message(
+                TITLE,
+                DAS_CONFIGS[select_project_index].name,
+                "",
+                "CI unreachable"
+            )
+        else:
+            rgbmatrix.fillRing(Color.OFF)
+            lcd.message = format_lcd_message(
+                TITLE,
+                DAS_CONFIGS[select_project_index].name
+            )
 
 
-def toggle_main_on() -> None:
-    global enable_main
-    enable_main = True
-    # Attach diagnotic menu to red button when held down
-    switch.red.when_held = run_diagnostics
-    # Attach key toggle menu to green button when held down
-    switch.green.when_held = key_toggle
-    if switch.yellow.when_held:
-        switch.yellow.when_held = None
-    if switch.blue.when_held:
-        switch.blue.when_held = None
-
-    for button in switch:
-        if button.when_pressed:
-            button.when_pressed = None
-    switchLight.off()
-
-    toggle.dev.when_pressed = dev_deploy
-    toggle.test.when_pressed = test_deploy
-    toggle.stage.when_pressed = stage_deploy
-    toggle.prod.when_pressed = prod_deploy
-
-    toggle.dev.when_released = toggle_release
-    toggle.test.when_released = toggle_release
-    toggle.stage.when_released = toggle_release
-    toggle.prod.when_released = toggle_release
-
-
-def toggle_main_off() -> None:
-    global enable_main
-    enable_main = False
-    for button in switch:
-        if button.when_pressed:
-            button.when_pressed = None
-        if button.when_held:
-            button.when_held = None
-    switchLight.off()
-
-    for tog in toggle:
-        if tog.when_pressed:
-            tog.when_pressed = None
-        if tog.when_released:
-            tog.when_released = None
+def status_changed() -> None:
+    update_display(last_result)
+    if not startup.finished:
+        end_splash()
+        startup.finish("first status", STARTUP_TARGET)
+        if not any(tog.value for tog in toggle):
+            # Stays up until the status next changes
+            lcd.message = format_lcd_message(
+                TITLE,
+                DAS_CONFIGS[select_project_index].name,
+                "",
+                f"Ready in {startup.total:.1f}s"
+            )
 
 
-def main() -> None:
+def show_startup_phase(phase: str, duration: float, total: float) -> None:
+    lcd.message = format_lcd_message(
+        TITLE,
+        f"{phase[:12]:<12}{duration:>7.2f}s",
+        f"{'total':<12}{total:>7.2f}s",
+        get_ip()
+    )
 
-    # Quick init sequence to show all is well
-    lcd.message = TITLE + "\n\n\n" + get_ip()
-    rgbmatrix.pulseButton(Color.RED, 1)
-    rgbmatrix.unicornRing(25)
-    leds.blink(0.5, 0.5, 0, 0, 2, False)
-    switchLight.blink(1, 1, 0.5, 0.5, 2, False)
-    lcd.message = TITLE
-    if len(DAS_CONFIGS) == 1:
-        global pipes
-        pipes = DAS_CONFIGS[select_project_index].pipeline_class(DAS_CONFIGS[select_project_index])
+
+# Inputs that behave the same whichever of the main states we are in
+_MAIN_EVENTS = {
+    ("red", "held"): run_diagnostics,
+    ("green", "held"): key_toggle,
+    ("yellow", "held"): show_logs,
+    ("dev", "up"): dev_deploy,
+    ("test", "up"): test_deploy,
+    ("stage", "up"): stage_deploy,
+    ("prod", "up"): prod_deploy,
+    ("dev", "down"): toggle_release,
+    ("test", "down"): toggle_release,
+    ("stage", "down"): toggle_release,
+    ("prod", "down"): toggle_release,
+    ("status", "changed"): status_changed,
+    ("deploy", "progress"): deploy_progress,
+    ("deploy", "done"): deploy_done,
+}
+
+TRANSITIONS = {
+    UIState.SELECT_PROJECT: {
+        ("red", "pressed"): select_project_previous,
+        ("yellow", "pressed"): select_project_next,
+        ("green", "pressed"): select_project_select,
+    },
+    UIState.MAIN: _MAIN_EVENTS,
+    UIState.AWAITING_KEYS: {
+        **_MAIN_EVENTS,
+        ("keys", "matched"): deploy_question2,
+    },
+    UIState.PROMPTING: {
+        # Held buttons and status changes are ignored while the parameters go in
+        ("dev", "down"): toggle_release,
+        ("test", "down"): toggle_release,
+        ("stage", "down"): toggle_release,
+        ("prod", "down"): toggle_release,
+        ("deploy", "progress"): deploy_progress,
+        ("deploy", "done"): deploy_done,
+        ("prompt", "done"): prompt_done,
+    },
+    UIState.ARMED: {
+        **_MAIN_EVENTS,
+        ("big_button", "pressed"): deploy,
+    },
+    UIState.DIAGNOSTICS: {
+        ("red", "pressed"): shutdown,
+        ("yellow", "pressed"): reboot,
+        ("green", "pressed"): reload_pipes,
+        ("blue", "pressed"): back_to_main,
+    },
+    UIState.KEY_MENU: {
+        ("red", "pressed"): toggle_keys,
+        ("blue", "pressed"): back_to_main,
+    },
+    UIState.LOGS: {
+        ("red", "pressed"): log_older,
+        ("yellow", "pressed"): log_newer,
+        ("blue", "pressed"): back_to_main,
+    },
+}
+
+# Every input wakes the box up, whether or not the current state uses it
+ui = UIStateMachine(UIState.MAIN, TRANSITIONS, on_event=governor.poke)
+
+
+def key_turned(name: str) -> Callable[[], None]:
+    post_turned = ui.callback(f"key_{name}", "turned")
+
+    def turned() -> None:
+        # Stamp the turn now, not when the UI thread gets round to it
+        key_detector.press(name)
+        post_turned()
+    return turned
+
+
+def bind_inputs() -> None:
+    """ Point every input at the UI queue, once. The state machine decides what they do. """
+    for name in ("red", "yellow", "green", "blue"):
+        button = getattr(switch, name)
+        button.when_pressed = ui.callback(name, "pressed")
+        button.when_held = ui.callback(name, "held")
+    for name in ("dev", "test", "stage", "prod"):
+        tog = getattr(toggle, name)
+        tog.when_pressed = ui.callback(name, "up")
+        tog.when_released = ui.callback(name, "down")
+    keys.one.when_pressed = key_turned("one")
+    keys.two.when_pressed = key_turned("two")
+    big_button.when_pressed = ui.callback("big_button", "pressed")
+
+
+def control_message(text: str) -> None:
+    governor.poke()
+    lcd.message = text
+
+
+def control_backlight(on: bool = True) -> None:
+    if on:
+        governor.poke()
+        lcd.redraw()
     else:
+        lcd.clear(backlight=False)
+
+
+def control_led(name: str, value: float) -> None:
+    for cache in (switch_leds, toggle_leds):
+        if name in cache.names:
+            cache.update(**{name: value})
+            return
+    raise KeyError(f"no LED called {name}")
+
+
+def control_status() -> Dict[str, object]:
+    result = last_result
+    return {
+        "project": DAS_CONFIGS[select_project_index].name,
+        "state": ui.state.value,
+        "idle": governor.idle,
+        "thermal": str(thermal.tier),
+        "deploying": deployer.in_flight,
+        "stale": result.stale,
+        "environments": {
+            env: {
+                "enabled": enabled,
+                "deploying": deploying,
+                "branch": branch,
+                "build": build.number if build else None,
+                "result": build.result if build else None,
+            }
+            for (env, enabled, deploying, branch, build) in (
+                ("Dev", result.enable_dev, result.deploying_dev, result.branch_dev, result.build_dev),
+                ("Test", result.enable_tst, result.deploying_tst, result.branch_tst, result.build_tst),
+                ("Stage", result.enable_stage, result.deploying_stage, result.branch_stage, result.build_stage),
+                ("Prod", result.enable_prod, result.deploying_prod, result.branch_prod, result.build_prod),
+            )
+        },
+    }
+
+
+# Lets writelcd.py and the boot scripts go through us rather than the I2C bus.
+# The LCD and LED caches have their own locks, so these run on the socket's threads.
+control = ControlServer({
+    "ping": lambda: None,
+    "message": control_message,
+    "backlight": control_backlight,
+    "led": control_led,
+    "status": lambda: {"status": control_status()},
+}, path=CONTROL_SOCKET)
+
+
+splash_over = Event()
+
+
+def splash() -> None:
+    """ Quick init sequence to show all is well, runs alongside the rest of startup """
+    leds.blink(0.5, 0.5, 0, 0, 2, False)
+    if not splash_over.is_set():
+        switchLight.blink(1, 1, 0.5, 0.5, 2, False)
+
+
+def end_splash() -> None:
+    if not splash_over.is_set():
+        splash_over.set()
+        # Stops a blink that's still going, the display loop takes the LEDs from here
+        leds.off()
+        switch_leds.invalidate()
+        toggle_leds.invalidate()
+
+
+def bring_up() -> None:
+    """ Bring up the slow hardware in parallel, with the first status poll already in flight """
+    global lcd, rgbmatrix
+    with ThreadPoolExecutor(thread_name_prefix="bring-up") as pool:
+        if len(DAS_CONFIGS) == 1:
+            # Starts the poll thread, so the first status is on its way
+            loading = pool.submit(load_pipes)
+        lcd_ready = pool.submit(LCD_HD44780_I2C)
+        rgb_ready = pool.submit(RGBButton, fps=ACTIVE_FPS)
+
+        lcd = lcd_ready.result()
+        lcd.message = TITLE + "\n\n\n" + get_ip()
+        startup.on_mark = show_startup_phase
+        rgbmatrix = rgb_ready.result()
+        rgbmatrix.pulseButton(Color.RED, 1)
+        rgbmatrix.unicornRing(25)
+        Thread(target=splash, name="splash", daemon=True).start()
+        startup.mark("hardware")
+
+        if len(DAS_CONFIGS) == 1:
+            loading.result()
+            startup.mark("pipelines")
+
+
+def main() -> None:
+    bring_up()
+    thermal.start()
+    keyboard.start()
+    try:
+        control.start()
+    except OSError as e:
+        log.warning("Control socket unavailable: %s", e)
+    if METRICS_PORT is not None:
+        try:
+            metrics.MetricsServer(METRICS_PORT).start()
+        except OSError as e:
+            log.warning("Metrics endpoint unavailable: %s", e)
+
+    if len(DAS_CONFIGS) > 1:
+        end_splash()
+        ui.state = UIState.SELECT_PROJECT
         select_project_menu()
+    bind_inputs()
+    ui.start()
     while not pipes:
         sleep(1)
 
-    toggle_main_on()
-
-    # Set up build polling.
-    # pipes = Pipelines()
-    global last_result
-    last_result = pipes.get_status()
+    governor.start()
 
     # Display loop
     while True:
-        if enable_main:
-            # result = pipes.get_status()
+        if ui.state in MAIN_STATES:
+            # Restarts the poll thread if it's died
+            pipes.get_status()
 
             # Set the state of the approval toggle LED's
-            toggleLight.dev.value = last_result.enable_dev
-            toggleLight.test.value = last_result.enable_tst
-            toggleLight.stage.value = last_result.enable_stage
-            toggleLight.prod.value = last_result.enable_prod
+            toggle_leds.set("dev", last_result.enable_dev)
+            toggle_leds.set("test", last_result.enable_tst)
+            toggle_leds.set("stage", last_result.enable_stage)
+            toggle_leds.set("prod", last_result.enable_prod)
+            toggle_leds.flush()
 
             # update_display(last_result)
             # sleep(1)
 
             if (last_result.changed):
-                # Something has changed, update the display
-                update_display(last_result)
+                # Something has changed, have the UI thread update the display
                 last_result.reset()
+                ui.post("status", "changed")
             else:
                 # Nothing has changed - lets just wait a bit
                 sleep(1)
@@ -0,0 +1,125 @@
+"""
+`dasdeployer.deploy`
+====================================================
+
+Runs deploy dispatches off the gpiozero callback threads.
+
+`DeployExecutor.submit` returns straight away. The dispatch runs on its own
+thread and reports each `DeployStage` as it gets there, so the display can
+follow along. Only one dispatch runs at a time, so presses of the big button
+while one is in flight are dropped rather than deploying twice.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from pipelines import BuildState, DeployStage, GAVE_UP
+import tracing
+
+if TYPE_CHECKING:
+    from pipelines import Pipelines
+
+# How long past its timeout a dispatch gets before the watchdog gives up on it,
+# so a backend that honours the timeout reports first
+_GRACE = 5.0
+
+log = logging.getLogger(__name__)
+
+
+class DeployExecutor:
+    def __init__(
+        self,
+        on_progress: Callable[[str, DeployStage], None],
+        on_done: Callable[[str, Optional[BuildState]], None],
+        timeout: float = 90,
+    ) -> None:
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._in_flight: Optional[str] = None
+
+    @property
+    def in_flight(self) -> Optional[str]:
+        """The environment currently being dispatched, if any."""
+        return self._in_flight
+
+    def submit(self, pipes: "Pipelines", environment: str, params: dict[str, str]) -> bool:
+        with self._lock:
+            if self._in_flight is not None:
+                log.warning("Deploy to %s already in flight, ignoring %s", self._in_flight, environment)
+                return False
+            self._in_flight = environment
+        self.on_progress(environment, DeployStage.QUEUED)
+        thread = threading.Thread(
+            target=self._run,
+            args=(pipes, environment, dict(params)),
+            name=f"deploy-{environment}",
+            daemon=True,
+        )
+        thread.start()
+        return True
+
+    def _run(self, pipes: "Pipelines", environment: str, params: dict[str, str]) -> None:
+        # Whichever of the dispatch and the watchdog gets there first finishes
+        # the run, anything the other reports after that is ignored
+        finished = False
+        # What the backend said went wrong, shown when the run finishes
+        reason: Optional[DeployStage] = None
+        started = time.monotonic()
+
+        def report(stage: DeployStage) -> None:
+            nonlocal reason
+            with self._lock:
+                if finished:
+                    return
+                if stage in GAVE_UP:
+                    reason = stage
+                    return
+                self.on_progress(environment, stage)
+
+        def finish(stage: DeployStage, build: Optional[BuildState]) -> bool:
+            nonlocal finished
+            with self._lock:
+                if finished:
+                    return False
+                finished = True
+                self._in_flight = None
+                self.on_progress(environment, stage)
+            self.on_done(environment, build)
+            return True
+
+        def watchdog() -> None:
+            # The backend should have given up by now, but a hung request won't
+            if finish(DeployStage.TIMED_OUT, None):
+                log.warning("Deploy to %s still hasn't come back, giving up on it", environment)
+
+        timer = threading.Timer(self.timeout + _GRACE, watchdog)
+        timer.daemon = True
+        timer.start()
+        try:
+            with tracing.span("approve", "deploy", environment=environment):
+                build = pipes.approve(environment, params, progress=report, timeout=self.timeout)
+        except Exception:
+            log.exception("Deploy to %s failed", environment)
+            (stage, build) = (DeployStage.FAILED, None)
+        else:
+            if build is not None:
+                stage = DeployStage.RUNNING
+            elif reason is not None:
+                stage = reason
+            elif time.monotonic() - started >= self.timeout:
+                stage = DeployStage.TIMED_OUT
+            else:
+                stage = DeployStage.FAILED
+        finally:
+            timer.cancel()
+        if not finish(stage, build) and build is not None:
+            # The watchdog gave up on it, but it did start a build after all
+            log.warning("Deploy to %s came back late with build %s", environment, build.number)
+            pipes._set_build(environment, build)
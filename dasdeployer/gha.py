@@ -1,24 +1,39 @@
 # mypy: ignore-errors
+from __future__ import annotations
+
 # from azure.devops.connection import Connection
 # from msrest.authentication import BasicAuthentication
 # from azure.devops.released.build import Build, BuildClient, BuildDefinition
 
 # import threading
-from github import Github
-from github.Repository import Repository
 # from operator import attrgetter
-from dataclasses import dataclass
-from typing import TYPE_CHECKING, cast
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Any, Callable
 # from dasdeployer.local_settings import DasDeployerConfig
 # from dasdeployer.pipelines import QueryResult
-from pipelines import PollStatusThread, Pipelines, BuildState, QueryResultStatus, QueryResult
+from pipelines import api_calls, PollStatusThread, Pipelines, BuildState, QueryResultStatus, QueryResult, DeployStage
+import github_graphql
+import itertools
+import logging
+import ratelimit
+import tracing
+import threading
 import time
 from datetime import date
 
-now = 0.0
+# How long to wait for a dispatched workflow run to show up
+_RUN_SEARCH_TIMEOUT = 60
+
+# Paginated listings only count as the one call
+_api_calls = api_calls("gha")
+
+log = logging.getLogger(__name__)
 
 if TYPE_CHECKING:
     from local_settings import GHAConfig
+    from github import Github
+    from github.Repository import Repository
+    from github.Workflow import Workflow
 
 
 # class QueryResultStatus():
@@ -48,11 +63,21 @@ if TYPE_CHECKING:
 
 
 
-@dataclass
+@dataclass(frozen=True)
 class GhaBuildState(BuildState):
     run_id: int
 
 
+@dataclass
+class GhaDispatchContext:
+    """Everything a dispatch needs before it can fire, see `GhaWorkflows._prefetch`."""
+    source_branch: str
+    workflow: "Workflow"
+    created_since: str
+    # Highest run number that already existed before the dispatch
+    last_run_number: int
+
+
 class GhaWorkflows(Pipelines):
     config: "GHAConfig"
     connection: Repository
@@ -74,8 +99,14 @@ class GhaWorkflows(Pipelines):
     #         self._poll_thread.start()
     #     return self._poll_thread._last_result
 
-    def approve(self, approve_env, params: dict[str, str]) -> str | None:
-        print("Approve env:" + approve_env)
+    def approve(
+        self,
+        approve_env,
+        params: dict[str, str],
+        progress: Callable[[DeployStage], None] | None = None,
+        timeout: float | None = None,
+    ) -> GhaBuildState | None:
+        log.info("Approve env: %s", approve_env)
         # Get Release Client
         # connection = Connection(
         #     base_url=self.config.ado_org_url,
@@ -88,147 +119,254 @@ class GhaWorkflows(Pipelines):
         #     self.config.ado_pipeline_ids[approve_env]
         # )
 
-        if approve_env == 'Dev':
-            source_branch = self.get_status().branch_dev
-        elif approve_env == 'Test':
-            source_branch = self.get_status().branch_tst
-        elif approve_env == 'Stage':
-            source_branch = self.get_status().branch_stage
-        elif approve_env == 'Prod':
-            source_branch = self.get_status().branch_prod
-        else:
+        source_branch = self.source_branch(approve_env)
+        if source_branch is None:
+            if progress:
+                progress(DeployStage.NO_BRANCH)
             return None
 
-        workflow_id = self.config.gha_workflows[approve_env]
-        workflow = self.connection.get_workflow(workflow_id)
-
-        today = date.today().isoformat()
-        pre_runs = workflow.get_runs(created=f">={today}")
-        pre_runs_sorted = sorted(pre_runs, key=lambda x: x.run_number, reverse=True)
-        last_run = pre_runs_sorted[0]
-        workflow.create_dispatch(ref=source_branch, inputs=params)
-        for _ in range(30):
-            time.sleep(2)
-            post_runs = workflow.get_runs(created=f">={today}")
-            post_runs_sorted = sorted(post_runs, key=lambda x: x.run_number, reverse=True)
-            new_run = post_runs_sorted[0]
-            if len(post_runs_sorted) == len(pre_runs_sorted) + 1 and new_run.run_number > last_run.run_number:
-                break
-        else:
+        # Normally warmed up by prefetch() while the keys were being turned
+        context = self._take_prefetched(approve_env)
+        if context is None or context.source_branch != source_branch:
+            with tracing.span("dispatch_context", "deploy"):
+                context = self._dispatch_context(approve_env, source_branch)
+            if context is None:
+                return None
+
+        _api_calls.inc()
+        with tracing.span("create_dispatch", "deploy"):
+            context.workflow.create_dispatch(ref=source_branch, inputs=params)
+        if progress:
+            progress(DeployStage.DISPATCHED)
+        if timeout is None:
+            timeout = _RUN_SEARCH_TIMEOUT
+        deadline = time.monotonic() + min(timeout, _RUN_SEARCH_TIMEOUT)
+        new_run = None
+        with tracing.span("find_dispatched_run", "deploy"):
+            while new_run is None and time.monotonic() < deadline:
+                time.sleep(2)
+                new_run = self._find_dispatched_run(context)
+        if new_run is None:
+            if progress:
+                progress(DeployStage.NOT_FOUND)
             return None
+        if progress:
+            progress(DeployStage.RUN_FOUND)
 
         state = GhaBuildState(
             number=new_run.run_number,
             run_id=new_run.id,
             result=QueryResultStatus.RUNNING,
         )
-        if approve_env == 'Dev':
-            self.last_result.build_dev = state
-        elif approve_env == 'Test':
-            self.last_result.build_tst = state
-        elif approve_env == 'Stage':
-            self.last_result.build_stage = state
-        elif approve_env == 'Prod':
-            self.last_result.build_prod = state
+        self._set_build(approve_env, state)
 
         return state
 
+    def _prefetch(self, approve_env: str, cancel: threading.Event) -> Any:
+        source_branch = self.source_branch(approve_env)
+        if approve_env not in self.config.gha_workflows or source_branch is None:
+            return None
+        return self._dispatch_context(approve_env, source_branch, cancel)
+
+    def _dispatch_context(
+        self,
+        approve_env: str,
+        source_branch: str,
+        cancel: threading.Event | None = None
+    ) -> GhaDispatchContext | None:
+        _api_calls.inc()
+        workflow = self.connection.get_workflow(self.config.gha_workflows[approve_env])
+        if cancel and cancel.is_set():
+            return None
+        today = date.today().isoformat()
+        _api_calls.inc()
+        pre_runs = workflow.get_runs(created=f">={today}")
+        last_run_number = max((run.run_number for run in pre_runs), default=0)
+        return GhaDispatchContext(
+            source_branch=source_branch,
+            workflow=workflow,
+            created_since=today,
+            last_run_number=last_run_number,
+        )
+
+    def _find_dispatched_run(self, context: GhaDispatchContext) -> Any:
+        _api_calls.inc()
+        post_runs = context.workflow.get_runs(
+            created=f">={context.created_since}", event="workflow_dispatch"
+        )
+        # Not matched on the commit, the branch can move on between the
+        # prefetch and the dispatch
+        new_runs = [
+            run for run in post_runs
+            if run.run_number > context.last_run_number and run.head_branch == context.source_branch
+        ]
+        if not new_runs:
+            return None
+        # Oldest new run is ours if somebody else dispatched straight after us
+        return min(new_runs, key=lambda x: x.run_number)
+
 
 class GhaPollStatusThread(PollStatusThread):
     config: "GHAConfig"
     _connection: Repository
+    backend = "gha"
     def __init__(
             self,
             config: "GHAConfig",
             github_conn: Github,
             last_result: QueryResult,
             connection: Repository,
-            interval: int = 10
+            interval: float = 10
         ):
         super().__init__(config, github_conn, connection, last_result, interval)
-
-    def run(self) -> None:
-        while True:
-            global now
-            new_now = time.time()
-            print(f"running, last run {new_now - now} seconds ago")
-            now = new_now
-
-            for e, value in self.config.environments.items():
-                # if value:
-                if e == 'Dev':
-                    self._last_result.enable_dev = bool(value)
-                    self._last_result.branch_dev = 'master'
-                    state = cast(GhaBuildState, self._last_result.build_dev)
-                    # state = self._last_result.build_dev
-                    # result.deploying_dev = deploying
-                    # result.build_dev = buildDef.latest_build
-
-                elif e == 'Test':
-                    self._last_result.enable_tst = bool(value)
-                    self._last_result.branch_tst = 'master'
-                    state = cast(GhaBuildState, self._last_result.build_tst)
-                    # state = self._last_result.build_tst
-                    # result.deploying_tst = deploying
-                    # result.build_tst = buildDef.latest_build
-                elif e == 'Stage':
-                    self._last_result.enable_stage = bool(value)
-                    self._last_result.branch_stage = 'master'
-                    state = cast(GhaBuildState, self._last_result.build_stage)
-                    # state = self._last_result.build_stage
-                    # result.deploying_stage = deploying
-                    # result.build_stage = buildDef.latest_build
-                elif e == 'Prod':
-                    self._last_result.enable_prod = bool(value)
-                    self._last_result.branch_prod = 'master'
-                    state = cast(GhaBuildState, self._last_result.build_prod)
-                    # state = self._last_result.build_prod
-
-                if state:
-                    run = self._connection.get_workflow_run(state.run_id)
-                    if run.status == 'completed':
-                        deploying = False
-                        if run.conclusion == 'success':
-                            state.result = QueryResultStatus.SUCCEEDED
-                        elif run.conclusion == 'failure':
-                            state.result = QueryResultStatus.FAILED
-                        elif run.conclusion == 'cancelled':
-                            state.result = QueryResultStatus.CANCELED
-                        else:
-                            # action_required, neutral, skipped, stale
-                            return None
-                    else:
-                        # queued, in_progress, waiting, requested, pending
-                        deploying = True
-                        state.result = QueryResultStatus.RUNNING
+        self._graphql: github_graphql.GitHubGraphQL | None = github_graphql.GitHubGraphQL(connection, config.github_repo, config.github_pat)
+        self._workflows: dict[str, Workflow] = {}
+
+    def _rate_budget(self) -> ratelimit.RateBudget:
+        # Polls go over GraphQL, which has a points budget of its own
+        return github_graphql.budget_for(self.config.github_pat)
+
+    def poll_once(self) -> None:
+        # Read before fetching, so a deploy recorded meanwhile isn't undone
+        tracked = {e: self._current_build(e) for e in self.config.environments}
+        runs = self._fetch_runs(tracked)
+        for e, value in self.config.environments.items():
+            # if value:
+            if e == 'Dev':
+                self._last_result.enable_dev = bool(value)
+                self._last_result.branch_dev = 'master'
+                # state = self._last_result.build_dev
+                # result.deploying_dev = deploying
+                # result.build_dev = buildDef.latest_build
+
+            elif e == 'Test':
+                self._last_result.enable_tst = bool(value)
+                self._last_result.branch_tst = 'master'
+                # state = self._last_result.build_tst
+                # result.deploying_tst = deploying
+                # result.build_tst = buildDef.latest_build
+            elif e == 'Stage':
+                self._last_result.enable_stage = bool(value)
+                self._last_result.branch_stage = 'master'
+                # state = self._last_result.build_stage
+                # result.deploying_stage = deploying
+                # result.build_stage = buildDef.latest_build
+            elif e == 'Prod':
+                self._last_result.enable_prod = bool(value)
+                self._last_result.branch_prod = 'master'
+                # state = self._last_result.build_prod
+
+            state = tracked[e]
+            run = runs.get(e)
+            if run is not None:
+                (deploying, result) = _run_status(run)
+                if state is not None and state.run_id == run.id:
+                    new_state = replace(state, result=result)
+                else:
+                    new_state = GhaBuildState(number=run.run_number, run_id=run.id, result=result)
+                self._replace_build(e, state, new_state)
+            else:
+                deploying = False
+
+            if e == 'Dev':
+                # result.enable_dev = bool(dev_branch)
+                # result.branch_dev = dev_branch
+                self._last_result.deploying_dev = deploying
+                # result.build_dev = buildDef.latest_build
+
+            elif e == 'Test':
+                # result.enable_tst = bool(tst_branch)
+                # result.branch_tst = tst_branch
+                self._last_result.deploying_tst = deploying
+                # result.build_tst = buildDef.latest_build
+            elif e == 'Stage':
+                # result.enable_stage = bool(main_branch)
+                # result.branch_stage = main_branch
+                self._last_result.deploying_stage = deploying
+                # result.build_stage = buildDef.latest_build
+            elif e == 'Prod':
+                # result.enable_prod = True
+                # result.branch_prod = None
+                self._last_result.deploying_prod = deploying
+                # result.build_prod = buildDef.latest_build
+
+        if self._graphql is None:
+            # From the headers of the last response, so this doesn't cost a request.
+            # GraphQL has its own limit, which its queries report themselves.
+            (remaining, limit) = self._github_conn.rate_limiting
+            self.budget.update(remaining, limit, self._github_conn.rate_limiting_resettime)
+
+    def _fetch_runs(self, tracked: dict[str, GhaBuildState | None]) -> dict[str, Any]:
+        """The run to show for each environment that needs looking at this poll."""
+        # Finished builds don't change, so they cost nothing between refreshes
+        watched = {e: state for (e, state) in tracked.items() if state and (self.refreshing or not state.finished)}
+        # Refreshes also pick up runs started from GitHub rather than from here
+        workflows = [e for e in tracked if self.refreshing and e in self.config.gha_workflows]
+        if not watched and not workflows:
+            return {}
+        # Each workflow's newest runs, the one a watched build is for should be among them
+        recent: dict[str, list[Any]] = {}
+        if self._graphql is not None:
+            try:
+                recent = self._recent_runs_graphql(list(watched) + workflows)
+            except Exception as ex:
+                if not github_graphql.unavailable(ex):
+                    raise
+                log.warning("GitHub didn't take the GraphQL status query, polling over REST instead: %s", ex)
+                self._graphql = None
+                self.budget = ratelimit.for_token("github", self.config.github_pat)
+        else:
+            for e in workflows:
+                _api_calls.inc()
+                # Newest first, and only the first page gets fetched
+                recent[e] = list(itertools.islice(self._workflow(e).get_runs(), 1))
+
+        runs = {}
+        for (e, state) in tracked.items():
+            newest = (recent.get(e) or [None])[0] if e in workflows else None
+            if newest is not None and (state is None or newest.run_number >= state.number):
+                runs[e] = newest
+            elif e in watched:
+                found = [run for run in recent.get(e, []) if run.id == state.run_id]
+                if found:
+                    runs[e] = found[0]
                 else:
-                    deploying = False
-
-                if e == 'Dev':
-                    # result.enable_dev = bool(dev_branch)
-                    # result.branch_dev = dev_branch
-                    self._last_result.deploying_dev = deploying
-                    # result.build_dev = buildDef.latest_build
-
-                elif e == 'Test':
-                    # result.enable_tst = bool(tst_branch)
-                    # result.branch_tst = tst_branch
-                    self._last_result.deploying_tst = deploying
-                    # result.build_tst = buildDef.latest_build
-                elif e == 'Stage':
-                    # result.enable_stage = bool(main_branch)
-                    # result.branch_stage = main_branch
-                    self._last_result.deploying_stage = deploying
-                    # result.build_stage = buildDef.latest_build
-                elif e == 'Prod':
-                    # result.enable_prod = True
-                    # result.branch_prod = None
-                    self._last_result.deploying_prod = deploying
-                    # result.build_prod = buildDef.latest_build
-
-            # At the end of the thread execution, wait a bit and then poll again
-            if self.stoprequest.wait(self.delay):
-                break
+                    _api_calls.inc()
+                    runs[e] = self._connection.get_workflow_run(state.run_id)
+        return runs
+
+    def _recent_runs_graphql(self, environments: list[str]) -> dict[str, list[Any]]:
+        workflow_ids = {
+            e: self._workflow(e).raw_data["node_id"]
+            for e in set(environments)
+            if e in self.config.gha_workflows
+        }
+        _api_calls.inc()
+        status = self._graphql.status(workflow_ids=set(workflow_ids.values()))
+        return {e: status.runs.get(node_id, []) for (e, node_id) in workflow_ids.items()}
+
+    def _workflow(self, environment: str) -> Workflow:
+        """The environment's workflow, looked up the first time it's needed."""
+        if environment not in self._workflows:
+            _api_calls.inc()
+            self._workflows[environment] = self._connection.get_workflow(self.config.gha_workflows[environment])
+        return self._workflows[environment]
+
+
+def _run_status(run: Any) -> tuple[bool, QueryResultStatus]:
+    """Whether a workflow run is still deploying, and how it's doing."""
+    if run.status != 'completed':
+        # queued, in_progress, waiting, requested, pending
+        return (True, QueryResultStatus.RUNNING)
+    if run.conclusion == 'action_required':
+        # Waiting on somebody to approve it, so not done yet
+        return (True, QueryResultStatus.RUNNING)
+    if run.conclusion in ('success', 'neutral'):
+        return (False, QueryResultStatus.SUCCEEDED)
+    if run.conclusion in ('failure', 'timed_out', 'startup_failure'):
+        return (False, QueryResultStatus.FAILED)
+    # cancelled, skipped, stale
+    return (False, QueryResultStatus.CANCELED)
 
 
 # class PollStatusThread(threading.Thread):
@@ -0,0 +1,231 @@
+"""
+`dasdeployer.github_graphql`
+====================================================
+
+What the poll threads need from GitHub, in one GraphQL request.
+
+Over REST, picking the newest dev/ or tst/ branch means listing the
+branches and then fetching every branch's commit for its date, and each
+workflow run being watched is another request. The status query here
+asks for the branch heads with their commit dates and the newest runs of
+every tracked workflow, with their check suites, all at once. A run that's
+just been dispatched is always among the newest of its workflow.
+
+GraphQL has its own rate limit, counted in points rather than requests.
+Every query asks what it cost and how many points are left, and that
+goes into a `ratelimit.RateBudget` of its own, so polls slow down as the
+points run out just like they do for REST.
+
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+import logging
+from typing import TYPE_CHECKING, Any, Iterable
+
+import metrics
+import ratelimit
+import tracing
+
+if TYPE_CHECKING:
+    from github.Repository import Repository
+
+# Branches fetched per page for each prefix. They come back in name order,
+# so every page is read and the newest picked by commit date.
+_BRANCHES_PER_PAGE = 100
+# Runs fetched for each workflow, newest first
+_RUNS_PER_WORKFLOW = 5
+
+_RUN_FIELDS = "id databaseId runNumber checkSuite { status conclusion }"
+_HEAD_FIELDS = "name target { ... on Commit { committedDate } }"
+_PAGE_FIELDS = "pageInfo { hasNextPage endCursor }"
+_RATE_LIMIT_FIELDS = "rateLimit { cost remaining limit resetAt }"
+
+log = logging.getLogger(__name__)
+
+_points = metrics.counter(
+    "dasdeployer_graphql_points_total",
+    "Points spent from the GitHub GraphQL rate limit",
+    shared=True,
+)
+
+
+@dataclass(frozen=True)
+class WorkflowRun:
+    """The bits of a workflow run the pollers look at, named as PyGithub names them."""
+    node_id: str
+    id: int
+    run_number: int
+    # Lower case like the REST API, e.g. in_progress, completed
+    status: str
+    conclusion: str | None
+
+
+@dataclass
+class RepoStatus:
+    # Newest branch for each prefix asked for, or the branch itself for a plain name
+    heads: dict[str, str | None]
+    # Newest runs first, by the workflow's node id
+    runs: dict[str, list[WorkflowRun]]
+    cost: int
+
+
+def budget_for(token: str) -> ratelimit.RateBudget:
+    """The GraphQL point budget for `token`, separate from its REST quota."""
+    return ratelimit.for_token("github-graphql", token)
+
+
+def unavailable(error: BaseException) -> bool:
+    """Whether `error` is the server not taking the query, so REST should be used instead.
+
+    Most likely a GitHub Enterprise Server without GraphQL, or without
+    workflows in its schema.
+    """
+    # Only imported here so loading this module doesn't pull in PyGithub
+    from github import GithubException
+    return isinstance(error, GithubException) and error.status in (400, 404)
+
+
+class GitHubGraphQL:
+    def __init__(self, repo: Repository, full_name: str, token: str) -> None:
+        # The repo's requester has the same auth, server and error handling
+        # as the REST calls. The PyGithub 2.3 we pin keeps Github's own private,
+        # and its graphql_query nests the variables under "input".
+        self._requester = repo._requester
+        (self.owner, _, self.name) = full_name.partition('/')
+        self.budget = budget_for(token)
+
+    def status(self, heads: Iterable[str] = (), workflow_ids: Iterable[str] = ()) -> RepoStatus:
+        """Fetch branch heads and the newest runs of workflows.
+
+        `heads` are branch names, or prefixes ending in / to get the branch
+        under them with the newest commit. `workflow_ids` are GraphQL node
+        ids, as found in a workflow's REST `node_id`.
+        """
+        heads = list(heads)
+        (query, variables) = _status_query(self.owner, self.name, heads, list(workflow_ids))
+        data = self._query(query, variables)
+        cost = self._account(data["rateLimit"])
+
+        repository = data.get("repository") or {}
+        found: dict[str, str | None] = {}
+        for (i, head) in enumerate(heads):
+            if head.endswith('/'):
+                refs = repository.get(f"prefix{i}") or {}
+                nodes = refs.get("nodes") or []
+                page = refs.get("pageInfo") or {}
+                while page.get("hasNextPage"):
+                    (more, page, page_cost) = self._more_heads(head, page["endCursor"])
+                    nodes.extend(more)
+                    cost += page_cost
+                # Commit dates are ISO 8601 in UTC, so they sort as strings
+                newest = max(nodes, key=_committed, default=None)
+                found[head] = head + newest["name"] if newest else None
+            else:
+                ref = repository.get(f"ref{i}")
+                found[head] = ref["name"] if ref else None
+
+        runs = {
+            node["id"]: [_workflow_run(run) for run in node["runs"]["nodes"]]
+            for node in data.get("workflows") or []
+            if node
+        }
+        return RepoStatus(heads=found, runs=runs, cost=cost)
+
+    def _more_heads(self, prefix: str, after: str) -> tuple[list[dict[str, Any]], dict[str, Any], int]:
+        """The next page of branches under `prefix`, for repos with lots of them."""
+        query = (
+            "query DasDeployerHeads($owner: String!, $name: String!, $prefix: String!, $after: String!) { "
+            f"{_RATE_LIMIT_FIELDS} repository(owner: $owner, name: $name) {{ "
+            f"refs(refPrefix: $prefix, first: {_BRANCHES_PER_PAGE}, after: $after) "
+            f"{{ {_PAGE_FIELDS} nodes {{ {_HEAD_FIELDS} }} }} }} }}"
+        )
+        data = self._query(query, {
+            "owner": self.owner,
+            "name": self.name,
+            "prefix": f"refs/heads/{prefix}",
+            "after": after,
+        })
+        cost = self._account(data["rateLimit"])
+        refs = (data.get("repository") or {}).get("refs") or {}
+        return (refs.get("nodes") or [], refs.get("pageInfo") or {}, cost)
+
+    def _query(self, query: str, variables: dict[str, Any]) -> dict[str, Any]:
+        with tracing.span("graphql", "poll"):
+            (headers, data) = self._requester.requestJsonAndCheck(
+                "POST",
+                self._requester.graphql_url,
+                input={"query": query, "variables": variables},
+            )
+        if data.get("errors"):
+            # GraphQL answers 200 regardless, raise what PyGithub would
+            from github import GithubException
+            raise GithubException(400, data, headers)
+        return data["data"]
+
+    def _account(self, rate_limit: dict[str, Any]) -> int:
+        cost = rate_limit["cost"]
+        _points.inc(cost)
+        reset_at = datetime.fromisoformat(rate_limit["resetAt"].replace("Z", "+00:00")).timestamp()
+        self.budget.update(rate_limit["remaining"], rate_limit["limit"], reset_at)
+        log.debug("GraphQL status query cost %d, %d points left", cost, rate_limit["remaining"])
+        return cost
+
+
+def _status_query(
+    owner: str,
+    name: str,
+    heads: list[str],
+    workflow_ids: list[str],
+) -> tuple[str, dict[str, Any]]:
+    params = ["$owner: String!", "$name: String!"]
+    variables: dict[str, Any] = {"owner": owner, "name": name}
+    repo_fields = []
+    for (i, head) in enumerate(heads):
+        if head.endswith('/'):
+            params.append(f"$prefix{i}: String!")
+            variables[f"prefix{i}"] = f"refs/heads/{head}"
+            repo_fields.append(
+                f"prefix{i}: refs(refPrefix: $prefix{i}, first: {_BRANCHES_PER_PAGE}) "
+                f"{{ {_PAGE_FIELDS} nodes {{ {_HEAD_FIELDS} }} }}"
+            )
+        else:
+            params.append(f"$ref{i}: String!")
+            variables[f"ref{i}"] = f"refs/heads/{head}"
+            repo_fields.append(f"ref{i}: ref(qualifiedName: $ref{i}) {{ {_HEAD_FIELDS} }}")
+
+    fields = [_RATE_LIMIT_FIELDS]
+    if repo_fields:
+        fields.append("repository(owner: $owner, name: $name) { " + " ".join(repo_fields) + " }")
+    if workflow_ids:
+        params.append("$workflowIds: [ID!]!")
+        variables["workflowIds"] = workflow_ids
+        fields.append(
+            "workflows: nodes(ids: $workflowIds) { ... on Workflow { id "
+            f"runs(first: {_RUNS_PER_WORKFLOW}, orderBy: {{field: CREATED_AT, direction: DESC}}) "
+            f"{{ nodes {{ {_RUN_FIELDS} }} }} }} }}"
+        )
+    if not repo_fields:
+        # Otherwise $owner and $name would be unused, which GraphQL rejects
+        params = params[2:]
+        del variables["owner"], variables["name"]
+    signature = "(" + ", ".join(params) + ")" if params else ""
+    query = "query DasDeployerStatus" + signature + " { " + " ".join(fields) + " }"
+    return (query, variables)
+
+
+def _committed(node: dict[str, Any]) -> str:
+    return (node.get("target") or {}).get("committedDate") or ""
+
+
+def _workflow_run(node: dict[str, Any]) -> WorkflowRun:
+    suite = node.get("checkSuite") or {}
+    return WorkflowRun(
+        node_id=node["id"],
+        id=node["databaseId"],
+        run_number=node["runNumber"],
+        status=(suite.get("status") or "queued").lower(),
+        conclusion=suite["conclusion"].lower() if suite.get("conclusion") else None,
+    )
@@ -0,0 +1,75 @@
+"""
+`dasdeployer.idle`
+====================================================
+
+Idle governor. Puts the box into a low power state after a quiet period and
+brings it straight back on the next input or status change.
+
+`poke()` is cheap and safe to call from any thread (gpiozero callbacks, the
+display loop). The idle and wake callbacks always run on the governor's own
+thread, so a callback never waits on the display or LEDs.
+
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable
+
+
+class IdleGovernor(threading.Thread):
+    def __init__(
+        self,
+        timeout: float,
+        on_idle: Callable[[], None],
+        on_wake: Callable[[], None],
+        can_idle: Callable[[], bool] = lambda: True,
+    ) -> None:
+        super(IdleGovernor, self).__init__()
+        assert timeout > 0
+        self.daemon = True
+        self.stoprequest = threading.Event()
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.on_wake = on_wake
+        self.can_idle = can_idle
+        self.idle = False
+        self._last_activity = time.monotonic()
+        self._activity = threading.Event()
+
+    def poke(self) -> None:
+        self._last_activity = time.monotonic()
+        self._activity.set()
+
+    def start(self) -> None:
+        self.stoprequest.clear()
+        super(IdleGovernor, self).start()
+
+    def stop(self, timeout: float | None = 10) -> None:
+        self.stoprequest.set()
+        self._activity.set()
+        self.join(timeout)
+
+    def run(self) -> None:
+        while not self.stoprequest.is_set():
+            if self.idle:
+                # Sleep until something happens
+                self._activity.wait()
+                self._activity.clear()
+                if self.stoprequest.is_set():
+                    break
+                self.idle = False
+                self.on_wake()
+                continue
+
+            remaining = self._last_activity + self.timeout - time.monotonic()
+            if remaining > 0:
+                self._activity.wait(remaining)
+                self._activity.clear()
+            elif self.can_idle():
+                self.idle = True
+                self.on_idle()
+            else:
+                # Busy (deploying, toggle up...) so start the quiet period again
+                self._last_activity = time.monotonic()
@@ -11,7 +11,7 @@ ser.write(json.dumps({
     "state": "enabled",
     "possible_chars": "abcdefghijklmnopqrstuvwxyz_",
     "display_name": "Built For"
-}).encode())
+}).encode() + b"\n")
 
 time.sleep(1)
 print("sending chars")
@@ -26,4 +26,4 @@ while True:
     # print(ser.readline().decode().strip())
 print("found result")
 time.sleep(1)
-ser.write(b"end")
+ser.write(json.dumps({"state": "disabled"}).encode() + b"\n")
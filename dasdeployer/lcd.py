@@ -28,8 +28,10 @@ Code inspired by Adafruit's excellent CircuitPython CharLCD library
 * python3-smbus, i2c-tools
 
 """
-import smbus2
+import threading
 import time
+import metrics
+import tracing
 
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/martinwoodward/DasDeployer.git"
@@ -44,17 +46,31 @@ _ENABLE = 0b00000100  # Enable bit
 # Timing constants
 _DELAY = 0.0003
 
+# Writes all happen under the display's lock, so these don't need one of their own
+_write_seconds = metrics.histogram(
+    "dasdeployer_lcd_write_seconds",
+    "Time taken to write a whole message to the LCD",
+    buckets=(.01, .025, .05, .075, .1, .15, .2, .3, .5, 1.0),
+)
+_bytes_written = metrics.counter("dasdeployer_lcd_bytes_total", "Bytes sent to the LCD controller")
+
 
 class LCD_HD44780_I2C:
-    def __init__(self, cols=20, rows=4, address=0x27) -> None:
+    def __init__(self, cols=20, rows=4, address=0x27, bus=None) -> None:
         self.cols = cols
         self.rows = rows
         self.address = address
 
         self._last_message = ""
+        self._message = ""
+        # Whole messages are written under the lock so writers from different threads don't interleave
+        self._lock = threading.RLock()
 
-        # Initialise the bus
-        self.bus = smbus2.SMBus(1)  # Modern Pi uses 1, old Pi's (Rev 1) use 0
+        # Initialise the bus, anything with smbus2's write_byte will do off the Pi
+        if bus is None:
+            import smbus2
+            bus = smbus2.SMBus(1)  # Modern Pi uses 1, old Pi's (Rev 1) use 0
+        self.bus = bus
 
         # Use the bus to initialise the display using some magic bits
         self._write8(0x33)  # 110011 Initialise
@@ -77,6 +93,7 @@ class LCD_HD44780_I2C:
         backlight : int
             0 for backlight off, 0x08 for on
         """
+        _bytes_written.inc()
         bits_high = char_mode | (bits & 0xF0) | backlight
         bits_low = char_mode | ((bits << 4) & 0xF0) | backlight
 
@@ -119,7 +136,20 @@ class LCD_HD44780_I2C:
         #     # We've already displayed this.
         #     return
         # self._last_message = self._message
-        self._message = message
+        # Includes any wait for the lock, which is part of how long it takes to show
+        with tracing.span("lcd.message", "lcd"), self._lock:
+            self._message = message
+            self._write_message(message)
+
+    def redraw(self):
+        """Write the current message again, which also turns the backlight back on
+        after `clear(backlight=False)`.
+        """
+        with self._lock:
+            self._write_message(self._message)
+
+    def _write_message(self, message):
+        started = time.perf_counter()
         row = 0
         col = 0
         line = ""
@@ -141,9 +171,11 @@ class LCD_HD44780_I2C:
         # Fill the remainer of screen with empty characters
         for i in range(row + 1, self.rows + 1):
             self.printLine("", i)
+        _write_seconds.observe(time.perf_counter() - started)
 
     def clear(self, backlight=True):
-        if (backlight):
-            self._write8(0x01)  # 000001 Clear display
-        else:
-            self._write8(0x01, False, 0)  # Clear display and turn off backlight
+        with self._lock:
+            if (backlight):
+                self._write8(0x01)  # 000001 Clear display
+            else:
+                self._write8(0x01, False, 0)  # Clear display and turn off backlight
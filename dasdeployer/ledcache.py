@@ -0,0 +1,64 @@
+"""
+`dasdeployer.ledcache`
+====================================================
+
+Remembers what each LED on a gpiozero `LEDBoard` was last set to, so the
+hardware (and with pwm=True, the PWM thread) is only touched when a value
+actually changes.
+
+`set` just records the value wanted. `flush` writes whatever differs from
+what's already lit, once per frame, and `update` does both in one go. Call
+`invalidate` after driving the board directly (blink, off...) so the next
+flush writes everything again.
+
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Any
+
+
+class LEDCache:
+    def __init__(self, board: Any) -> None:
+        self.board = board
+        self.names: tuple[str, ...] = board.namedtuple._fields
+        self._lock = threading.Lock()
+        self._lit: dict[str, float] = {}
+        self._wanted: dict[str, float] = {}
+        self.writes = 0
+        # Values that were set but already matched the hardware
+        self.avoided = 0
+
+    def set(self, name: str, value: float) -> None:
+        if name not in self.names:
+            raise KeyError(name)
+        with self._lock:
+            self._wanted[name] = float(value)
+
+    def flush(self) -> int:
+        """Write the values that changed since the last flush, return how many."""
+        with self._lock:
+            (wanted, self._wanted) = (self._wanted, {})
+            written = 0
+            for (name, value) in wanted.items():
+                if self._lit.get(name) == value:
+                    self.avoided += 1
+                    continue
+                getattr(self.board, name).value = value
+                self._lit[name] = value
+                written += 1
+            self.writes += written
+        return written
+
+    def update(self, **values: float) -> int:
+        for (name, value) in values.items():
+            self.set(name, value)
+        return self.flush()
+
+    def off(self) -> int:
+        return self.update(**{name: 0 for name in self.names})
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._lit.clear()
@@ -0,0 +1,167 @@
+"""
+`dasdeployer.logs`
+====================================================
+
+Logging set up for the deployer, on top of the standard `logging` module.
+Modules just use ``logging.getLogger(__name__)``.
+
+* Every record is kept in a fixed size ring buffer in memory, so the
+  diagnostics menu can page back through them without the SD card.
+* Output is filtered by level, and rate limited per message so a loop
+  that goes wrong can't flood stdout (or push everything else out of the
+  buffer). How many were dropped is noted on the next one let through.
+* Anything that looks like a token, and any secret registered with
+  `add_secret`, is masked before it is written anywhere. Use `redact` on
+  parameter dicts before logging them.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Mapping, Union
+
+MASK = "***"
+
+# Parameter and setting names whose values are never logged
+_SECRET_NAME = re.compile(r"pat|token|secret|passw|key|auth|credential", re.IGNORECASE)
+# GitHub personal access, OAuth, app and fine grained tokens
+_TOKEN = re.compile(r"\bgh[pousr]_[A-Za-z0-9]{20,}|\bgithub_pat_[A-Za-z0-9_]{20,}")
+
+_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+
+def redact(values: Mapping[str, Any]) -> dict[str, Any]:
+    """Copy of `values` with anything under a secret looking name masked."""
+    return {name: MASK if _SECRET_NAME.search(name) else value for (name, value) in values.items()}
+
+
+def is_secret_name(name: str) -> bool:
+    return bool(_SECRET_NAME.search(name))
+
+
+@dataclass(frozen=True)
+class LogEntry:
+    created: float
+    level: str
+    source: str
+    message: str
+
+
+class RingBufferHandler(logging.Handler):
+    def __init__(self, capacity: int = 500, level: int = logging.INFO) -> None:
+        super(RingBufferHandler, self).__init__(level)
+        self._entries: deque = deque(maxlen=capacity)
+
+    def resize(self, capacity: int) -> None:
+        with self.lock:
+            self._entries = deque(self._entries, maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._entries.append(LogEntry(record.created, record.levelname, record.name, record.getMessage()))
+
+    def entries(self) -> list[LogEntry]:
+        """Snapshot of the buffer, oldest first."""
+        with self.lock:
+            return list(self._entries)
+
+
+class RateLimitFilter(logging.Filter):
+    """Let each message through at most `burst` times every `per` seconds."""
+
+    def __init__(self, burst: int = 5, per: float = 10.0) -> None:
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.per = per
+        self._lock = threading.Lock()
+        # (logger, message template) -> (window start, count, dropped)
+        self._windows: dict[tuple[str, Any], tuple[float, int, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # The same record goes past every handler, only decide once
+        decided = getattr(record, "_rate_allowed", None)
+        if decided is not None:
+            return decided
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            (started, count, dropped) = self._windows.get(key, (now, 0, 0))
+            if now - started >= self.per:
+                if dropped:
+                    record.msg = f"{record.msg} ({dropped} more like this dropped)"
+                (started, count, dropped) = (now, 0, 0)
+            count += 1
+            allowed = count <= self.burst
+            if not allowed:
+                dropped += 1
+            if len(self._windows) > 1024:
+                # Lots of one off messages, start afresh rather than grow
+                self._windows.clear()
+            self._windows[key] = (started, count, dropped)
+        record._rate_allowed = allowed  # type: ignore[attr-defined]
+        return allowed
+
+
+class RedactFilter(logging.Filter):
+    def __init__(self) -> None:
+        super(RedactFilter, self).__init__()
+        self._secrets: set[str] = set()
+
+    def add_secret(self, secret: str) -> None:
+        # Too short to be a real secret, and masking it would mangle everything
+        if secret and len(secret) >= 8:
+            self._secrets.add(secret)
+
+    def scrub(self, text: str) -> str:
+        redacted = _TOKEN.sub(MASK, text)
+        for secret in self._secrets:
+            redacted = redacted.replace(secret, MASK)
+        return redacted
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        redacted = self.scrub(message)
+        if redacted != message:
+            record.msg = redacted
+            record.args = None
+        return True
+
+
+BUFFER = RingBufferHandler()
+_rate_limit = RateLimitFilter()
+_redact = RedactFilter()
+add_secret = _redact.add_secret
+# Masks GitHub tokens and everything passed to add_secret
+scrub = _redact.scrub
+
+
+def setup(
+    level: Union[int, str] = logging.INFO,
+    capacity: int = 500,
+    burst: int = 5,
+    per: float = 10.0,
+) -> None:
+    """Send all logging to stdout and the ring buffer, call once at startup."""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    _rate_limit.burst = burst
+    _rate_limit.per = per
+    BUFFER.resize(capacity)
+    BUFFER.setLevel(level)
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setLevel(level)
+    stream.setFormatter(logging.Formatter(_FORMAT))
+    root = logging.getLogger()
+    for handler in (stream, BUFFER):
+        # Rate limit first, so a message's template is what gets counted
+        handler.addFilter(_rate_limit)
+        handler.addFilter(_redact)
+        root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,232 @@
+"""
+`dasdeployer.metrics`
+====================================================
+
+Lightweight metrics registry, served on localhost in the Prometheus text
+format.
+
+Metrics are created once, up front, and recording is just arithmetic on
+preallocated slots, so it's cheap enough for the 32 fps animation loop.
+A metric that is only ever updated from one thread (the render thread, the
+UI thread...) takes no lock at all. Pass `shared=True` for one updated
+from several threads and it takes a small lock of its own.
+
+Asking for a metric that already exists, with the same name and labels,
+returns the existing one, so modules can just ask for what they need.
+
+"""
+
+from __future__ import annotations
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+DEFAULT_PORT = 9101
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _NoLock:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *args: object) -> None:
+        return None
+
+
+_NO_LOCK = _NoLock()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str], **extra: str) -> str:
+    merged = {**labels, **extra}
+    if not merged:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for (name, value) in merged.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: dict[str, str], shared: bool) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock() if shared else _NO_LOCK
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: dict[str, str], shared: bool) -> None:
+        super(Counter, self).__init__(name, help, labels, shared)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: dict[str, str], shared: bool) -> None:
+        super(Gauge, self).__init__(name, help, labels, shared)
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        # A single store, no lock needed even when shared
+        self.value = value
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels)} {_format_value(self.value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: dict[str, str],
+        shared: bool,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super(Histogram, self).__init__(name, help, labels, shared)
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket plus one for anything bigger
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def samples(self) -> list[str]:
+        counts = list(self.counts)
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = _format_value(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, le=le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels)} {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: dict[tuple[str, tuple[tuple[str, str], ...]], _Metric] = {}
+
+    def _get(self, cls: type, name: str, help: str, labels: dict[str, str], shared: bool, **kwargs: object) -> _Metric:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(name, help, labels, shared, **kwargs)
+                self._metrics[key] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help: str, shared: bool = False, **labels: str) -> Counter:
+        return self._get(Counter, name, help, labels, shared)  # type: ignore[return-value]
+
+    def gauge(self, name: str, help: str, shared: bool = False, **labels: str) -> Gauge:
+        return self._get(Gauge, name, help, labels, shared)  # type: ignore[return-value]
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        shared: bool = False,
+        **labels: str,
+    ) -> Histogram:
+        return self._get(Histogram, name, help, labels, shared, buckets=buckets)  # type: ignore[return-value]
+
+    def exposition(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        seen = set()
+        for metric in sorted(metrics, key=lambda m: m.name):
+            if metric.name not in seen:
+                seen.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        # Scraped every few seconds, that's a lot of noise
+        pass
+
+
+class MetricsServer(threading.Thread):
+    def __init__(self, port: int = DEFAULT_PORT, host: str = "127.0.0.1", registry: Optional[Registry] = None) -> None:
+        super(MetricsServer, self).__init__()
+        self.daemon = True
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry or REGISTRY})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def stop(self, timeout: float | None = 10) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self.join(timeout)
+
+    def run(self) -> None:
+        self._server.serve_forever(poll_interval=0.5)
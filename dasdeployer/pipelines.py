@@ -1,21 +1,33 @@
 # from azure.devops.connection import Connection
 # from msrest.authentication import BasicAuthentication
 # from azure.devops.released.build import Build, BuildClient, BuildDefinition
-# from __future__ import annotations
+from __future__ import annotations
 
 from dataclasses import dataclass
 from enum import Enum
+import importlib
+import logging
 import threading
-from typing import TYPE_CHECKING, Any
-from github import Github, Auth
+import time
+from typing import TYPE_CHECKING, Any, Callable
+import breaker
+import metrics
+import ratelimit
+import tracing
 # from operator import attrgetter
 
 if TYPE_CHECKING:
+    from github import Github
     from local_settings import DasDeployerConfig
     from pycircleci.api import Api
     from azure.devops.connection import Connection
     from github.Repository import Repository
 
+log = logging.getLogger(__name__)
+
+# Longest wait between polls of a backend that keeps failing
+_MAX_BACKOFF = 300.0
+
 
 class QueryResultStatus(str, Enum):
     CHECKING = "Checking"
@@ -25,11 +37,56 @@ class QueryResultStatus(str, Enum):
     CANCELED = "Build canceled"
     PARTIAL = "Build partially succeeded"
 
-@dataclass
+class DeployStage(str, Enum):
+    QUEUED = "Queued"
+    DISPATCHED = "Dispatched"
+    RUN_FOUND = "Run found"
+    RUNNING = "Running"
+    TIMED_OUT = "Timed out"
+    FAILED = "Dispatch failed"
+    # Why a dispatch gave up before the timeout
+    NO_BRANCH = "No branch"
+    NOT_FOUND = "Run not found"
+
+
+# Where a deploy ends up when it didn't start a build
+GAVE_UP = frozenset({
+    DeployStage.TIMED_OUT,
+    DeployStage.FAILED,
+    DeployStage.NO_BRANCH,
+    DeployStage.NOT_FOUND,
+})
+
+# A build that's got to one of these won't change again, so isn't polled any more
+FINISHED = frozenset({
+    QueryResultStatus.SUCCEEDED,
+    QueryResultStatus.FAILED,
+    QueryResultStatus.CANCELED,
+    QueryResultStatus.PARTIAL,
+})
+
+
+# Frozen so the display never sees a build change under it, the poll
+# threads swap in a new one instead, see PollStatusThread._replace_build
+@dataclass(frozen=True)
 class BuildState:
     number: int
     result: str
 
+    @property
+    def finished(self) -> bool:
+        return self.result in FINISHED
+
+
+_BUILD_FIELDS = {
+    'Dev': 'build_dev',
+    'Test': 'build_tst',
+    'Stage': 'build_stage',
+    'Prod': 'build_prod',
+}
+# Held while swapping builds in a QueryResult, so a poll can't put back
+# the build a deploy has just replaced
+_builds_lock = threading.Lock()
 
 
 # class QueryResult():
@@ -69,6 +126,8 @@ class QueryResult:
     branch_tst: str | None = None
     branch_stage: str | None = None
     branch_prod: str | None = None
+    # The backend can't be reached, everything above is as it was last seen
+    stale = False
     changed = False
 
     def __setattr__(self, name: str, value: Any) -> None:
@@ -81,6 +140,31 @@ class QueryResult:
     def reset(self) -> None:
         super().__setattr__('changed', False)
 
+def api_calls(backend: str) -> metrics.Counter:
+    """Counter for requests a backend makes, from whichever thread makes them."""
+    return metrics.counter(
+        "dasdeployer_api_calls_total",
+        "Requests made to the CI and GitHub APIs",
+        shared=True,
+        backend=backend,
+    )
+
+
+def load_pipeline_class(pipeline_class: type | str) -> type:
+    """Resolve a config's `pipeline_class`.
+
+    Configs can name the class as a "module.Class" string instead of importing
+    it, so a backend (and its client library) is only imported when a project
+    that uses it is loaded.
+    """
+    if not isinstance(pipeline_class, str):
+        return pipeline_class
+    (module_name, _, class_name) = pipeline_class.rpartition('.')
+    if not module_name:
+        raise ValueError(f"pipeline_class should look like 'module.Class', not {pipeline_class!r}")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
 class Pipelines():
     _poll_thread: "PollStatusThread" | None
     config: DasDeployerConfig
@@ -96,10 +180,19 @@ class Pipelines():
 
     ):
         self._poll_thread = None
+        self._restarts = 0
+        self._restart_at = 0.0
         self.config = config
+        self.poll_interval = 10.0
+        self.refresh_interval: float | None = None
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_cancel: threading.Event | None = None
+        self._prefetched: dict[str, tuple[float, Any]] = {}
         self.last_result = QueryResult()
         self._poll_thread_class = poll_thread_class
         # self.connection = connection
+        # PyGithub takes a while to import on a Pi, so not until a project is loaded
+        from github import Github, Auth
         gh_auth = Auth.Token(config.github_pat)
         # github_args = {'login_or_token': config.github_pat}
         if config.github_url:
@@ -113,22 +206,139 @@ class Pipelines():
 
     def get_status(self) -> QueryResult:
         if self._poll_thread is None:
-            self._poll_thread = self._poll_thread_class(
-                config=self.config,
-                github_conn=self.github_conn,
-                last_result=self.last_result,
-                connection=self.connection,
-                interval=10,
-            )
-            self._poll_thread.start()
-        return self._poll_thread._last_result
-
-    def stop(self) -> None:
+            self._start_poll_thread()
+        elif not self._poll_thread.is_alive() and not self._poll_thread.stoprequest.is_set():
+            # Died of something the poll loop couldn't handle, start another
+            # one, backing off in case it dies again straight away
+            if time.monotonic() >= self._restart_at:
+                self._restarts += 1
+                log.error("Poll thread died, restarting it (%d so far)", self._restarts)
+                self._restart_at = time.monotonic() + min(self.poll_interval * 2 ** self._restarts, _MAX_BACKOFF)
+                self._start_poll_thread()
+        return self.last_result
+
+    def _start_poll_thread(self) -> None:
+        self._poll_thread = self._poll_thread_class(
+            config=self.config,
+            github_conn=self.github_conn,
+            last_result=self.last_result,
+            connection=self.connection,
+            interval=self.poll_interval,
+        )
+        self._poll_thread.refresh_interval = self.refresh_interval
+        self._poll_thread.start()
+
+    def set_poll_interval(self, interval: float) -> None:
+        # Picked up by the poll thread after its current wait
+        self.poll_interval = interval
         if self._poll_thread:
-            self._poll_thread.stop()
+            self._poll_thread.delay = interval
+
+    def set_refresh_interval(self, interval: float | None) -> None:
+        """How often to look at finished builds again, for runs started elsewhere.
 
-    def approve(self, approve_env: str, params: dict[str, str]) -> BuildState | None:
-        print("Approve env:" + approve_env)
+        None (the default) only looks once, on the first poll, so there's no
+        polling at all when nothing's deploying after that.
+        """
+        self.refresh_interval = interval
+        if self._poll_thread:
+            self._poll_thread.refresh_interval = interval
+
+    def stop(self, wait: bool = True) -> None:
+        if self._poll_thread:
+            if wait:
+                self._poll_thread.stop()
+            else:
+                # Finishes whatever request it's in the middle of on its own
+                self._poll_thread.stoprequest.set()
+                self._poll_thread.poke()
+
+    def source_branch(self, approve_env: str) -> str | None:
+        result = self.get_status()
+        return {
+            'Dev': result.branch_dev,
+            'Test': result.branch_tst,
+            'Stage': result.branch_stage,
+            'Prod': result.branch_prod,
+        }.get(approve_env)
+
+    def prefetch(self, approve_env: str) -> None:
+        """Start warming up what `approve` will need for `approve_env` in the background.
+
+        Called when a toggle goes up, so the lookups happen while the operator
+        is turning the keys rather than after the big button is pressed.
+        """
+        cancel = threading.Event()
+        with self._prefetch_lock:
+            if self._prefetch_cancel:
+                self._prefetch_cancel.set()
+            self._prefetch_cancel = cancel
+            self._prefetched.clear()
+        thread = threading.Thread(
+            target=self._run_prefetch,
+            args=(approve_env, cancel),
+            name=f"prefetch-{approve_env}",
+            daemon=True,
+        )
+        thread.start()
+
+    def cancel_prefetch(self) -> None:
+        with self._prefetch_lock:
+            if self._prefetch_cancel:
+                self._prefetch_cancel.set()
+            self._prefetch_cancel = None
+            self._prefetched.clear()
+
+    def _run_prefetch(self, approve_env: str, cancel: threading.Event) -> None:
+        try:
+            context = self._prefetch(approve_env, cancel)
+        except Exception as e:
+            # approve() will just do the lookups itself
+            log.warning("Prefetch for %s failed: %r", approve_env, e)
+            return
+        with self._prefetch_lock:
+            if context is not None and not cancel.is_set():
+                self._prefetched[approve_env] = (time.monotonic(), context)
+
+    def _set_build(self, approve_env: str, state: BuildState) -> None:
+        """Record the build a deploy to `approve_env` just started."""
+        field = _BUILD_FIELDS.get(approve_env)
+        if field is None:
+            return
+        with _builds_lock:
+            setattr(self.last_result, field, state)
+        if self._poll_thread:
+            # Start watching it now rather than after the rest of the wait
+            self._poll_thread.poke()
+
+    def _prefetch(self, approve_env: str, cancel: threading.Event) -> Any:
+        """Backends override this to return whatever `approve` can reuse, or None."""
+        return None
+
+    def _take_prefetched(self, approve_env: str, max_age: float = 120) -> Any:
+        with self._prefetch_lock:
+            entry = self._prefetched.pop(approve_env, None)
+        if entry is None:
+            return None
+        (fetched_at, context) = entry
+        if time.monotonic() - fetched_at > max_age:
+            return None
+        return context
+
+    def approve(
+        self,
+        approve_env: str,
+        params: dict[str, str],
+        progress: Callable[[DeployStage], None] | None = None,
+        timeout: float | None = None,
+    ) -> BuildState | None:
+        """Dispatch a deploy to `approve_env`.
+
+        `progress` is called with each `DeployStage` reached, and backends that
+        wait for the new run to show up give up after `timeout` seconds. When
+        it returns None, the last stage reported can say why.
+        """
+        log.info("Approve env: %s", approve_env)
         raise NotImplementedError
         # print("Approve env:" + approve_env)
         # # Get Release Client
@@ -167,17 +377,21 @@ class Pipelines():
 
 
 class PollStatusThread(threading.Thread):
+    # Label for this backend's metrics
+    backend = "pipelines"
+
     def __init__(
         self,
         config: DasDeployerConfig,
         github_conn: Github,
         connection: Api | Connection | Repository,
         last_result: QueryResult,
-        interval: int = 10
+        interval: float = 10
     ):
         super(PollStatusThread, self).__init__()
         self.daemon = True
         self.stoprequest = threading.Event()
+        self._poked = threading.Event()
         # self.pipelines = pipelines
 
         # self.regularInterval = interval
@@ -195,6 +409,41 @@ class PollStatusThread(threading.Thread):
         # # self._rm_client = self._connection.clients.get_release_client()
 
         self._last_result = last_result
+        self.budget = self._rate_budget()
+        self.breaker = self._circuit_breaker()
+        # Polls that have failed in a row
+        self.failures = 0
+        # Finished builds are looked at again this often, if at all
+        self.refresh_interval: float | None = None
+        # Set for the polls that should check finished builds too
+        self.refreshing = False
+        # None until the first refresh. The first poll always refreshes, whatever
+        # the interval, to pick up whatever ran before we started.
+        self._refreshed_at: float | None = None
+        self._api_calls = api_calls(self.backend)
+        self._poll_seconds = metrics.histogram(
+            "dasdeployer_poll_seconds",
+            "Time taken by one poll of the build status",
+            backend=self.backend,
+        )
+        self._poll_interval = metrics.gauge(
+            "dasdeployer_poll_interval_seconds",
+            "Wait before the next poll, stretched when the rate limit is running low",
+            backend=self.backend,
+        )
+
+    def _rate_budget(self) -> ratelimit.RateBudget:
+        """The budget for the token this backend's polls are made with."""
+        return ratelimit.for_token("github", self.config.github_pat)
+
+    def _circuit_breaker(self) -> breaker.CircuitBreaker:
+        """The breaker for the service this backend polls."""
+        return breaker.for_service(self.config.github_url or "https://api.github.com")
+
+    @property
+    def deploying(self) -> bool:
+        result = self._last_result
+        return result.deploying_dev or result.deploying_tst or result.deploying_stage or result.deploying_prod
 
     def start(self) -> None:
         self.stoprequest.clear()
@@ -202,8 +451,13 @@ class PollStatusThread(threading.Thread):
 
     def stop(self, timeout: float | None = 10) -> None:
         self.stoprequest.set()
+        self.poke()
         self.join(timeout)
 
+    def poke(self) -> None:
+        """Poll now rather than at the end of the current wait."""
+        self._poked.set()
+
     def join(self, timeout: float | None = 10) -> None:
         super(PollStatusThread, self).join(timeout)
         if self.is_alive():
@@ -212,6 +466,90 @@ class PollStatusThread(threading.Thread):
                 "PollStatusThread failed to die within %d seconds" % timeout)
 
     def run(self) -> None:
+        try:
+            while True:
+                started = time.monotonic()
+                calls_before = self._api_calls.value
+                if self.breaker.allow():
+                    self.refreshing = self._refreshed_at is None or (
+                        self.refresh_interval is not None
+                        and started - self._refreshed_at >= self.refresh_interval
+                    )
+                    with tracing.span("poll", "poll", backend=self.backend, refresh=self.refreshing):
+                        self._supervised_poll()
+                    if self.refreshing and not self.failures:
+                        self._refreshed_at = started
+                    self._poll_seconds.observe(time.monotonic() - started)
+                else:
+                    # Somebody else found the service down, don't pile on
+                    self._last_result.stale = True
+
+                # At the end of the thread execution, wait a bit and then poll again
+                delay = self._next_interval(self._api_calls.value - calls_before)
+                if self.failures:
+                    delay = max(delay, min(self.delay * 2 ** (self.failures - 1), _MAX_BACKOFF))
+                self._poll_interval.set(delay)
+                if self._wait(delay):
+                    break
+        finally:
+            if not self.stoprequest.is_set():
+                # Nobody's updating it any more
+                self._last_result.stale = True
+
+    def _next_interval(self, calls: float) -> float:
+        """Seconds until the next poll, after one that made `calls` requests."""
+        return self.budget.interval(self.delay, calls, deploying=self.deploying)
+
+    def _wait(self, delay: float) -> bool:
+        """Wait `delay` seconds or until poked, True if the thread's stopping."""
+        deadline = time.monotonic() + delay
+        while not self.stoprequest.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self._poked.wait(remaining):
+                self._poked.clear()
+                # Still honour a backoff the API asked for
+                deadline = time.monotonic() + self.budget.interval(0, 0)
+        return self.stoprequest.is_set()
+
+    def _current_build(self, environment: str) -> BuildState | None:
+        field = _BUILD_FIELDS.get(environment)
+        return getattr(self._last_result, field) if field else None
+
+    def _replace_build(self, environment: str, old: BuildState | None, new: BuildState | None) -> None:
+        """Swap `old` for `new` unless a deploy has replaced `old` meanwhile."""
+        field = _BUILD_FIELDS[environment]
+        with _builds_lock:
+            if getattr(self._last_result, field) is old:
+                setattr(self._last_result, field, new)
+
+    def _supervised_poll(self) -> None:
+        try:
+            self.poll_once()
+        except Exception as e:
+            backoff = ratelimit.retry_after(e)
+            if backoff is not None:
+                # Keep showing the last status until we're allowed back
+                self.budget.throttle(backoff)
+                self.breaker.release()
+                return
+            self.failures += 1
+            self.breaker.failure()
+            self._last_result.stale = True
+            if self.failures == 1:
+                log.warning("%s poll failed, showing the last status until it recovers", self.backend, exc_info=True)
+            else:
+                log.warning("%s poll failed %d times in a row: %r", self.backend, self.failures, e)
+            return
+        if self.failures:
+            log.info("%s poll recovered after %d failures", self.backend, self.failures)
+        self.failures = 0
+        self.breaker.success()
+        self._last_result.stale = False
+
+    def poll_once(self) -> None:
+        """Bring `_last_result` up to date, backends implement this."""
         raise NotImplementedError
         # while True:
         #     # Wait a bit then poll the server again
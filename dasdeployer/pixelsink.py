@@ -0,0 +1,77 @@
+"""
+`dasdeployer.pixelsink`
+====================================================
+
+Where the render thread in `rgb` sends finished frames.
+
+A sink only needs a `show(frame)` method taking a list of (r, g, b) tuples,
+one per pixel, already gamma corrected.
+
+* `NeoPixelSink` drives the real WS2812B strip and is the only code that
+  imports the Adafruit libraries, so everything else runs off the Pi.
+* `RecordingPixelSink` keeps the last N frames with timestamps in a
+  preallocated ring buffer, for benchmarks and for checking what the
+  animations actually drew.
+
+"""
+
+import time
+from array import array
+
+_OFF = (0, 0, 0)
+
+
+class NeoPixelSink:
+    def __init__(self, num_pixels, pin=None) -> None:
+        import board
+        import neopixel
+
+        if pin is None:
+            pin = board.D21  # NeoPixels must be connected to 10, 12, 18 or 21 to work.
+        self.pixels = neopixel.NeoPixel(
+            pin,
+            num_pixels,
+            # Brightness is done in the lookup tables so the driver doesn't need to scale
+            brightness=1,
+            auto_write=False,
+            pixel_order=neopixel.GRB  # The ones I purchased have red and green reversed
+        )
+
+    def show(self, frame) -> None:
+        self.pixels[:] = frame
+        self.pixels.show()
+
+
+class RecordingPixelSink:
+    def __init__(self, num_pixels, capacity=4096) -> None:
+        assert capacity > 0
+        self.num_pixels = num_pixels
+        self.capacity = capacity
+        # Everything is allocated up front so recording doesn't disturb the timing
+        self.timestamps = array('d', [0.0]) * capacity
+        self.frames = [[_OFF] * num_pixels for _ in range(capacity)]
+        self.count = 0
+
+    def show(self, frame) -> None:
+        i = self.count % self.capacity
+        self.frames[i][:] = frame
+        self.timestamps[i] = time.perf_counter()
+        self.count += 1
+
+    def clear(self) -> None:
+        self.count = 0
+
+    def recorded(self):
+        """Return the retained (timestamp, frame) pairs, oldest first."""
+        retained = min(self.count, self.capacity)
+        first = self.count - retained
+        return [
+            (self.timestamps[i % self.capacity], self.frames[i % self.capacity])
+            for i in range(first, self.count)
+        ]
+
+    @property
+    def last_frame(self):
+        if self.count == 0:
+            return None
+        return self.frames[(self.count - 1) % self.capacity]
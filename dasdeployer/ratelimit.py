@@ -0,0 +1,139 @@
+"""
+`dasdeployer.ratelimit`
+====================================================
+
+Request budgets for the rate limited APIs the backends talk to.
+
+There's one `RateBudget` per API token, shared by every project that uses
+the token. GitHub tells us how many requests are left and when the window
+resets in the headers of every response, and CircleCI just answers 429
+with a Retry-After once we've had too many, so a budget is fed from both.
+
+The poll threads ask their budget how long to wait before the next poll.
+What's left (less a reserve kept back for deploys) is spread evenly over
+the time until the reset, and polls never come faster than the configured
+interval. An environment that's deploying can dip into the reserve. When
+there's nothing left the poll waits for the reset instead of failing, so
+the box shows the last status it had rather than going blank.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import metrics
+
+# Requests kept back for dispatching deploys and watching them run
+_RESERVE = 50
+# How long to back off for when told to slow down without being told for how long
+_DEFAULT_BACKOFF = 60.0
+
+log = logging.getLogger(__name__)
+
+
+class RateBudget:
+    def __init__(self, api: str, reserve: int = _RESERVE, clock: Callable[[], float] = time.time) -> None:
+        self.api = api
+        self.reserve = reserve
+        # Wall clock, the reset times in the headers are epoch seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.remaining: Optional[int] = None
+        self.limit: Optional[int] = None
+        self.reset_at: Optional[float] = None
+        self.blocked_until = 0.0
+        self.exhausted = False
+        self._remaining_gauge = metrics.gauge(
+            "dasdeployer_rate_limit_remaining",
+            "Requests left in the current rate limit window",
+            api=api,
+        )
+
+    def update(self, remaining: int, limit: int, reset_at: float) -> None:
+        """Record the quota from the headers of the latest response."""
+        if remaining < 0:
+            # PyGithub's way of saying it hasn't seen any headers yet
+            return
+        with self._lock:
+            self.remaining = remaining
+            self.limit = limit
+            self.reset_at = reset_at
+        self._remaining_gauge.set(remaining)
+
+    def throttle(self, seconds: float) -> None:
+        """The API said to slow down, make no more requests for `seconds`."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, self._clock() + seconds)
+        log.warning("%s is throttling us, backing off for %.0fs", self.api, seconds)
+
+    def interval(self, base: float, calls: float, deploying: bool = False) -> float:
+        """Seconds until the next poll that makes about `calls` requests.
+
+        Never less than `base`, the interval we'd poll at with quota to spare.
+        """
+        now = self._clock()
+        with self._lock:
+            if self.blocked_until > now:
+                return max(base, self.blocked_until - now)
+            if self.remaining is None or self.reset_at is None or calls <= 0:
+                return base
+            until_reset = max(self.reset_at - now, 1.0)
+            remaining = self.remaining
+            # Down to the reserve, only deploys get to spend any more
+            exhausted = remaining - self.reserve < calls
+            was_exhausted = self.exhausted
+            self.exhausted = exhausted
+        if exhausted != was_exhausted:
+            if exhausted:
+                log.warning("%s quota down to %d, slowing polls until it resets", self.api, remaining)
+            else:
+                log.info("%s quota back to %d", self.api, remaining)
+        spendable = remaining if deploying else remaining - self.reserve
+        if spendable < calls:
+            return max(base, until_reset)
+        return max(base, until_reset * calls / spendable)
+
+
+_budgets: dict[tuple[str, str], RateBudget] = {}
+_budgets_lock = threading.Lock()
+
+
+def for_token(api: str, token: str) -> RateBudget:
+    """Get the budget for `token`, every project using the same token shares it."""
+    # Keyed on a digest so the token itself isn't kept around any longer
+    key = (api, hashlib.sha256(token.encode()).hexdigest())
+    with _budgets_lock:
+        if key not in _budgets:
+            _budgets[key] = RateBudget(api)
+        return _budgets[key]
+
+
+def retry_after(error: BaseException, clock: Callable[[], float] = time.time) -> Optional[float]:
+    """Seconds to back off for if `error` is an API saying slow down, otherwise None.
+
+    Understands PyGithub's exceptions (status and headers on the exception)
+    and requests' HTTPError, which is what pycircleci raises.
+    """
+    status = getattr(error, "status", None)
+    headers: Any = getattr(error, "headers", None)
+    response = getattr(error, "response", None)
+    if response is not None and hasattr(response, "status_code"):
+        status = response.status_code
+        headers = response.headers
+    if status not in (403, 429):
+        return None
+    headers = {name.lower(): value for (name, value) in dict(headers or {}).items()}
+    try:
+        if "retry-after" in headers:
+            return max(float(headers["retry-after"]), 1.0)
+        if headers.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in headers:
+            return max(float(headers["x-ratelimit-reset"]) - clock(), 1.0)
+    except ValueError:
+        pass
+    # A 403 that doesn't say anything about the rate limit is a real 403
+    return _DEFAULT_BACKOFF if status == 429 else None
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Record and replay CI API traffic, for soak tests.
+
+record: a proxy to the real GitHub or CircleCI API. Point a project's
+    github_url (or circle_url, with /api on the end) at it and use the
+    deployer as normal. Each response is appended to a gzipped JSON lines
+    recording with the time it came back. Tokens never get as far as the
+    recording: request headers aren't kept, the tokens the deployer sends
+    are masked anywhere they show up in a response, and anything that
+    looks like a GitHub token is masked too. A response that's the same as
+    the last one for that request only keeps its headers.
+
+replay: serves recordings back with virtual time running `--speed` times
+    faster, so every request gets the response that was recorded at that
+    point in the day. The rate limit reset times are shifted to match, and
+    the recording loops when virtual time runs off the end of it.
+
+soak: replays recordings to the real deployer on the fake hardware from
+    bench_e2e.py, using the projects in local_settings, with the poll
+    interval shrunk by the same factor. The deploys in the recording are
+    made again at the same virtual times. CPU, memory and thread counts
+    are sampled throughout and written out as JSON.
+
+Example:
+    ./replay.py record --upstream https://api.github.com --port 8301 --out github.jsonl.gz
+    ./replay.py soak github.jsonl.gz --speed 100 --days 7 --json soak.json
+"""
+
+import argparse
+import base64
+import bisect
+import gzip
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import logs
+from pipelines import GAVE_UP
+
+FORMAT = 1
+# Stands in for wherever the recording is being served from
+BASE = "{base}"
+# Response headers worth keeping, everything else is noise or per connection
+_KEEP_HEADERS = (
+    "content-type", "link", "location", "retry-after",
+    "x-ratelimit-limit", "x-ratelimit-remaining", "x-ratelimit-reset",
+    "x-ratelimit-used", "x-ratelimit-resource",
+)
+# Dropped from the request before it goes upstream
+_HOP_HEADERS = ("host", "connection", "keep-alive", "accept-encoding", "content-length", "transfer-encoding")
+_SECRET_QUERY = re.compile(r"((?:circle-)?token=)[^&]+", re.IGNORECASE)
+# Requests that start a deploy, with the GitHub workflow if there is one
+_DEPLOY = re.compile(r"/actions/workflows/([^/]+)/dispatches$|/project/[^/]+/[^/]+/[^/]+/pipeline$")
+_SOAK_METRICS_EVERY = 5.0
+
+
+# Recording
+
+class Recorder:
+    def __init__(self, path, upstream, flush_every=50):
+        self.upstream = upstream.rstrip("/")
+        self.started = time.time()
+        self._file = gzip.open(path, "wt", compresslevel=9)
+        self._lock = threading.Lock()
+        self._last_body = {}
+        self._unflushed = 0
+        self.flush_every = flush_every
+        self.entries = 0
+        self._write({"format": FORMAT, "started": self.started, "upstream": self.upstream})
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def record(self, method, path, status, headers, body):
+        entry = {
+            "t": round(time.time() - self.started, 3),
+            "method": method,
+            "path": _SECRET_QUERY.sub(r"\1" + logs.MASK, logs.scrub(path)),
+            "status": status,
+            "headers": {name: logs.scrub(value.replace(self.upstream, BASE)) for (name, value) in headers.items()},
+        }
+        body = logs.scrub(body.replace(self.upstream, BASE))
+        key = (method, entry["path"])
+        with self._lock:
+            if self._last_body.get(key) == body:
+                entry["same"] = True
+            else:
+                entry["body"] = body
+                self._last_body[key] = body
+            self._write(entry)
+            self.entries += 1
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._file.flush()
+                self._unflushed = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _tokens(headers):
+    """The API tokens in a request's headers, so they can be masked in what comes back."""
+    found = []
+    if headers.get("Circle-Token"):
+        found.append(headers["Circle-Token"])
+    authorization = headers.get("Authorization", "")
+    (scheme, _, credential) = authorization.partition(" ")
+    if scheme.lower() in ("token", "bearer"):
+        found.append(credential)
+    elif scheme.lower() == "basic":
+        try:
+            # pycircleci sends the token as the user name
+            found.extend(base64.b64decode(credential).decode().split(":"))
+        except ValueError:
+            pass
+    return [token for token in found if token]
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _proxy(self):
+        recorder = self.server.recorder
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length) if length else None
+        for token in _tokens(self.headers):
+            logs.add_secret(token)
+        headers = {
+            name: value for (name, value) in self.headers.items()
+            if name.lower() not in _HOP_HEADERS
+        }
+        request = urllib.request.Request(recorder.upstream + self.path, data=data, headers=headers, method=self.command)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                (status, reply_headers, body) = (response.status, response.headers, response.read())
+        except urllib.error.HTTPError as e:
+            (status, reply_headers, body) = (e.code, e.headers, e.read())
+        except OSError as e:
+            self.send_error(502, str(e))
+            return
+        kept = {name.lower(): value for (name, value) in reply_headers.items() if name.lower() in _KEEP_HEADERS}
+        text = body.decode("utf-8", errors="replace")
+        recorder.record(self.command, self.path, status, kept, text)
+
+        # The client gets the real thing, with links pointing back through us
+        own = f"http://{self.headers.get('Host', '%s:%d' % self.server.server_address)}"
+        body = text.replace(recorder.upstream, own).encode()
+        self.send_response(status)
+        for (name, value) in kept.items():
+            self.send_header(name, value.replace(recorder.upstream, own))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _proxy
+
+
+def record(args):
+    recorder = Recorder(args.out, args.upstream)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), _ProxyHandler)
+    server.daemon_threads = True
+    server.recorder = recorder
+    print(f"Recording {args.upstream} on http://127.0.0.1:{server.server_address[1]} to {args.out}, ^C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        recorder.close()
+    print(f"Recorded {recorder.entries} responses over {time.time() - recorder.started:.0f}s")
+
+
+# Replay
+
+def load(path):
+    """Read a recording, returning its header and its entries with every body filled in."""
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT:
+            raise ValueError(f"{path} is format {header.get('format')}, expected {FORMAT}")
+        entries = []
+        last_body = {}
+        for line in f:
+            entry = json.loads(line)
+            key = (entry["method"], entry["path"])
+            if entry.pop("same", False):
+                entry["body"] = last_body[key]
+            last_body[key] = entry["body"]
+            entry["started"] = header["started"]
+            entries.append(entry)
+    return (header, entries)
+
+
+class ReplayServer:
+    """Serves recordings back with virtual time running `speed` times faster."""
+
+    def __init__(self, paths, speed=100.0, loop=True):
+        self.speed = speed
+        self.loop = loop
+        self.requests = 0
+        self.misses = 0
+        self.entries = []
+        for path in paths:
+            self.entries.extend(load(path)[1])
+        self.entries.sort(key=lambda entry: entry["t"])
+        self.duration = max((entry["t"] for entry in self.entries), default=0) or 1.0
+        # Exact request first, then the same path with any query, the dates
+        # in the workflow run searches won't match on another day
+        self._exact = {}
+        self._by_path = {}
+        for entry in self.entries:
+            self._exact.setdefault((entry["method"], entry["path"]), []).append(entry)
+            self._by_path.setdefault((entry["method"], urlsplit(entry["path"]).path), []).append(entry)
+        self._times = {key: [entry["t"] for entry in entries] for (key, entries) in self._exact.items()}
+        self._path_times = {key: [entry["t"] for entry in entries] for (key, entries) in self._by_path.items()}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _ReplayHandler)
+        self.server.daemon_threads = True
+        self.server.replay = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._started = time.monotonic()
+
+    def start(self):
+        self._started = time.monotonic()
+        threading.Thread(target=self.server.serve_forever, name="replay", daemon=True).start()
+
+    @property
+    def elapsed(self):
+        """Virtual seconds since the replay started, not wrapped."""
+        return (time.monotonic() - self._started) * self.speed
+
+    @property
+    def now(self):
+        """Virtual seconds into the recording."""
+        elapsed = self.elapsed
+        return elapsed % self.duration if self.loop else elapsed
+
+    def deploys(self):
+        """(virtual time, GitHub workflow or None) for each deploy in the recordings."""
+        found = []
+        for entry in self.entries:
+            match = _DEPLOY.search(urlsplit(entry["path"]).path)
+            if entry["method"] == "POST" and match:
+                found.append((entry["t"], match.group(1)))
+        return found
+
+    def lookup(self, method, path):
+        now = self.now
+        for (index, times, key) in (
+            (self._exact, self._times, (method, path)),
+            (self._by_path, self._path_times, (method, urlsplit(path).path)),
+        ):
+            if key in index:
+                # The latest response by now, or the first if it hasn't happened yet
+                i = max(bisect.bisect_right(times[key], now) - 1, 0)
+                return index[key][i]
+        return None
+
+    def respond(self, entry):
+        """Status, headers and body for `entry` as if it were happening now."""
+        now = self.now
+        headers = {name: value.replace(BASE, self.url) for (name, value) in entry["headers"].items()}
+        if "x-ratelimit-reset" in headers:
+            # The reset is as far away in virtual time as it was when recorded
+            until_reset = float(headers["x-ratelimit-reset"]) - entry["started"] - now
+            headers["x-ratelimit-reset"] = str(int(time.time() + max(until_reset, 0) / self.speed))
+        return (entry["status"], headers, entry["body"].replace(BASE, self.url).encode())
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _replay(self):
+        replay = self.server.replay
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        entry = replay.lookup(self.command, self.path)
+        with replay._lock:
+            replay.requests += 1
+            if entry is None:
+                replay.misses += 1
+        if entry is None:
+            (status, headers, body) = (404, {"content-type": "application/json"}, b'{"message": "Not Found"}')
+        else:
+            (status, headers, body) = replay.respond(entry)
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _replay
+
+
+def replay(args):
+    server = ReplayServer(args.recordings, args.speed, loop=not args.once)
+    server.start()
+    print(f"Replaying {len(server.entries)} responses over {server.duration:.0f}s at {args.speed}x on {server.url}, ^C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    print(f"Served {server.requests} requests, {server.misses} not in the recording")
+
+
+# Soak test
+
+def _rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # Peak rather than current, but better than nothing off Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _environment_for(config, workflow):
+    for (environment, configured) in getattr(config, "gha_workflows", {}).items():
+        if workflow is not None and str(configured) == workflow:
+            return environment
+    return "Dev"
+
+
+def _redeploy(rig, environment):
+    """Go through a deploy as an operator would, returning whether it was confirmed."""
+    from bench_e2e import armed_text
+
+    toggle = rig.toggle(environment)
+    started = time.perf_counter()
+    toggle.pin.drive_high()
+    try:
+        rig.wait_lcd(started, "Turn Keys")
+        since = rig.turn_keys()
+        rig.wait_lcd(since, armed_text(environment))
+        since = time.perf_counter()
+        rig.press(rig.dd.big_button)
+        outcomes = {f"triggered to {environment}": True, **{stage.value: False for stage in GAVE_UP}}
+        outcome = []
+
+        def finished():
+            for (stamp, message) in reversed(rig.lcd_log):
+                if stamp < since:
+                    return False
+                outcome.extend(result for (text, result) in outcomes.items() if text in message)
+                if outcome:
+                    return True
+            return False
+        rig.wait(finished, f"the deploy to {environment}")
+        return outcome[0]
+    except TimeoutError as e:
+        print(f"Deploy to {environment} failed: {e}", file=sys.stderr)
+        return False
+    finally:
+        toggle.pin.drive_low()
+
+
+def soak(args):
+    import importlib
+    import tempfile
+    from dataclasses import replace
+
+    from bench_e2e import Rig
+
+    server = ReplayServer(args.recordings, args.speed)
+    settings = importlib.import_module("local_settings")
+    configs = []
+    for config in settings.DAS_CONFIGS:
+        changes = {"github_url": server.url}
+        if hasattr(config, "circle_url"):
+            changes["circle_url"] = f"{server.url}/api"
+        configs.append(replace(config, **changes))
+    settings.DAS_CONFIGS = configs
+    settings.CONTROL_SOCKET = os.path.join(tempfile.mkdtemp(prefix="soak-"), "control.sock")
+    settings.METRICS_PORT = None
+    settings.LOG_LEVEL = "WARNING"
+
+    rig = Rig(settings)
+    # Polls as often in virtual time as they would in real time
+    rig.dd.POLL_INTERVAL = rig.dd.POLL_INTERVAL / args.speed
+    config = configs[args.project]
+    deploys = server.deploys()
+    virtual_seconds = args.days * 24 * 3600
+    server.start()
+    rig.start()
+    if len(configs) > 1:
+        rig.select_project(args.project)
+
+    samples = []
+    outcomes = {"confirmed": 0, "failed": 0}
+    next_deploy = 0
+    wrapped = 0
+    last_sample = (time.perf_counter(), time.process_time())
+    started = last_sample[0]
+    while server.elapsed < virtual_seconds:
+        if next_deploy < len(deploys) and server.elapsed - wrapped >= deploys[next_deploy][0]:
+            (_, workflow) = deploys[next_deploy]
+            next_deploy += 1
+            confirmed = _redeploy(rig, _environment_for(config, workflow))
+            outcomes["confirmed" if confirmed else "failed"] += 1
+        elif server.elapsed - wrapped >= server.duration:
+            # Round the recording again
+            wrapped += server.duration
+            next_deploy = 0
+        now = (time.perf_counter(), time.process_time())
+        if now[0] - last_sample[0] >= _SOAK_METRICS_EVERY:
+            samples.append({
+                "seconds": round(now[0] - started, 1),
+                "virtual_hours": round(server.elapsed / 3600, 2),
+                "cpu_percent": round((now[1] - last_sample[1]) / (now[0] - last_sample[0]) * 100, 1),
+                "rss_kb": _rss_kb(),
+                "threads": threading.active_count(),
+                "lcd_messages": len(rig.lcd_log),
+            })
+            last_sample = now
+        time.sleep(0.05)
+
+    rss = [sample["rss_kb"] for sample in samples] or [_rss_kb()]
+    threads = [sample["threads"] for sample in samples] or [threading.active_count()]
+    cpu = [sample["cpu_percent"] for sample in samples] or [0.0]
+    report = {
+        "benchmark": "soak",
+        "version": rig.dd.__version__,
+        "recordings": args.recordings,
+        "speed": args.speed,
+        "virtual_days": args.days,
+        "seconds": round(time.perf_counter() - started, 1),
+        "summary": {
+            "rss_start_kb": rss[0],
+            "rss_end_kb": rss[-1],
+            "rss_max_kb": max(rss),
+            "threads_start": threads[0],
+            "threads_max": max(threads),
+            "cpu_mean_percent": round(sum(cpu) / len(cpu), 1),
+            "deploys": outcomes,
+            "api_requests": server.requests,
+            "api_misses": server.misses,
+        },
+        "samples": samples,
+    }
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report["summary"], indent=2))
+    sys.stdout.flush()
+    # gpiozero and the deployer leave threads behind that aren't worth unwinding
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record CI API traffic and replay it faster than real time.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    recording = commands.add_parser('record', help='Proxy to a real API and record the responses')
+    recording.add_argument('--upstream', required=True, help='API to proxy, e.g. https://api.github.com')
+    recording.add_argument('--port', type=int, default=8301, help='Port to listen on, localhost only')
+    recording.add_argument('--out', required=True, help='Recording to write, .jsonl.gz')
+    recording.set_defaults(run=record)
+
+    replaying = commands.add_parser('replay', help='Serve recordings with time compressed')
+    replaying.add_argument('recordings', nargs='+', help='Recordings to serve together')
+    replaying.add_argument('--speed', type=float, default=100, help='Virtual seconds per real second')
+    replaying.add_argument('--once', action='store_true', help="Don't loop when the recording runs out")
+    replaying.set_defaults(run=replay)
+
+    soaking = commands.add_parser('soak', help='Run the deployer against recordings on fake hardware')
+    soaking.add_argument('recordings', nargs='+', help='Recordings to serve together')
+    soaking.add_argument('--speed', type=float, default=100, help='Virtual seconds per real second')
+    soaking.add_argument('--days', type=float, default=7, help='Virtual days to run for')
+    soaking.add_argument('--project', type=int, default=0, help='Index of the project in DAS_CONFIGS')
+    soaking.add_argument('--json', dest='json_path', help='Write the samples to this file')
+    soaking.set_defaults(run=soak)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,18 +17,21 @@ inside the button.
 **Software and Dependencies:**
 
 * Adafruit_CircuitPython_NeoPixel https://github.com/adafruit/Adafruit_CircuitPython_NeoPixel
+  (only needed by `pixelsink.NeoPixelSink`, pass another sink to run off the Pi)
 
 """
 
-import neopixel
-import board
+import queue
 import threading
+import time
 from enum import Enum
+from pixelsink import NeoPixelSink
+import metrics
+import tracing
 
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/martinwoodward/DasDeployer.git"
 
-_PIXEL_PIN = board.D21  # NeoPixels must be connected to 10, 12, 18 or 21 to work.
 _RING_PIXELS = 32
 _BUTTON_PIXELS = 8
 _KEY_PIXELS = 16
@@ -41,8 +44,12 @@ _RING_RANGE = slice(_RING_START, _RING_END)
 _BUTTON_RANGE = slice(_BUTTON_START, _BUTTON_END)
 _KEY1_RANGE = slice(_KEY1_START, _KEY1_END)
 _KEY2_RANGE = slice(_KEY2_START, _KEY2_END)
-
-_ORDER = neopixel.GRB  # The ones I purchased have red and green reversed
+_SEGMENTS = {
+    "ring": _RING_RANGE,
+    "button": _BUTTON_RANGE,
+    "key1": _KEY1_RANGE,
+    "key2": _KEY2_RANGE,
+}
 
 
 class Color:
@@ -63,288 +70,330 @@ class AnimationType(Enum):
     FILL = 5
 
 
+def wheel(pos):
+    # Taken from the Adafruit Neopixel example code.
+    # Input a value 0 to 255 to get a color value.
+    # The colours are a transition r - g - b - back to r.
+    if pos < 0 or pos > 255:
+        r = g = b = 0
+    elif pos < 85:
+        r = int(pos * 3)
+        g = int(255 - pos * 3)
+        b = 0
+    elif pos < 170:
+        pos -= 85
+        r = int(255 - pos * 3)
+        g = 0
+        b = int(pos * 3)
+    else:
+        pos -= 170
+        r = 0
+        g = int(pos * 3)
+        b = int(255 - pos * 3)
+
+    return (r, g, b)
+
+
+# The unicorn animation only ever needs these 256 colors
+_WHEEL = [wheel(pos) for pos in range(256)]
+
+
+def _gamma_table(brightness, gamma, scale=255):
+    # 256 entry lookup from linear 0-255 channel values to corrected output values
+    table = [round(((i / 255) ** gamma) * brightness * scale) for i in range(256)]
+    if brightness > 0:
+        # Dimmed right down the low levels would round to off, and a chase's tail
+        # would vanish, so anything lit stays at least one step lit
+        step = scale // 255
+        table[1:] = [max(level, step) for level in table[1:]]
+    return table
+
+
+# Effects that are worth holding still when the Pi is running hot
+_COMPLEX_ANIMATIONS = (AnimationType.UNICORN, AnimationType.CHASE)
+
+
 class RGBButton():
-    def __init__(self, brightness=1, ring_brightness=0.2, fps=32) -> None:
+    """Front end for the LED matrix.
+
+    Every method posts a command to the render thread, which owns the pixels
+    and applies commands at the next frame boundary, so callers (typically
+    gpiozero callbacks) never block on the animation or write to the pixel
+    buffer themselves.
+
+    Colors are always given at full scale. Brightness and gamma correction are
+    applied per segment from lookup tables as the frame is written out.
+    """
+
+    def __init__(
+        self, brightness=1, ring_brightness=0.2, fps=32, gamma=2.2, dither=False, sink=None
+    ) -> None:
         assert 0 <= brightness <= 1
         assert 0 <= ring_brightness <= 1
         assert fps > 0
+        assert gamma > 0
         self.brightness = brightness
         self.ring_brightness = ring_brightness
+        self.gamma = gamma
         self.delay = 1 / fps
-        self.pixels = neopixel.NeoPixel(
-            _PIXEL_PIN,
-            _NUM_PIXELS,
-            brightness=self.brightness,
-            auto_write=False,
-            pixel_order=_ORDER
-        )
-        self._animate_thread = None
+        if sink is None:
+            sink = NeoPixelSink(_NUM_PIXELS)
+        self.sink = sink
+        # Ring appears brighter to the eye than the button so reduce intensity of the LEDS
+        ring_brightness = self.brightness * self.ring_brightness
+        segment_brightness = {
+            "ring": ring_brightness,
+            "button": self.brightness,
+            "key1": ring_brightness,
+            "key2": ring_brightness,
+        }
+        luts = {
+            segment: _gamma_table(level, gamma)
+            for (segment, level) in segment_brightness.items()
+        }
+        fine_luts = None
+        if dither:
+            # 8.8 fixed point so the fractional part can be carried between frames
+            fine_luts = {
+                segment: _gamma_table(level, gamma, scale=255 * 256)
+                for (segment, level) in segment_brightness.items()
+            }
+        self._animate_thread = AnimateThread(self.sink, luts, self.delay, fine_luts)
+        self._animate_thread.start()
+
+    def close(self, timeout=10):
+        """Stop the render thread. Only needed when shutting down."""
+        self._animate_thread.stop(timeout)
+
+    def _post(self, **animations):
+        # All segments in one post are applied in the same frame
+        self._animate_thread.post(animations)
+
+    def set_fps(self, fps):
+        assert fps > 0
+        self._animate_thread.call(self._animate_thread.set_delay, 1 / fps)
+
+    def limit_fps(self, fps=None):
+        """Cap the frame rate whatever `set_fps` asks for, None removes the cap."""
+        assert fps is None or fps > 0
+        min_delay = 0 if fps is None else 1 / fps
+        self._animate_thread.call(self._animate_thread.set_min_delay, min_delay)
+
+    def simplify(self, simple=True):
+        """Hold the per pixel effects (unicorn, chase) still instead of animating them."""
+        self._animate_thread.call(self._animate_thread.set_simple, simple)
+
+    def suspend(self, *segments):
+        """Blank and stop rendering the given segments ("ring", "button", "key1",
+        "key2") until `resume`. Their animations are kept and carry on afterwards.
+        """
+        self._animate_thread.call(self._animate_thread.suspend, segments)
+
+    def resume(self):
+        self._animate_thread.call(self._animate_thread.resume)
 
     def off(self):
-        self._animate_stop()
-        self.pixels.fill(Color.OFF)
-        self.pixels.show()
+        self._post(
+            ring=_fill(Color.OFF),
+            button=_fill(Color.OFF),
+            key1=_fill(Color.OFF),
+            key2=_fill(Color.OFF)
+        )
 
     def fill(self, color):
-        self._animate_stop()
-        # Ring appears brighter to the eye than the button so reduce intensity of the LEDS
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self.pixels[_RING_RANGE] = [ring_color] * _RING_PIXELS
-        self.pixels[_BUTTON_RANGE] = [color] * _BUTTON_PIXELS
-        self.pixels[_KEY1_RANGE] = [ring_color] * _KEY_PIXELS
-        self.pixels[_KEY2_RANGE] = [ring_color] * _KEY_PIXELS
-        self.pixels.show()
+        self._post(
+            ring=_fill(color),
+            button=_fill(color),
+            key1=_fill(color),
+            key2=_fill(color)
+        )
 
     def fillButton(self, color) -> None:
-        self._animate_stop()
-        self.pixels[_BUTTON_RANGE] = [color] * _BUTTON_PIXELS
-        self.pixels.show()
+        self._post(button=_fill(color))
 
     def fillRing(self, color) -> None:
-        self._animate_stop()
-        # Ring appears brighter to the eye than the button so reduce intensity of the LEDS
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self.pixels[_RING_RANGE] = [ring_color] * _RING_PIXELS
-        self.pixels.show()
+        self._post(ring=_fill(color))
 
     def fillKey1(self, color):
-        self._animate_stop()
-        # Ring appears brighter to the eye than the button so reduce intensity of the LEDS
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self.pixels[_KEY1_RANGE] = [ring_color] * _KEY_PIXELS
-        self.pixels.show()
+        self._post(key1=_fill(color))
 
     def fillKey2(self, color):
-        self._animate_stop()
-        # Ring appears brighter to the eye than the button so reduce intensity of the LEDS
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self.pixels[_KEY2_RANGE] = [ring_color] * _KEY_PIXELS
-        self.pixels.show()
-
-    def _animate_stop(self):
-        if getattr(self, '_animate_thread', None):
-            self._animate_thread.stop()
-        self._animate_thread = None
-
-    def _animate_start(self):
-        if self._animate_thread is None:
-            self._animate_thread = AnimateThread(self.pixels, self.ring_brightness, self.delay)
-            self._animate_thread.start()
+        self._post(key2=_fill(color))
 
     def pulseButton(self, color=Color.WHITE, duration=1) -> None:
-        self._animate_start()
-        self._animate_thread.button_animation = {
+        self._post(button={
             "type": AnimationType.PULSE,
             "color": color,
             "duration": duration
-        }
+        })
 
     def flashButton(self, color=Color.WHITE, duration=1):
-        self._animate_start()
-        self._animate_thread.button_animation = {
+        self._post(button={
             "type": AnimationType.FLASH,
             "color": color, "duration": duration
-        }
+        })
 
     def stopButton(self):
-        if self._animate_thread is not None:
-            if (
-                self._animate_thread.ring_animation is None
-                and
-                self._animate_thread.key1_animation is None
-                and
-                self._animate_thread.key2_animation is None
-            ):
-                self._animate_stop()
-            else:
-                self._animate_thread.button_animation = None
-        self.pixels[_BUTTON_RANGE] = [Color.OFF] * _BUTTON_PIXELS
-        self.pixels.show()
+        self._post(button=_fill(Color.OFF))
 
     def unicornRing(self, duration=25) -> None:
-        self._animate_start()
-        self._animate_thread.ring_animation = {
+        self._post(ring={
             "type": AnimationType.UNICORN,
             "color": Color.OFF,
             "duration": duration
-        }
+        })
 
     def pulseRing(self, color=(0, 0, 100), duration=2.5) -> None:
-        self._animate_start()
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self._animate_thread.ring_animation = {
+        self._post(ring={
             "type": AnimationType.PULSE,
-            "color": ring_color,
+            "color": color,
             "duration": duration
-        }
+        })
 
     def chaseRing(self, color=(0, 0, 255), duration=5) -> None:
-        self._animate_start()
-        self._animate_thread.ring_animation = {
+        self._post(ring={
             "type": AnimationType.CHASE,
             "color": color,
             "duration": duration
-        }
+        })
 
     def flashRing(self, color=(0, 0, 100), duration=2.5):
-        self._animate_start()
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self._animate_thread.ring_animation = {
+        self._post(ring={
             "type": AnimationType.FLASH,
-            "color": ring_color,
+            "color": color,
             "duration": duration
-        }
+        })
 
     def stopRing(self) -> None:
-        if self._animate_thread is not None:
-            if (
-                self._animate_thread.button_animation is None
-                and
-                self._animate_thread.key1_animation is None
-                and
-                self._animate_thread.key2_animation is None
-            ):
-                self._animate_stop()
-            else:
-                self._animate_thread.ring_animation = None
-        self.pixels[_RING_RANGE] = [Color.OFF] * _RING_PIXELS
-        self.pixels.show()
+        self._post(ring=_fill(Color.OFF))
 
     def stopKey1(self) -> None:
-        if self._animate_thread is not None:
-            if (
-                self._animate_thread.button_animation is None
-                and
-                self._animate_thread.ring_animation is None
-                and
-                self._animate_thread.key2_animation is None
-            ):
-                self._animate_stop()
-            else:
-                self._animate_thread.key1_animation = None
-        self.pixels[_KEY1_RANGE] = [Color.OFF] * _KEY_PIXELS
-        self.pixels.show()
+        self._post(key1=_fill(Color.OFF))
 
     def stopKey2(self) -> None:
-        if self._animate_thread is not None:
-            if (
-                self._animate_thread.button_animation is None
-                and
-                self._animate_thread.ring_animation is None
-                and
-                self._animate_thread.key1_animation is None
-            ):
-                self._animate_stop()
-            else:
-                self._animate_thread.key2_animation = None
-        self.pixels[_KEY2_RANGE] = [Color.OFF] * _KEY_PIXELS
-        self.pixels.show()
+        self._post(key2=_fill(Color.OFF))
 
     def chaseKey1(self, color=(0, 0, 255), duration=5) -> None:
-        self._animate_start()
-        self._animate_thread.key1_animation = {
+        self._post(key1={
             "type": AnimationType.CHASE,
             "color": color,
             "duration": duration
-        }
+        })
 
     def chaseKey2(self, color=(0, 0, 255), duration=5) -> None:
-        self._animate_start()
-        self._animate_thread.key2_animation = {
+        self._post(key2={
             "type": AnimationType.CHASE,
             "color": color,
             "duration": duration
-        }
+        })
 
     def flashKey1(self, color=(0, 0, 100), duration=2.5):
-        self._animate_start()
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self._animate_thread.key1_animation = {
+        self._post(key1={
             "type": AnimationType.FLASH,
-            "color": ring_color,
+            "color": color,
             "duration": duration
-        }
+        })
 
     def flashKey2(self, color=(0, 0, 100), duration=2.5):
-        self._animate_start()
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self._animate_thread.key2_animation = {
+        self._post(key2={
             "type": AnimationType.FLASH,
-            "color": ring_color,
+            "color": color,
             "duration": duration
-        }
+        })
 
     def pulseKey1(self, color=Color.WHITE, duration=1) -> None:
-        self._animate_start()
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self._animate_thread.key1_animation = {
+        self._post(key1={
             "type": AnimationType.PULSE,
-            "color": ring_color,
+            "color": color,
             "duration": duration
-        }
+        })
 
     def pulseKey2(self, color=Color.WHITE, duration=1) -> None:
-        self._animate_start()
-        ring_color = tuple(int(c * self.ring_brightness) for c in color)
-        self._animate_thread.key2_animation = {
+        self._post(key2={
             "type": AnimationType.PULSE,
-            "color": ring_color,
+            "color": color,
             "duration": duration
-        }
+        })
+
+
+def _fill(color):
+    return {"type": AnimationType.FILL, "color": color}
+
+
+# Only the render thread records these. Jitter is the spread of the intervals
+# and fps is the rate of frames, both worked out by whatever scrapes them.
+_frames = metrics.counter("dasdeployer_animation_frames_total", "Frames sent to the LED strip")
+_frame_interval = metrics.histogram(
+    "dasdeployer_animation_frame_interval_seconds",
+    "Time between frames while animating",
+    buckets=(.01, .02, .025, .03, .0325, .035, .04, .05, .0625, .125, .25, .5),
+)
 
 
 class AnimateThread(threading.Thread):
-    def __init__(self, pixels, ring_brightness, delay):
+    """Render thread, the only code that touches the pixels.
+
+    Commands are dicts of segment name to animation, posted from any thread
+    with `post`, or functions to run on the render thread, posted with `call`
+    (used for the methods below `call` that change how the thread renders).
+    Everything queued when a frame starts is applied before that
+    frame is rendered, so a multi-segment change never shows half done.
+
+    Animations render full scale colors into `_frame`. `_output` then maps the
+    whole frame through the per segment lookup tables, optionally carrying the
+    rounding error to the next frame (temporal dithering) when `fine_luts` is
+    given.
+    """
+
+    def __init__(self, sink, luts, delay, fine_luts=None):
         super(AnimateThread, self).__init__()
         self.daemon = True
         self.stoprequest = threading.Event()
-        self.pixels = pixels
+        self.commands = queue.SimpleQueue()
+        self.sink = sink
         self.delay = delay
-        self.ring_brightness = ring_brightness
-        self._button_animation = None
-        self._ring_animation = None
-        self._key1_animation = None
-        self._key2_animation = None
-        self._button_frame = 0
-        self._ring_frame = 0
-        self._key1_frame = 0
-        self._key2_frame = 0
-
-    @property
-    def button_animation(self):
-        return self._button_animation
-
-    @button_animation.setter
-    def button_animation(self, value):
-        self._button_animation = value
-        self._button_frame = 0
-
-    @property
-    def ring_animation(self):
-        return self._ring_animation
-
-    @ring_animation.setter
-    def ring_animation(self, value):
-        self._ring_animation = value
-        self._ring_frame = 0
-
-    @property
-    def key1_animation(self):
-        return self._key1_animation
-
-    @key1_animation.setter
-    def key1_animation(self, value):
-        self._key1_animation = value
-        self._key1_frame = 0
-
-    @property
-    def key2_animation(self):
-        return self._key2_animation
-
-    @key2_animation.setter
-    def key2_animation(self, value):
-        self._key2_animation = value
-        self._key2_frame = 0
+        self._requested_delay = delay
+        self._min_delay = 0
+        self.simple = False
+        self._luts = luts
+        self._fine_luts = fine_luts
+        self._error = [0] * (_NUM_PIXELS * 3)
+        self._frame = [Color.OFF] * _NUM_PIXELS
+        self._animations = dict.fromkeys(_SEGMENTS)
+        self._frames = dict.fromkeys(_SEGMENTS, 0)
+        self._dirty = set()
+        self._suspended = set()
+        self._chase_patterns = {}
+
+    def post(self, animations):
+        self.commands.put(animations)
+
+    def call(self, fn, *args):
+        self.commands.put((fn, args))
+
+    def set_delay(self, delay):
+        self._requested_delay = delay
+        self.delay = max(self._requested_delay, self._min_delay)
+
+    def set_min_delay(self, min_delay):
+        self._min_delay = min_delay
+        self.delay = max(self._requested_delay, self._min_delay)
+
+    def set_simple(self, simple):
+        self.simple = simple
+        # Redraw so held effects restart (or freeze) cleanly
+        self._dirty.update(_SEGMENTS)
+
+    def suspend(self, segments):
+        for segment in segments:
+            self._suspended.add(segment)
+            segment_range = _SEGMENTS[segment]
+            self._frame[segment_range] = [Color.OFF] * (segment_range.stop - segment_range.start)
+
+    def resume(self):
+        # Static segments need drawing again, animations pick up on the next frame
+        self._dirty.update(self._suspended)
+        self._suspended.clear()
 
     def start(self):
         self.stoprequest.clear()
@@ -352,11 +401,9 @@ class AnimateThread(threading.Thread):
 
     def stop(self, timeout=10):
         self.stoprequest.set()
+        # Wake the thread in case it is idle waiting for a command
+        self.commands.put({})
         self.join(timeout)
-        self.button_animation = None
-        self.ring_animation = None
-        self.key1_animation = None
-        self.key2_animation = None
 
     def join(self, timeout=None):
         super(AnimateThread, self).join(timeout)
@@ -365,106 +412,118 @@ class AnimateThread(threading.Thread):
             raise RuntimeError(
                 "Thread failed to die within %d seconds" % timeout)
 
-    def run(self):
-        while True:
-            # Note that the animate functions control iterating and resetting their own frames
-            # Get a frame for the ring
-            ring_pixels = self._animate_ring(self.pixels[_RING_RANGE])
-            self.pixels[_RING_RANGE] = ring_pixels
-            # Get a frame for the button
-            button_pixels = self._animate_button(self.pixels[_BUTTON_RANGE])
-            self.pixels[_BUTTON_RANGE] = button_pixels
-            # Get a frame for key1
-            key1_pixels = self._animate_key1(self.pixels[_KEY1_RANGE])
-            self.pixels[_KEY1_RANGE] = key1_pixels
-            # Get a frame for key2
-            key2_pixels = self._animate_key2(self.pixels[_KEY2_RANGE])
-            self.pixels[_KEY2_RANGE] = key2_pixels
-            # Show them at the same time
-            self.pixels.show()
-            # Wait a bit then get the next frame
-            if self.stoprequest.wait(self.delay):
-                break
-
-    def _animate_button(self, pixels):
-        if self.button_animation is None:
-            return [self.pixels[_BUTTON_START]] * len(pixels)
-
-        (self._button_frame, pixels) = self._animate(
-            num_pixels=len(pixels),
-            animation_type=self.button_animation["type"],
-            frame=self._button_frame,
-            color=self.button_animation["color"],
-            duration=self.button_animation["duration"])
-
-        return pixels
-
-    def _animate_ring(self, pixels):
-        if self.ring_animation is None:
-            return [self.pixels[_RING_START]] * len(pixels)
-
-        (self._ring_frame, pixels) = self._animate(
-            num_pixels=len(pixels),
-            animation_type=self.ring_animation["type"],
-            frame=self._ring_frame,
-            color=self.ring_animation["color"],
-            duration=self.ring_animation["duration"])
-
-        return pixels
-
-    def _animate_key1(self, pixels):
-        if self.key1_animation is None:
-            return [self.pixels[_KEY1_START]] * len(pixels)
-
-        (self._key1_frame, pixels) = self._animate(
-            num_pixels=len(pixels),
-            animation_type=self.key1_animation["type"],
-            frame=self._key1_frame,
-            color=self.key1_animation["color"],
-            duration=self.key1_animation["duration"])
-
-        return pixels
-
-    def _animate_key2(self, pixels):
-        if self.key2_animation is None:
-            return [self.pixels[_KEY2_START]] * len(pixels)
-
-        (self._key2_frame, pixels) = self._animate(
-            num_pixels=len(pixels),
-            animation_type=self.key2_animation["type"],
-            frame=self._key2_frame,
-            color=self.key2_animation["color"],
-            duration=self.key2_animation["duration"])
-
-        return pixels
+    def _is_static(self, animation):
+        return animation["type"] == AnimationType.FILL or (
+            self.simple and animation["type"] in _COMPLEX_ANIMATIONS
+        )
 
-    def wheel(self, pos):
-        # Taken from the Adafruit Neopixel example code.
-        # Input a value 0 to 255 to get a color value.
-        # The colours are a transition r - g - b - back to r.
-        if pos < 0 or pos > 255:
-            r = g = b = 0
-        elif pos < 85:
-            r = int(pos * 3)
-            g = int(255 - pos * 3)
-            b = 0
-        elif pos < 170:
-            pos -= 85
-            r = int(255 - pos * 3)
-            g = 0
-            b = int(pos * 3)
-        else:
-            pos -= 170
-            r = 0
-            g = int(pos * 3)
-            b = int(255 - pos * 3)
+    def _is_animating(self):
+        return any(
+            animation is not None
+            and not self._is_static(animation)
+            and segment not in self._suspended
+            for (segment, animation) in self._animations.items()
+        )
 
-        # As this is used for the ring, turn down the brightness
-        r = int(r * self.ring_brightness)
-        g = int(g * self.ring_brightness)
-        b = int(b * self.ring_brightness)
+    def _apply(self, command):
+        if isinstance(command, tuple):
+            (fn, args) = command
+            fn(*args)
+            return
+        animations = command
+        for segment, animation in animations.items():
+            self._animations[segment] = animation
+            self._frames[segment] = 0
+            self._dirty.add(segment)
+
+    def _apply_pending(self):
+        while True:
+            try:
+                self._apply(self.commands.get_nowait())
+            except queue.Empty:
+                return
 
-        return (r, g, b)
+    def run(self):
+        next_frame = time.monotonic()
+        shown_at = None
+        while not self.stoprequest.is_set():
+            if self._is_animating():
+                timeout = max(0, next_frame - time.monotonic())
+            else:
+                # Nothing is moving, so sleep until somebody posts a command
+                timeout = None
+                shown_at = None
+            try:
+                self._apply(self.commands.get(timeout=timeout))
+            except queue.Empty:
+                # Frame deadline reached
+                next_frame = max(next_frame + self.delay, time.monotonic())
+            else:
+                self._apply_pending()
+                if timeout is not None and self._is_animating():
+                    # Mid animation, what just changed shows in the frame that's due
+                    continue
+                # Woken from idle, or whatever was moving has just stopped,
+                # so there's no frame due to show it. Show it now and keep time from here.
+                next_frame = time.monotonic() + self.delay
+            if self.stoprequest.is_set():
+                break
+            with tracing.span("frame", "animation"):
+                self._render()
+                # Show all the segments at the same time
+                self.sink.show(self._output())
+            now = time.monotonic()
+            if shown_at is not None:
+                _frame_interval.observe(now - shown_at)
+            shown_at = now
+            _frames.inc()
+
+    def _render(self):
+        # Note that the animate functions control iterating and resetting their own frames
+        for segment, segment_range in _SEGMENTS.items():
+            animation = self._animations[segment]
+            if animation is None or segment in self._suspended:
+                continue
+            if animation["type"] == AnimationType.FILL:
+                if segment in self._dirty:
+                    num_pixels = segment_range.stop - segment_range.start
+                    self._frame[segment_range] = [animation["color"]] * num_pixels
+                continue
+            if self._is_static(animation) and segment not in self._dirty:
+                continue
+            (self._frames[segment], pixels) = self._animate(
+                num_pixels=segment_range.stop - segment_range.start,
+                animation_type=animation["type"],
+                frame=self._frames[segment],
+                color=animation["color"],
+                duration=animation["duration"])
+            self._frame[segment_range] = pixels
+        self._dirty.clear()
+
+    def _output(self):
+        # Segments are contiguous and in order, so they can be appended as we go
+        frame = self._frame
+        output = []
+        for segment, segment_range in _SEGMENTS.items():
+            if self._fine_luts is None:
+                lut = self._luts[segment]
+                output.extend(
+                    (lut[r], lut[g], lut[b]) for (r, g, b) in frame[segment_range]
+                )
+                continue
+            lut = self._fine_luts[segment]
+            error = self._error
+            i = segment_range.start * 3
+            for (r, g, b) in frame[segment_range]:
+                r = lut[r] + error[i]
+                g = lut[g] + error[i + 1]
+                b = lut[b] + error[i + 2]
+                error[i] = r & 0xFF
+                error[i + 1] = g & 0xFF
+                error[i + 2] = b & 0xFF
+                output.append((r >> 8, g >> 8, b >> 8))
+                i += 3
+        return output
 
     def _flash(self, num_pixels, frame, color, duration):
         framesOn = (duration / self.delay)
@@ -502,26 +561,23 @@ class AnimateThread(threading.Thread):
         pixels = [Color.OFF] * num_pixels
         for i in range(num_pixels):
             pixel_index = (i * 256 // num_pixels) + frame
-            pixels[i] = self.wheel(pixel_index & 255)
+            pixels[i] = _WHEEL[pixel_index & 255]
         frame += 1 + int(25 / duration)
         # Max length of animation is 255
         if frame > 255:
             frame = 0
         return (frame, pixels)
 
-    def _chase(self, num_pixels, frame, color):
+    def _chase_pattern(self, num_pixels, color):
         # Define the brightness sequence for pattern
-        min_brightness = self.ring_brightness / 50
+        min_brightness = 1 / 50
         # Add a leading brighter pixel
-        pattern = [self.ring_brightness - ((self.ring_brightness - min_brightness) / 10)]
+        pattern = [1 - ((1 - min_brightness) / 10)]
         # Have a bunch of full brightness pixels
-        pattern += ([self.ring_brightness] * int(num_pixels / 6))
+        pattern += ([1] * int(num_pixels / 6))
         for i in range(int(num_pixels / 3)):
             # linear drop in brightness to min brightness
-            pattern.append(
-                self.ring_brightness
-                - (((self.ring_brightness - min_brightness) / int(num_pixels / 3)) * i)
-            )
+            pattern.append(1 - (((1 - min_brightness) / int(num_pixels / 3)) * i))
         # rest of the pixels at min brightness
         pattern += [min_brightness] * (num_pixels - len(pattern))
 
@@ -530,6 +586,14 @@ class AnimateThread(threading.Thread):
         for pb in reversed(pattern):
             pixel = tuple(int(c * pb) for c in color)
             pixels.append(pixel)
+        return pixels
+
+    def _chase(self, num_pixels, frame, color):
+        # The pattern only depends on the color, so build it once per chase
+        key = (num_pixels, color)
+        pixels = self._chase_patterns.get(key)
+        if pixels is None:
+            pixels = self._chase_patterns[key] = self._chase_pattern(num_pixels, color)
 
         # Rotate the pixels clockwise
         pixels = (pixels[-frame:] + pixels[:-frame])
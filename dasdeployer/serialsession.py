@@ -0,0 +1,218 @@
+"""
+`dasdeployer.serialsession`
+====================================================
+
+Long lived session with the keyboard controller on the serial port.
+
+The port is opened once and kept open. Messages are framed as one JSON
+object per line in each direction. A reader thread blocks on the port with
+a short timeout and queues every line it gets, and `request` waits on that
+queue, so nothing spins while the operator is typing.
+
+`cancel` can be called from any thread (a toggle going down) to give up on
+the request in flight straight away.
+
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from serial import Serial
+
+# Opening the port resets the controller, give it a moment to boot
+_SETTLE_TIME = 1.0
+_RECONNECT_DELAY = 5.0
+# How often a request waiting on the port or another request checks for a cancel
+_CANCEL_CHECK = 0.1
+_CANCELLED = object()
+
+log = logging.getLogger(__name__)
+
+
+class SerialSession(threading.Thread):
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 9600,
+        read_timeout: float = 0.5,
+        serial: Optional[Serial] = None,
+    ) -> None:
+        super(SerialSession, self).__init__()
+        self.daemon = True
+        self.stoprequest = threading.Event()
+        if serial is None:
+            serial = Serial(baudrate=baudrate, timeout=read_timeout)
+            serial.port = port
+        self._serial = serial
+        self._connected = threading.Event()
+        self._responses: queue.SimpleQueue = queue.SimpleQueue()
+        # One request at a time, the controller only has the one screen
+        self._request_lock = threading.Lock()
+        # Bumped by every cancel, a request is cancelled if it's moved on
+        # since the request was made
+        self._cancels = 0
+        self._cancels_lock = threading.Lock()
+        # Whether the controller's sent a bare line rather than JSON, so only
+        # knows single prompts. Checked again every time it reconnects.
+        self.legacy_firmware = False
+
+    def start(self) -> None:
+        self.stoprequest.clear()
+        super(SerialSession, self).start()
+
+    def stop(self, timeout: float | None = 10) -> None:
+        self.stoprequest.set()
+        self.cancel()
+        self.join(timeout)
+        self._serial.close()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def cancel(self) -> None:
+        """Give up on the request in flight, or waiting to go, if there is one."""
+        with self._cancels_lock:
+            self._cancels += 1
+        # Wakes the request up if it's waiting on a reply
+        self._responses.put(_CANCELLED)
+
+    def cancel_token(self) -> int:
+        """Pass to `request` to have any `cancel` from now on cancel it."""
+        with self._cancels_lock:
+            return self._cancels
+
+    def send(self, message: dict[str, Any]) -> None:
+        self._serial.write((json.dumps(message) + "\n").encode())
+
+    def request(
+        self,
+        message: dict[str, Any],
+        timeout: Optional[float] = None,
+        token: Optional[int] = None,
+    ) -> Optional[dict[str, Any]]:
+        """Send `message` and wait for the reply.
+
+        Returns None if there was no reply within `timeout` seconds, the
+        request was cancelled or the controller isn't connected. A cancel
+        counts from when `request` is called, or from when `token` was
+        taken, so a run of requests can be cancelled between them too.
+        """
+        generation = token if token is not None else self.cancel_token()
+        # Once this request has been cancelled it stops waiting, whether for an
+        # earlier request to finish or for the controller to connect
+        if not self._wait(lambda: self._request_lock.acquire(timeout=_CANCEL_CHECK), None, generation):
+            log.info("Keyboard request cancelled")
+            return None
+        try:
+            if not self._wait(
+                lambda: self._connected.wait(_CANCEL_CHECK),
+                timeout if timeout is not None else _SETTLE_TIME * 2,
+                generation,
+            ):
+                if self._cancelled_since(generation):
+                    log.info("Keyboard request cancelled")
+                else:
+                    log.warning("Keyboard controller not connected")
+                return None
+            return self._exchange(message, timeout, generation)
+        finally:
+            self._request_lock.release()
+
+    def _exchange(
+        self,
+        message: dict[str, Any],
+        timeout: Optional[float],
+        generation: int,
+    ) -> Optional[dict[str, Any]]:
+        # Anything left over is a reply to an earlier request, or an earlier
+        # cancel's wake up. Whether this request was cancelled is down to the
+        # count, so one that came in before we got here isn't lost.
+        while not self._responses.empty():
+            self._responses.get_nowait()
+        if self._cancelled_since(generation):
+            log.info("Keyboard request cancelled")
+            return None
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            self.send(message)
+            while True:
+                try:
+                    response = self._responses.get(
+                        timeout=max(0, deadline - time.monotonic()) if deadline is not None else None
+                    )
+                except queue.Empty:
+                    log.warning("Keyboard controller timed out")
+                    return None
+                if response is not _CANCELLED:
+                    return response
+                if self._cancelled_since(generation):
+                    log.info("Keyboard request cancelled")
+                    return None
+                # Waking up for a cancel from before this request was made
+        finally:
+            try:
+                self.send({"state": "disabled"})
+            except OSError as e:
+                log.warning("Keyboard controller write failed: %s", e)
+
+    def _wait(self, ready: Callable[[], bool], timeout: Optional[float], generation: int) -> bool:
+        """Call `ready` until it's true, False if cancelled or `timeout` seconds go by first."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not ready():
+            if self._cancelled_since(generation):
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def _cancelled_since(self, generation: int) -> bool:
+        with self._cancels_lock:
+            return self._cancels != generation
+
+    def _connect(self) -> bool:
+        try:
+            self._serial.open()
+        except OSError as e:
+            log.warning("Can't open keyboard controller: %s", e)
+            return False
+        if self.stoprequest.wait(_SETTLE_TIME):
+            return False
+        self._serial.reset_input_buffer()
+        self.legacy_firmware = False
+        self._connected.set()
+        return True
+
+    def _parse(self, line: bytes) -> dict[str, Any]:
+        text = line.decode(errors="replace").strip()
+        try:
+            message = json.loads(text)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            # Older firmware just sends the value back as a bare line
+            message = {"value": text}
+            self.legacy_firmware = True
+        return message
+
+    def run(self) -> None:
+        while not self.stoprequest.is_set():
+            if not self._serial.is_open and not self._connect():
+                self.stoprequest.wait(_RECONNECT_DELAY)
+                continue
+            try:
+                # Blocks for up to the read timeout, so we notice a stop request
+                line = self._serial.readline()
+            except OSError as e:
+                log.warning("Keyboard controller read failed: %s", e)
+                self._connected.clear()
+                self._serial.close()
+                continue
+            if line.strip():
+                self._responses.put(self._parse(line))
@@ -0,0 +1,83 @@
+"""
+`dasdeployer.startup`
+====================================================
+
+Startup profiler. Records how long each phase of bringing the deployer up
+takes (imports, hardware, splash, loading the backend...) and checks the
+time until the first build status is on the display against a target.
+
+Only uses the standard library, so it can be imported first thing and
+count the imports that come after it.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from typing import Callable, Optional
+
+# The display only has room for short phase names
+_PHASE_WIDTH = 12
+
+log = logging.getLogger(__name__)
+
+
+class StartupProfiler:
+    def __init__(
+        self,
+        on_mark: Optional[Callable[[str, float, float], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._clock = clock
+        self.started = clock()
+        self._last = self.started
+        # Called with (phase, seconds in phase, seconds since start) for every
+        # phase except the last one, so it can be put on the display
+        self.on_mark = on_mark
+        self.phases: list[tuple[str, float]] = []
+        self.total: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.total is not None
+
+    @property
+    def elapsed(self) -> float:
+        return self._clock() - self.started
+
+    def mark(self, phase: str) -> float:
+        """End `phase` and return how long it took."""
+        now = self._clock()
+        duration = now - self._last
+        self._last = now
+        self.phases.append((phase, duration))
+        log.info("%s took %.2fs (%.2fs total)", phase, duration, now - self.started)
+        if self.on_mark and not self.finished:
+            try:
+                self.on_mark(phase, duration, now - self.started)
+            except Exception as e:
+                log.warning("Couldn't report %s: %r", phase, e)
+        return duration
+
+    def finish(self, phase: str, target: Optional[float] = None) -> bool:
+        """End the last phase, log the breakdown and return whether we made `target`."""
+        if self.finished:
+            return True
+        # Stop on_mark from drawing over whatever the last phase put on screen
+        self.total = self.elapsed
+        self.mark(phase)
+        for line in self.lines():
+            log.info("%s", line)
+        if target is None:
+            return True
+        if self.total > target:
+            log.warning("%.2fs to %s is over the %.0fs target", self.total, phase, target)
+            return False
+        log.info("%.2fs to %s, target %.0fs", self.total, phase, target)
+        return True
+
+    def lines(self) -> list[str]:
+        """One short line per phase, slowest first, sized for the LCD."""
+        ranked = sorted(self.phases, key=lambda phase: phase[1], reverse=True)
+        return [f"{name[:_PHASE_WIDTH]:<{_PHASE_WIDTH}}{seconds:>7.2f}s" for (name, seconds) in ranked]
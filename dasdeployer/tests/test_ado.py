@@ -0,0 +1,17 @@
+from types import SimpleNamespace
+
+from ado import _build_status
+from pipelines import QueryResultStatus
+
+
+def status(status, result=None):
+    return _build_status(SimpleNamespace(status=status, result=result))
+
+
+def test_build_status():
+    assert status("inProgress") == (True, QueryResultStatus.RUNNING)
+    assert status("cancelling") == (True, QueryResultStatus.RUNNING)
+    assert status("completed", "succeeded") == (False, QueryResultStatus.SUCCEEDED)
+    assert status("completed", "partiallySucceeded") == (False, QueryResultStatus.PARTIAL)
+    assert status("completed", "canceled") == (False, QueryResultStatus.CANCELED)
+    assert status("completed", "failed") == (False, QueryResultStatus.FAILED)
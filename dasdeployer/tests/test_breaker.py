@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+
+from breaker import CircuitBreaker
+from pipelines import PollStatusThread, QueryResult
+from ratelimit import RateBudget
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimited(Exception):
+    status = 429
+    headers = {"Retry-After": "30"}
+
+    @classmethod
+    def throw(cls):
+        raise cls()
+
+
+class Poller(PollStatusThread):
+    backend = "test"
+
+    def __init__(self, breaker, poll):
+        self._breaker = breaker
+        self._poll = poll
+        super().__init__(
+            config=SimpleNamespace(github_pat="token", github_url=None),
+            github_conn=None,
+            connection=None,
+            last_result=QueryResult(),
+        )
+
+    def _rate_budget(self):
+        return RateBudget("test")
+
+    def _circuit_breaker(self):
+        return self._breaker
+
+    def poll_once(self):
+        self._poll()
+
+
+def failing():
+    raise RuntimeError("down")
+
+
+def tripped(clock):
+    breaker = CircuitBreaker("ci", threshold=3, cooldown=30, clock=clock)
+    for _ in range(3):
+        breaker.failure()
+    return breaker
+
+
+def test_opens_after_threshold_failures():
+    clock = Clock()
+    breaker = CircuitBreaker("ci", threshold=3, cooldown=30, clock=clock)
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.open
+    assert not breaker.allow()
+
+
+def test_lets_one_probe_through_after_the_cooldown():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    # Only the one while it's out
+    assert not breaker.allow()
+    breaker.success()
+    assert not breaker.open
+    assert breaker.allow()
+
+
+def test_failed_probe_doubles_the_cooldown():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.failure()
+    clock.now += 30
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_released_probe_lets_another_through():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.open
+    assert breaker.allow()
+
+
+def test_rate_limited_probe_poll_releases_the_breaker():
+    clock = Clock()
+    breaker = tripped(clock)
+    clock.now += 30
+    poller = Poller(breaker, RateLimited.throw)
+    assert breaker.allow()
+    poller._supervised_poll()
+    # Neither a success nor a failure, but the next poll can still try
+    assert breaker.allow()
+    assert poller.budget.blocked_until > 0
+    poller._poll = lambda: None
+    poller._supervised_poll()
+    assert not breaker.open
+
+
+def test_poll_failures_count_against_the_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker("ci", threshold=2, cooldown=30, clock=clock)
+    poller = Poller(breaker, failing)
+    poller._supervised_poll()
+    poller._supervised_poll()
+    assert poller.failures == 2
+    assert poller._last_result.stale
+    assert breaker.open
+
+
+def test_first_poll_refreshes_without_an_interval():
+    seen = []
+    poller = Poller(CircuitBreaker("ci", threshold=3, cooldown=30), lambda: seen.append(poller.refreshing))
+    polls = iter([False, True])
+    poller._wait = lambda delay: next(polls)
+    poller.run()
+    assert poller.refresh_interval is None
+    assert seen == [True, False]
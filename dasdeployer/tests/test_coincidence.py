@@ -0,0 +1,76 @@
+from coincidence import CoincidenceDetector
+
+
+class Clock:
+    def __init__(self):
+        self.now = 10**12
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += int(seconds * 1e9)
+
+
+def detector(clock, **kwargs):
+    spreads = []
+    keys = CoincidenceDetector(("dev", "prod"), window=1.0, clock=clock, on_match=spreads.append, **kwargs)
+    keys.arm()
+    return (keys, spreads)
+
+
+def test_matches_presses_within_the_window():
+    clock = Clock()
+    (keys, spreads) = detector(clock)
+    assert not keys.press("dev")
+    clock.advance(0.4)
+    assert keys.press("prod")
+    assert keys.matched.is_set()
+    assert spreads == [0.4]
+    # Disarmed once it has fired
+    assert not keys.armed
+
+
+def test_ignores_presses_too_far_apart():
+    clock = Clock()
+    (keys, spreads) = detector(clock)
+    keys.press("dev")
+    clock.advance(1.5)
+    assert not keys.press("prod")
+    assert keys.armed
+    clock.advance(0.2)
+    assert keys.press("dev")
+    assert spreads == [0.2]
+
+
+def test_only_fires_once_per_arm():
+    clock = Clock()
+    (keys, spreads) = detector(clock)
+    keys.press("dev")
+    keys.press("prod")
+    clock.advance(0.1)
+    assert not keys.press("dev")
+    assert not keys.press("prod")
+    assert len(spreads) == 1
+
+
+def test_debounces_a_bouncing_key():
+    clock = Clock()
+    (keys, spreads) = detector(clock, debounce=0.05)
+    keys.press("dev")
+    clock.advance(0.9)
+    keys.press("dev")
+    clock.advance(0.01)
+    # The bounce didn't move the dev press along
+    keys.press("dev")
+    clock.advance(0.5)
+    assert keys.press("prod")
+    assert spreads == [0.51]
+
+
+def test_unarmed_presses_are_ignored():
+    clock = Clock()
+    keys = CoincidenceDetector(("dev", "prod"), clock=clock)
+    assert not keys.press("dev")
+    assert not keys.press("prod")
+    assert not keys.matched.is_set()
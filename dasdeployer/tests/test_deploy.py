@@ -0,0 +1,112 @@
+import threading
+
+import deploy
+from deploy import DeployExecutor
+from pipelines import BuildState, DeployStage, QueryResultStatus
+
+BUILD = BuildState(number=7, result=QueryResultStatus.RUNNING)
+
+
+class FakePipes:
+    def __init__(self, approve):
+        self._approve = approve
+        self.builds = {}
+
+    def approve(self, environment, params, progress, timeout):
+        return self._approve(progress)
+
+    def _set_build(self, environment, state):
+        self.builds[environment] = state
+
+
+class Recorder:
+    def __init__(self):
+        self.stages = []
+        self.done = threading.Event()
+        self.builds = []
+
+    def progress(self, environment, stage):
+        self.stages.append(stage)
+
+    def finished(self, environment, build):
+        self.builds.append(build)
+        self.done.set()
+
+
+def run(approve, timeout=5.0):
+    recorder = Recorder()
+    executor = DeployExecutor(recorder.progress, recorder.finished, timeout=timeout)
+    pipes = FakePipes(approve)
+    assert executor.submit(pipes, "Dev", {})
+    assert recorder.done.wait(5)
+    return (executor, pipes, recorder)
+
+
+def test_reports_the_build_it_started():
+    def approve(progress):
+        progress(DeployStage.DISPATCHED)
+        return BUILD
+    (executor, _, recorder) = run(approve)
+    assert recorder.stages == [DeployStage.QUEUED, DeployStage.DISPATCHED, DeployStage.RUNNING]
+    assert recorder.builds == [BUILD]
+    assert executor.in_flight is None
+
+
+def test_reports_why_the_backend_gave_up():
+    def approve(progress):
+        progress(DeployStage.NO_BRANCH)
+        return None
+    (_, _, recorder) = run(approve)
+    assert recorder.stages == [DeployStage.QUEUED, DeployStage.NO_BRANCH]
+
+
+def test_none_without_a_reason_before_the_timeout_is_a_failure():
+    (_, _, recorder) = run(lambda progress: None)
+    assert recorder.stages[-1] == DeployStage.FAILED
+
+
+def test_an_exception_is_a_failure():
+    def approve(progress):
+        raise RuntimeError("boom")
+    (executor, _, recorder) = run(approve)
+    assert recorder.stages[-1] == DeployStage.FAILED
+    assert recorder.builds == [None]
+    assert executor.in_flight is None
+
+
+def test_only_one_deploy_at_a_time():
+    release = threading.Event()
+    recorder = Recorder()
+    executor = DeployExecutor(recorder.progress, recorder.finished, timeout=5)
+    pipes = FakePipes(lambda progress: release.wait(5) and BUILD)
+    assert executor.submit(pipes, "Dev", {})
+    assert not executor.submit(pipes, "Test", {})
+    release.set()
+    assert recorder.done.wait(5)
+    assert executor.submit(pipes, "Test", {})
+
+
+def test_watchdog_frees_a_hung_deploy_and_tracks_its_late_build(monkeypatch):
+    monkeypatch.setattr(deploy, "_GRACE", 0.05)
+    release = threading.Event()
+    returned = threading.Event()
+
+    def approve(progress):
+        release.wait(5)
+        progress(DeployStage.DISPATCHED)
+        returned.set()
+        return BUILD
+    (executor, pipes, recorder) = run(approve, timeout=0.05)
+    assert recorder.stages == [DeployStage.QUEUED, DeployStage.TIMED_OUT]
+    assert recorder.builds == [None]
+    assert executor.in_flight is None
+
+    release.set()
+    assert returned.wait(5)
+    executor_thread = [t for t in threading.enumerate() if t.name == "deploy-Dev"]
+    for thread in executor_thread:
+        thread.join(5)
+    # Nothing more shown, but the poller gets to watch the build
+    assert recorder.stages == [DeployStage.QUEUED, DeployStage.TIMED_OUT]
+    assert recorder.builds == [None]
+    assert pipes.builds == {"Dev": BUILD}
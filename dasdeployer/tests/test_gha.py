@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+from gha import GhaDispatchContext, GhaWorkflows, _run_status
+from pipelines import QueryResultStatus
+
+
+def run(number, branch, sha="old"):
+    return SimpleNamespace(id=number * 100, run_number=number, head_branch=branch, head_sha=sha)
+
+
+class FakeWorkflow:
+    def __init__(self, runs):
+        self.runs = runs
+
+    def get_runs(self, **filters):
+        return list(self.runs)
+
+
+def context(workflow, last_run_number=3):
+    return GhaDispatchContext(
+        source_branch="dev/feature",
+        workflow=workflow,
+        created_since="2026-10-19",
+        last_run_number=last_run_number,
+    )
+
+
+def find(runs, last_run_number=3):
+    # Doesn't touch anything set up by __init__
+    workflows = GhaWorkflows.__new__(GhaWorkflows)
+    return workflows._find_dispatched_run(context(FakeWorkflow(runs), last_run_number))
+
+
+def test_finds_the_dispatched_run_after_the_branch_moved():
+    # Prefetched before a push, so the run is on a newer commit than the prefetch saw
+    found = find([run(3, "dev/feature"), run(4, "dev/feature", sha="new")])
+    assert found.run_number == 4
+
+
+def test_ignores_runs_from_before_the_dispatch_and_other_branches():
+    assert find([run(2, "dev/feature"), run(3, "dev/feature"), run(4, "dev/other")]) is None
+
+
+def test_takes_the_oldest_new_run():
+    found = find([run(6, "dev/feature"), run(5, "dev/feature")])
+    assert found.run_number == 5
+
+
+def test_run_status():
+    def status(status, conclusion=None):
+        return _run_status(SimpleNamespace(status=status, conclusion=conclusion))
+
+    assert status("queued") == (True, QueryResultStatus.RUNNING)
+    assert status("completed", "action_required") == (True, QueryResultStatus.RUNNING)
+    assert status("completed", "neutral") == (False, QueryResultStatus.SUCCEEDED)
+    assert status("completed", "startup_failure") == (False, QueryResultStatus.FAILED)
+    assert status("completed", "skipped") == (False, QueryResultStatus.CANCELED)
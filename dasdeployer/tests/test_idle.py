@@ -0,0 +1,35 @@
+import threading
+
+from idle import IdleGovernor
+
+
+def governor(can_idle=lambda: True):
+    (idled, woke) = (threading.Event(), threading.Event())
+    idle = IdleGovernor(0.05, idled.set, woke.set, can_idle)
+    return (idle, idled, woke)
+
+
+def test_idles_after_the_quiet_period_and_wakes_on_a_poke():
+    (idle, idled, woke) = governor()
+    idle.start()
+    try:
+        assert idled.wait(2)
+        assert idle.idle
+        idle.poke()
+        assert woke.wait(2)
+    finally:
+        idle.stop()
+    assert not idle.is_alive()
+
+
+def test_stays_awake_while_busy():
+    busy = threading.Event()
+    busy.set()
+    (idle, idled, woke) = governor(lambda: not busy.is_set())
+    idle.start()
+    try:
+        assert not idled.wait(0.3)
+        busy.clear()
+        assert idled.wait(2)
+    finally:
+        idle.stop()
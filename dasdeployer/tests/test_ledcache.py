@@ -0,0 +1,61 @@
+from collections import namedtuple
+
+import pytest
+
+from ledcache import LEDCache
+
+
+class LED:
+    def __init__(self, board):
+        self._board = board
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._board.writes.append(value)
+        self._value = value
+
+
+class Board:
+    namedtuple = namedtuple("Board", ("red", "green"))
+
+    def __init__(self):
+        self.writes = []
+        self.red = LED(self)
+        self.green = LED(self)
+
+
+def test_only_writes_changed_values():
+    board = Board()
+    leds = LEDCache(board)
+    assert leds.update(red=1, green=0) == 2
+    assert leds.update(red=1, green=0.5) == 1
+    assert board.writes == [1.0, 0.0, 0.5]
+    assert leds.avoided == 1
+    assert leds.writes == 3
+
+
+def test_last_set_before_a_flush_wins():
+    board = Board()
+    leds = LEDCache(board)
+    leds.set("red", 1)
+    leds.set("red", 0.25)
+    assert leds.flush() == 1
+    assert board.red.value == 0.25
+
+
+def test_invalidate_writes_everything_again():
+    board = Board()
+    leds = LEDCache(board)
+    leds.off()
+    leds.invalidate()
+    assert leds.off() == 2
+
+
+def test_unknown_led():
+    with pytest.raises(KeyError):
+        LEDCache(Board()).set("blue", 1)
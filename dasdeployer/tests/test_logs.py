@@ -0,0 +1,45 @@
+import logging
+
+from logs import MASK, RateLimitFilter, RedactFilter, redact
+
+
+def record(msg, *args, name="test"):
+    return logging.LogRecord(name, logging.INFO, __file__, 1, msg, args or None, None)
+
+
+def test_masks_github_tokens_in_the_formatted_message():
+    redactor = RedactFilter()
+    entry = record("Connecting with %s", "ghp_" + "a" * 36)
+    assert redactor.filter(entry)
+    assert entry.getMessage() == f"Connecting with {MASK}"
+
+
+def test_masks_registered_secrets():
+    redactor = RedactFilter()
+    redactor.add_secret("hunter2hunter2")
+    # Too short to mask safely
+    redactor.add_secret("abc")
+    assert redactor.scrub("pat=hunter2hunter2 abc") == f"pat={MASK} abc"
+
+
+def test_leaves_clean_messages_alone():
+    redactor = RedactFilter()
+    entry = record("Build %d queued", 7)
+    redactor.filter(entry)
+    assert entry.args == (7,)
+    assert entry.getMessage() == "Build 7 queued"
+
+
+def test_redacts_secret_looking_parameters():
+    assert redact({"ado_pat": "x", "AuthToken": "y", "branch": "main"}) == {
+        "ado_pat": MASK,
+        "AuthToken": MASK,
+        "branch": "main",
+    }
+
+
+def test_rate_limits_each_message_template():
+    limiter = RateLimitFilter(burst=2, per=60)
+    allowed = [limiter.filter(record("Poll failed: %s", n)) for n in range(4)]
+    assert allowed == [True, True, False, False]
+    assert limiter.filter(record("Something else"))
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import ratelimit
+from ratelimit import RateBudget, retry_after
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def budget(remaining, reset_in, reserve=50):
+    clock = Clock()
+    rate = RateBudget("test", reserve=reserve, clock=clock)
+    rate.update(remaining, 5000, clock.now + reset_in)
+    return (rate, clock)
+
+
+def test_polls_at_the_base_interval_with_quota_to_spare():
+    (rate, clock) = budget(5000, 3600)
+    assert rate.interval(10, 2) == 10
+    # Nothing known yet
+    assert RateBudget("test").interval(10, 2) == 10
+
+
+def test_spreads_what_is_left_until_the_reset():
+    (rate, clock) = budget(150, 1000)
+    # 100 to spend after the reserve, 2 a poll
+    assert rate.interval(10, 2) == 20
+    assert not rate.exhausted
+
+
+def test_waits_for_the_reset_once_down_to_the_reserve():
+    (rate, clock) = budget(51, 600)
+    assert rate.interval(10, 2) == 600
+    assert rate.exhausted
+    # Deploys can still use the reserve
+    assert rate.interval(10, 2, deploying=True) < 600
+
+
+def test_throttle_blocks_until_it_passes():
+    (rate, clock) = budget(5000, 3600)
+    rate.throttle(30)
+    assert rate.interval(10, 2) == 30
+    clock.now += 30
+    assert rate.interval(10, 2) == 10
+
+
+def test_ignores_missing_headers():
+    (rate, clock) = budget(100, 60)
+    rate.update(-1, -1, 0)
+    assert rate.remaining == 100
+
+
+def test_shared_per_token():
+    assert ratelimit.for_token("github", "a") is ratelimit.for_token("github", "a")
+    assert ratelimit.for_token("github", "a") is not ratelimit.for_token("github", "b")
+
+
+def error(status, **headers):
+    return SimpleNamespace(status=status, headers=headers)
+
+
+def test_retry_after():
+    clock = Clock()
+    assert retry_after(error(429, **{"Retry-After": "30"})) == 30
+    assert retry_after(error(429)) == 60
+    reset = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(clock.now + 120)}
+    assert retry_after(error(403, **reset), clock) == 120
+    # A plain forbidden isn't a rate limit, and neither is a server error
+    assert retry_after(error(403)) is None
+    assert retry_after(error(500, **{"Retry-After": "30"})) is None
+    assert retry_after(RuntimeError()) is None
+
+
+def test_retry_after_from_requests():
+    response = SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+    assert retry_after(SimpleNamespace(response=response)) == 1
@@ -0,0 +1,50 @@
+import base64
+import gzip
+
+import logs
+import replay
+
+GITHUB_TOKEN = "ghp_" + "x" * 36
+
+
+def test_tokens_from_request_headers():
+    basic = base64.b64encode(b"circle-token-value:").decode()
+    assert replay._tokens({"Authorization": "token abc"}) == ["abc"]
+    assert replay._tokens({"Authorization": f"Basic {basic}"}) == ["circle-token-value"]
+    assert replay._tokens({"Circle-Token": "def"}) == ["def"]
+    assert replay._tokens({}) == []
+
+
+def test_recordings_keep_no_secrets(tmp_path):
+    path = tmp_path / "github.jsonl.gz"
+    logs.add_secret("recorded-circle-token")
+    recorder = replay.Recorder(str(path), "https://api.github.com/")
+    recorder.record(
+        "GET",
+        "/repos/o/r/actions/runs?token=query-secret",
+        200,
+        {"link": "<https://api.github.com/repos/o/r/actions/runs?page=2>; rel=\"next\""},
+        f'{{"token": "{GITHUB_TOKEN}", "circle": "recorded-circle-token"}}',
+    )
+    recorder.close()
+
+    with gzip.open(path, "rt") as f:
+        text = f.read()
+    for secret in (GITHUB_TOKEN, "recorded-circle-token", "query-secret"):
+        assert secret not in text
+    (header, [entry]) = replay.load(str(path))
+    assert entry["path"] == f"/repos/o/r/actions/runs?token={logs.MASK}"
+    assert entry["headers"]["link"].startswith(f"<{replay.BASE}/repos")
+
+
+def test_unchanged_bodies_are_stored_once(tmp_path):
+    path = tmp_path / "github.jsonl.gz"
+    recorder = replay.Recorder(str(path), "https://api.github.com")
+    for body in ("one", "one", "two"):
+        recorder.record("GET", "/rate_limit", 200, {}, body)
+    recorder.close()
+
+    with gzip.open(path, "rt") as f:
+        assert f.read().count('"same":true') == 1
+    (header, entries) = replay.load(str(path))
+    assert [entry["body"] for entry in entries] == ["one", "one", "two"]
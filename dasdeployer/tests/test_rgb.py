@@ -0,0 +1,56 @@
+import time
+
+import rgb
+from pixelsink import RecordingPixelSink
+from rgb import Color, RGBButton
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def ring(frame):
+    return frame[rgb._RING_RANGE]
+
+
+def test_stopping_the_last_animation_clears_it():
+    sink = RecordingPixelSink(rgb._NUM_PIXELS)
+    button = RGBButton(fps=32, sink=sink)
+    try:
+        button.chaseRing(Color.BLUE, 1)
+        wait_for(lambda: sink.count >= 3)
+        button.stopRing()
+        wait_for(lambda: ring(sink.last_frame) == [Color.OFF] * rgb._RING_PIXELS)
+    finally:
+        button.close()
+
+
+def test_commands_mid_animation_keep_to_the_frame_rate():
+    sink = RecordingPixelSink(rgb._NUM_PIXELS)
+    button = RGBButton(fps=32, sink=sink)
+    try:
+        button.chaseRing(Color.BLUE, 1)
+        wait_for(lambda: sink.count >= 2)
+        sink.clear()
+        started = time.monotonic()
+        while time.monotonic() - started < 0.5:
+            # Doesn't stop the ring, so each of these waits for the next frame
+            button.fillButton(Color.RED)
+            time.sleep(0.002)
+        frames = sink.count
+    finally:
+        button.close()
+    # 16 frames are due in half a second, an extra frame per command would be far more
+    assert frames <= 20
+
+
+
+def test_gamma_keeps_dim_levels_lit():
+    table = rgb._gamma_table(0.2, 2.2)
+    assert table[0] == 0
+    assert all(level >= 1 for level in table[1:])
+    assert table[255] == 51
+    assert rgb._gamma_table(0, 2.2) == [0] * 256
@@ -0,0 +1,161 @@
+import json
+import threading
+import time
+
+import pytest
+
+import serialsession
+from serialsession import SerialSession
+
+
+class FakeSerial:
+    """Answers every prompt with `reply`, if there is one, like the controller would."""
+
+    def __init__(self, reply=None, can_open=True):
+        self.reply = reply
+        self.can_open = can_open
+        self.is_open = False
+        self.written = []
+        self._lines = []
+
+    def open(self):
+        if not self.can_open:
+            raise OSError("no such port")
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def reset_input_buffer(self):
+        pass
+
+    def write(self, data):
+        message = json.loads(data)
+        self.written.append(message)
+        if message.get("state") != "disabled" and self.reply is not None:
+            self._lines.append(self.reply)
+
+    def readline(self):
+        time.sleep(0.01)
+        return self._lines.pop(0) if self._lines else b""
+
+
+@pytest.fixture(autouse=True)
+def quick_settle(monkeypatch):
+    monkeypatch.setattr(serialsession, "_SETTLE_TIME", 0.01)
+    monkeypatch.setattr(serialsession, "_RECONNECT_DELAY", 0.01)
+
+
+def started(serial):
+    session = SerialSession("/dev/null", serial=serial)
+    session.start()
+    deadline = time.monotonic() + 2
+    while serial.can_open and not session.connected:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return session
+
+
+def in_thread(fn):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn()))
+    thread.start()
+    return (thread, result)
+
+
+def test_reply_comes_back():
+    session = started(FakeSerial(b'{"value": "42"}\n'))
+    try:
+        assert session.request({"state": "enabled"}, timeout=2) == {"value": "42"}
+    finally:
+        session.stop(2)
+
+
+def test_bare_line_from_older_firmware():
+    session = started(FakeSerial(b"42\n"))
+    try:
+        assert not session.legacy_firmware
+        assert session.request({"state": "form"}, timeout=2) == {"value": "42"}
+        assert session.legacy_firmware
+    finally:
+        session.stop(2)
+
+
+def test_json_reply_isnt_older_firmware():
+    session = started(FakeSerial(b'{"values": {"version": "1"}}\n'))
+    try:
+        session.request({"state": "form"}, timeout=2)
+        assert not session.legacy_firmware
+    finally:
+        session.stop(2)
+
+
+def test_times_out():
+    session = started(FakeSerial())
+    try:
+        assert session.request({"state": "enabled"}, timeout=0.1) is None
+    finally:
+        session.stop(2)
+
+
+def test_cancel_from_before_the_request_doesnt_count():
+    session = started(FakeSerial(b'{"value": "42"}\n'))
+    try:
+        session.cancel()
+        assert session.request({"state": "enabled"}, timeout=2) == {"value": "42"}
+    finally:
+        session.stop(2)
+
+
+def test_cancel_while_waiting_for_the_lock_isnt_lost():
+    session = started(FakeSerial())
+    try:
+        with session._request_lock:
+            (thread, result) = in_thread(lambda: session.request({"state": "enabled"}))
+            time.sleep(0.05)
+            session.cancel()
+            thread.join(1)
+        assert not thread.is_alive()
+        assert result == [None]
+    finally:
+        session.stop(2)
+
+
+def test_cancel_while_waiting_for_a_reply():
+    session = started(FakeSerial())
+    try:
+        (thread, result) = in_thread(lambda: session.request({"state": "enabled"}))
+        time.sleep(0.05)
+        session.cancel()
+        thread.join(1)
+        assert result == [None]
+    finally:
+        session.stop(2)
+
+
+def test_cancel_while_waiting_to_connect():
+    session = started(FakeSerial(can_open=False))
+    try:
+        token = session.cancel_token()
+        (thread, result) = in_thread(lambda: session.request({"state": "enabled"}, timeout=30, token=token))
+        time.sleep(0.05)
+        session.cancel()
+        thread.join(1)
+        assert not thread.is_alive()
+        assert result == [None]
+        # And the next request isn't held up behind it
+        assert session._request_lock.acquire(timeout=0.5)
+        session._request_lock.release()
+    finally:
+        session.stop(2)
+
+
+def test_token_cancels_between_requests():
+    session = started(FakeSerial(b'{"value": "42"}\n'))
+    try:
+        token = session.cancel_token()
+        assert session.request({"state": "enabled"}, timeout=2, token=token) == {"value": "42"}
+        session.cancel()
+        assert session.request({"state": "enabled"}, timeout=2, token=token) is None
+    finally:
+        session.stop(2)
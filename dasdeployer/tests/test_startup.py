@@ -0,0 +1,52 @@
+from startup import StartupProfiler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_times_each_phase_and_reports_all_but_the_last():
+    clock = Clock()
+    marks = []
+    profile = StartupProfiler(lambda *mark: marks.append(mark), clock=clock)
+    clock.now += 1.5
+    assert profile.mark("imports") == 1.5
+    clock.now += 0.5
+    assert profile.finish("first status", target=5)
+    assert profile.phases == [("imports", 1.5), ("first status", 0.5)]
+    assert profile.total == 2.0
+    assert marks == [("imports", 1.5, 1.5)]
+
+
+def test_misses_the_target():
+    clock = Clock()
+    profile = StartupProfiler(clock=clock)
+    clock.now += 9
+    assert not profile.finish("first status", target=8)
+    # Only finishes once
+    assert profile.finish("first status", target=8)
+    assert len(profile.phases) == 1
+
+
+def test_lines_are_slowest_first_and_fit_the_lcd():
+    clock = Clock()
+    profile = StartupProfiler(clock=clock)
+    clock.now += 0.25
+    profile.mark("hardware")
+    clock.now += 3
+    profile.mark("backend import")
+    assert profile.lines() == ["backend impo   3.00s", "hardware       0.25s"]
+    assert all(len(line) == 20 for line in profile.lines())
+
+
+def test_a_failing_display_doesnt_stop_startup():
+    def broken(*mark):
+        raise OSError("i2c")
+
+    profile = StartupProfiler(broken, clock=Clock())
+    profile.mark("splash")
+    assert profile.phases == [("splash", 0.0)]
@@ -0,0 +1,39 @@
+from thermal import ThermalMonitor, ThermalTier
+
+
+def monitor(readings, throttled=None):
+    changes = []
+    readings = iter(readings)
+    thermal = ThermalMonitor(
+        changes.append,
+        read_temperature=lambda: next(readings),
+        read_throttled=lambda: throttled,
+    )
+    return (thermal, changes)
+
+
+def test_tiers_follow_the_thresholds():
+    (thermal, changes) = monitor([50, 66, 73, 80])
+    assert [thermal.sample() for _ in range(4)] == [
+        ThermalTier.NORMAL,
+        ThermalTier.WARM,
+        ThermalTier.HOT,
+        ThermalTier.CRITICAL,
+    ]
+    assert changes == [ThermalTier.WARM, ThermalTier.HOT, ThermalTier.CRITICAL]
+
+
+def test_holds_a_tier_until_cooled_by_the_hysteresis():
+    (thermal, changes) = monitor([73, 70, 68.9])
+    assert thermal.sample() == ThermalTier.HOT
+    # Below 72 but not 3 degrees below
+    assert thermal.sample() == ThermalTier.HOT
+    assert thermal.sample() == ThermalTier.WARM
+    assert changes == [ThermalTier.HOT, ThermalTier.WARM]
+
+
+def test_firmware_throttling_is_at_least_hot():
+    (thermal, changes) = monitor([40], throttled=0x4)
+    assert thermal.sample() == ThermalTier.HOT
+    # Throttled since boot, but not now
+    assert ThermalMonitor(changes.append)._tier_for(40, 0x40000) == ThermalTier.NORMAL
@@ -0,0 +1,56 @@
+import threading
+
+from ui import UIStateMachine
+
+
+def test_handlers_move_between_states():
+    seen = []
+    panel = UIStateMachine(
+        "idle",
+        {
+            "idle": {("red", "held"): lambda: "confirm"},
+            "confirm": {
+                ("red", "pressed"): lambda: seen.append("deploy") or "idle",
+                ("status", "changed"): lambda build: seen.append(build),
+            },
+        },
+    )
+    panel.dispatch("red", "pressed", (), 0)
+    assert panel.state == "idle"
+    panel.dispatch("red", "held", (), 0)
+    assert panel.state == "confirm"
+    # None stays put
+    panel.dispatch("status", "changed", ("build 7",), 0)
+    assert panel.state == "confirm"
+    panel.dispatch("red", "pressed", (), 0)
+    assert panel.state == "idle"
+    assert seen == ["build 7", "deploy"]
+    assert [latency[:3] for latency in panel.latencies] == [
+        ("idle", "red", "held"),
+        ("confirm", "status", "changed"),
+        ("confirm", "red", "pressed"),
+    ]
+
+
+def test_a_failing_handler_doesnt_stop_the_dispatcher():
+    done = threading.Event()
+
+    def broken():
+        raise RuntimeError("boom")
+
+    events = []
+    panel = UIStateMachine(
+        "idle",
+        {"idle": {("red", "pressed"): broken, ("green", "pressed"): lambda: done.set()}},
+        on_event=lambda: events.append(1),
+    )
+    panel.start()
+    try:
+        panel.callback("red", "pressed")()
+        panel.post("green", "pressed")
+        assert done.wait(2)
+    finally:
+        panel.stop()
+    assert not panel.is_alive()
+    # Both were seen, handled or not
+    assert len(events) == 2
@@ -0,0 +1,115 @@
+"""
+`dasdeployer.thermal`
+====================================================
+
+Background thermal monitor. Samples the SoC temperature and the firmware
+throttling flags every few seconds and publishes a `ThermalTier`, so the
+rest of the deployer can shed load before the Pi throttles itself.
+
+Each sample is two small sysfs reads. Tiers only go down again once the
+temperature has dropped `hysteresis` degrees below the threshold, so the
+display doesn't flap around a boundary.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from enum import IntEnum
+from typing import Callable, Optional
+
+# Firmware throttling flags, see `vcgencmd get_throttled`
+_THROTTLED_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+_CURRENTLY_THROTTLED = 0x4
+_SOFT_TEMP_LIMIT = 0x8
+
+log = logging.getLogger(__name__)
+
+
+class ThermalTier(IntEnum):
+    NORMAL = 0
+    WARM = 1
+    HOT = 2
+    CRITICAL = 3
+
+    def __str__(self) -> str:
+        return self.name.lower()
+
+
+def _read_throttled() -> Optional[int]:
+    try:
+        with open(_THROTTLED_PATH) as f:
+            return int(f.read().strip(), 16)
+    except (OSError, ValueError):
+        # Older kernels don't expose this, we fall back to temperature alone
+        return None
+
+
+class ThermalMonitor(threading.Thread):
+    def __init__(
+        self,
+        on_change: Callable[[ThermalTier], None],
+        interval: float = 5,
+        thresholds: tuple[float, float, float] = (65.0, 72.0, 78.0),
+        hysteresis: float = 3.0,
+        read_temperature: Optional[Callable[[], float]] = None,
+        read_throttled: Callable[[], Optional[int]] = _read_throttled,
+    ) -> None:
+        super(ThermalMonitor, self).__init__()
+        self.daemon = True
+        self.stoprequest = threading.Event()
+        self.on_change = on_change
+        self.delay = interval
+        # Temperatures at which WARM, HOT and CRITICAL start
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+        self._read_temperature = read_temperature
+        self._read_throttled = read_throttled
+        self.tier = ThermalTier.NORMAL
+        self.temperature: Optional[float] = None
+        self.throttled: Optional[int] = None
+
+    def start(self) -> None:
+        self.stoprequest.clear()
+        super(ThermalMonitor, self).start()
+
+    def stop(self, timeout: float | None = 10) -> None:
+        self.stoprequest.set()
+        self.join(timeout)
+
+    def _tier_for(self, temperature: float, throttled: Optional[int]) -> ThermalTier:
+        tier = ThermalTier.NORMAL
+        for (level, threshold) in enumerate(self.thresholds, start=1):
+            if level <= self.tier:
+                # Already at or above this tier, hold it until we've cooled off a bit
+                threshold -= self.hysteresis
+            if temperature >= threshold:
+                tier = ThermalTier(level)
+        if throttled and throttled & (_CURRENTLY_THROTTLED | _SOFT_TEMP_LIMIT):
+            # The firmware is already slowing us down, whatever the temperature says
+            tier = max(tier, ThermalTier.HOT)
+        return tier
+
+    def sample(self) -> ThermalTier:
+        if self._read_temperature is None:
+            from gpiozero import CPUTemperature
+            cpu = CPUTemperature()
+            self._read_temperature = lambda: float(cpu.temperature)
+        self.temperature = self._read_temperature()
+        self.throttled = self._read_throttled()
+        tier = self._tier_for(self.temperature, self.throttled)
+        if tier != self.tier:
+            log.warning("Thermal tier %s -> %s at %.1fC", self.tier, tier, self.temperature)
+            self.tier = tier
+            self.on_change(tier)
+        return tier
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.sample()
+            except OSError as e:
+                log.warning("Thermal sample failed: %s", e)
+            if self.stoprequest.wait(self.delay):
+                break
@@ -0,0 +1,166 @@
+"""
+`dasdeployer.tracing`
+====================================================
+
+Opt-in span tracing, written as Chrome trace events so a trace can be
+opened in chrome://tracing or https://ui.perfetto.dev to see where the time
+goes in a poll cycle or a deploy.
+
+Off unless `configure` is given a file, which the deployer does when the
+DASDEPLOYER_TRACE environment variable (or TRACE_FILE in local_settings) is
+set. While off, `span` hands back one shared do-nothing context manager,
+so the spans can stay in the hot paths.
+
+While on, finished spans are queued and a writer thread appends them to the
+file, rotating it once it reaches `max_bytes`. Each file is a JSON array
+that is left open at the end, which the trace viewers accept.
+
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Optional
+
+log = logging.getLogger(__name__)
+
+enabled = False
+_writer: Optional["_TraceWriter"] = None
+
+
+class _NullSpan:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *args: object) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "category", "args", "started")
+
+    def __init__(self, name: str, category: str, args: dict[str, Any]) -> None:
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter_ns()
+
+    def __exit__(self, exc_type: Optional[type], *args: object) -> None:
+        ended = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        writer = _writer
+        if writer is not None:
+            writer.events.put((self.name, self.category, self.args, self.started, ended, threading.get_ident()))
+
+
+def span(name: str, category: str = "dasdeployer", **args: Any) -> Any:
+    """Context manager timing the code inside it, `args` are shown with the span."""
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+
+class _TraceWriter(threading.Thread):
+    def __init__(self, path: str, max_bytes: int, backups: int) -> None:
+        super(_TraceWriter, self).__init__()
+        self.daemon = True
+        self.stoprequest = threading.Event()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.events: queue.SimpleQueue = queue.SimpleQueue()
+        self._pid = os.getpid()
+        self._file = None
+        self._size = 0
+        # Threads that have been named in the current file
+        self._named: set[int] = set()
+
+    def stop(self, timeout: float | None = 10) -> None:
+        self.stoprequest.set()
+        self.events.put(None)
+        self.join(timeout)
+
+    def _open(self) -> None:
+        self._file = open(self.path, "w")
+        self._file.write("[\n")
+        self._size = 2
+        self._named.clear()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self._open()
+
+    def _write(self, event: dict[str, Any]) -> None:
+        line = json.dumps(event, default=str) + ",\n"
+        self._file.write(line)
+        self._size += len(line)
+
+    def _record(self, name: str, category: str, args: dict, started: int, ended: int, tid: int) -> None:
+        if tid not in self._named:
+            self._named.add(tid)
+            thread_name = next((t.name for t in threading.enumerate() if t.ident == tid), str(tid))
+            self._write({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": thread_name}})
+        self._write({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": started / 1000,
+            "dur": (ended - started) / 1000,
+            "pid": self._pid,
+            "tid": tid,
+            "args": args,
+        })
+
+    def run(self) -> None:
+        self._open()
+        while True:
+            event = self.events.get()
+            # Write whatever has built up in one go
+            while event is not None:
+                self._record(*event)
+                try:
+                    event = self.events.get_nowait()
+                except queue.Empty:
+                    event = None
+            self._file.flush()
+            if self._size >= self.max_bytes:
+                self._rotate()
+            if self.stoprequest.is_set():
+                break
+        self._file.close()
+
+
+def configure(path: Optional[str], max_bytes: int = 10 * 1024 * 1024, backups: int = 3) -> None:
+    """Start writing spans to `path`, or stop tracing if it's None."""
+    global enabled, _writer
+    if _writer is not None:
+        enabled = False
+        _writer.stop()
+        _writer = None
+    if not path:
+        return
+    _writer = _TraceWriter(path, max_bytes, backups)
+    _writer.start()
+    enabled = True
+    log.info("Tracing to %s", path)
+
+
+atexit.register(configure, None)
@@ -0,0 +1,106 @@
+"""
+`dasdeployer.ui`
+====================================================
+
+Table driven state machine for the front panel.
+
+gpiozero callbacks (and the display loop, and background jobs) only `post`
+events onto a queue. A single dispatcher thread takes them off in order and
+looks up the handler for (current state, event) in the transition table,
+so handlers never run concurrently and never block a gpiozero thread.
+
+Handlers return the next state, or None to stay put. The time from an
+event being posted to its handler returning (which is when the LCD has been
+written) is recorded for every event that was handled.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+import metrics
+
+# (source, action), e.g. ("red", "held") or ("dev", "up")
+Event = Tuple[str, str]
+Handler = Callable[..., Optional[Hashable]]
+
+# Anything slower than this from input to display gets logged
+_SLOW_EVENT = 0.25
+
+_latency = metrics.histogram(
+    "dasdeployer_ui_latency_seconds",
+    "Time from an input or status event to its handler finishing",
+)
+
+log = logging.getLogger(__name__)
+
+
+class UIStateMachine(threading.Thread):
+    def __init__(
+        self,
+        initial_state: Hashable,
+        transitions: dict[Hashable, dict[Event, Handler]],
+        on_event: Optional[Callable[[], None]] = None,
+        history: int = 256,
+    ) -> None:
+        super(UIStateMachine, self).__init__()
+        self.daemon = True
+        self.stoprequest = threading.Event()
+        self.state = initial_state
+        self.transitions = transitions
+        # Called for every event before it is dispatched, handled or not
+        self.on_event = on_event
+        self.events: queue.SimpleQueue = queue.SimpleQueue()
+        # (state, source, action, seconds from post to handler done)
+        self.latencies: deque = deque(maxlen=history)
+
+    def post(self, source: str, action: str, *args: Any) -> None:
+        self.events.put((source, action, args, time.monotonic()))
+
+    def callback(self, source: str, action: str) -> Callable[[], None]:
+        """Return a gpiozero callback that posts (source, action)."""
+        def post_event() -> None:
+            self.post(source, action)
+        return post_event
+
+    def start(self) -> None:
+        self.stoprequest.clear()
+        super(UIStateMachine, self).start()
+
+    def stop(self, timeout: float | None = 10) -> None:
+        self.stoprequest.set()
+        self.events.put(None)
+        self.join(timeout)
+
+    def dispatch(self, source: str, action: str, args: tuple, posted: float) -> None:
+        if self.on_event:
+            self.on_event()
+        state = self.state
+        handler = self.transitions.get(state, {}).get((source, action))
+        if handler is None:
+            return
+        next_state = handler(*args)
+        if next_state is not None:
+            self.state = next_state
+        latency = time.monotonic() - posted
+        self.latencies.append((state, source, action, latency))
+        _latency.observe(latency)
+        if latency > _SLOW_EVENT:
+            log.warning("Slow UI event %s %s in %s: %.0fms", source, action, state, latency * 1000)
+
+    def run(self) -> None:
+        while not self.stoprequest.is_set():
+            event = self.events.get()
+            if event is None:
+                continue
+            try:
+                self.dispatch(*event)
+            except Exception:
+                # One bad handler mustn't take the whole panel down
+                log.exception("UI handler for %s %s failed", event[0], event[1])
@@ -1,22 +1,28 @@
 #!/usr/bin/env python3
 
 import argparse
-from lcd import LCD_HD44780_I2C
+from control import send_command, DEFAULT_SOCKET
 
 parser = argparse.ArgumentParser(
     description='Write a message to the LCD matrix display.', 
     epilog='Example: ./writelcd.py $\'Hello\\nWorld!\'')
 parser.add_argument('message', help='Text to write to the display')
 parser.add_argument('--displayOff', dest='display', action='store_false', default=True, help='Turn off the display')
+parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Control socket of the running deployer')
 
 args = parser.parse_args()
 
-lcd = LCD_HD44780_I2C()
-if (args.display):
-    lcd.message = args.message
-else:
-    lcd.clear(False)
-
-
-
-
+try:
+    # If the deployer is running it owns the display, so ask it
+    if (args.display):
+        send_command('message', path=args.socket, text=args.message)
+    else:
+        send_command('backlight', path=args.socket, on=False)
+except OSError:
+    # Not running (booting, or shutting down), drive the display directly
+    from lcd import LCD_HD44780_I2C
+    lcd = LCD_HD44780_I2C()
+    if (args.display):
+        lcd.message = args.message
+    else:
+        lcd.clear(False)